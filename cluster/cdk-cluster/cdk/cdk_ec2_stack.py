@@ -136,6 +136,7 @@ class CdkEc2Stack(core.Stack):
         sqs_queue.grant_consume_messages(jobsender)
         sqs_queue.grant_send_messages(jobsender)
         sqs_queue.grant_consume_messages(worker_asg)
+        sqs_queue.grant_send_messages(worker_asg)  # Worker re-queues failed jobs of small file packs
         sqs_queue_DLQ.grant_consume_messages(jobsender)
 
         # Allow EC2 access SSM Parameter Store, get bucket infor and get credential
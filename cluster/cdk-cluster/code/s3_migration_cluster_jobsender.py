@@ -1,12 +1,15 @@
 # PROJECT LONGBOW - JOBSENDER FOR COMPARE AMAZON S3 AND CREATE DELTA JOB LIST TO SQS
 
+import concurrent.futures
+import hashlib
 import json
 import os
 import sys
 import time
 from configparser import ConfigParser
 from s3_migration_lib import set_env, set_log, job_upload_sqs_ddb, delta_job_list, check_sqs_empty, \
-    get_des_file_list, get_src_file_list
+    get_des_file_list, get_src_file_list, iter_des_file_list, iter_src_file_list, stream_delta_job_list, \
+    pack_small_jobs, ListSnapshot, iter_src_inventory_list, iter_des_inventory_list, stream_index_delta_job_list
 from operator import itemgetter
 from pathlib import Path
 
@@ -24,8 +27,17 @@ try:
     MaxRetry = cfg.getint('Mode', 'MaxRetry')
     MaxThread = cfg.getint('Mode', 'MaxThread')
     MaxParallelFile = cfg.getint('Mode', 'MaxParallelFile')
+    WorkerMaxMemory = cfg.getint('Mode', 'WorkerMaxMemory')
     LoggingLevel = cfg.get('Debug', 'LoggingLevel')
     JobsenderCompareVersionId = cfg.getboolean('Mode', 'JobsenderCompareVersionId')
+    ListConcurrency = cfg.getint('Mode', 'ListConcurrency')
+    VersionIndexSegments = cfg.getint('Mode', 'VersionIndexSegments')
+    JobsenderStreamMode = cfg.getboolean('Mode', 'JobsenderStreamMode')
+    ListSnapshotHours = cfg.getfloat('Mode', 'ListSnapshotHours')
+    SqsSendConcurrency = cfg.getint('Mode', 'SqsSendConcurrency')
+    BucketPairConcurrency = cfg.getint('Mode', 'BucketPairConcurrency')
+    SmallFileJobsPerMessage = cfg.getint('Mode', 'SmallFileJobsPerMessage')
+    ResumableThreshold = cfg.getint('Mode', 'ResumableThreshold') * 1024 * 1024
 except Exception as e:
     print("s3_migration_cluster_config.ini ERR: ", str(e))
     sys.exit(0)
@@ -39,6 +51,241 @@ except Exception as e:
     print("No Environment Variable from CDK, use the para from config.ini", str(e))
 
 
+# Pass jobs through to sqs sender, and write them to local backup json file on the way
+# snapshot: 把 Job 的Key记到 ListSnapshot，下次仍与目的桶对比
+def backup_job_stream(job_iter, local_backup_list, job_stats, snapshot):
+    with open(local_backup_list, 'w') as f:
+        f.write('[')
+        for job in job_iter:
+            if job_stats['count']:
+                f.write(', ')
+            json.dump(job, f)
+            job_stats['count'] += 1
+            job_stats['max_size'] = max(job_stats['max_size'], job['Size'])
+            if snapshot is not None:
+                snapshot.add_job(job['Src_key'])
+            yield job
+        f.write(']')
+
+
+# Compare one bucket pair and send its delta jobs to sqs, pair_no is the index in ssm_parameter_bucket
+def process_bucket_pair(pair_no, bucket_para, send_pool):
+    src_bucket = bucket_para['src_bucket']
+    src_prefix = bucket_para['src_prefix']
+    des_bucket = bucket_para['des_bucket']
+    des_prefix = bucket_para['des_prefix']
+    # 可选的 S3 Inventory manifest.json，"s3://bucket/key" 或本地路径
+    src_inventory = bucket_para.get('src_inventory', '')
+    des_inventory = bucket_para.get('des_inventory', '')
+    pair_name = f'{src_bucket}/{src_prefix} -> {des_bucket}/{des_prefix}'
+    pair_start = time.time()
+    logger.info(f'Start bucket pair {pair_no}: {pair_name}')
+
+    t = time.localtime()
+    start_time = f'{t.tm_year}-{t.tm_mon}-{t.tm_mday}-{t.tm_hour}-{t.tm_min}-{t.tm_sec}'
+    log_path = str(Path(log_file_name).parent)
+    # 同一个源桶的多个桶对可能在同一秒开始，文件名加上桶对序号
+    local_backup_list = f'{log_path}/job-list-{src_bucket}-{start_time}-{pair_no}.json'
+
+    # 源桶列表快照，未过期时只对比比快照新增或改变的源对象。每个桶对一个文件，并行的桶对不会争用 sqlite 写锁
+    snapshot = None
+    if ListSnapshotHours > 0 and not src_inventory:
+        pair_hash = hashlib.md5(pair_name.encode('utf-8')).hexdigest()[:8]
+        snapshot = ListSnapshot(
+            path=f'{log_path}/list-snapshot-{src_bucket}-{pair_hash}.db',
+            bucket=src_bucket,
+            S3Prefix=src_prefix,
+            MaxAge=ListSnapshotHours * 3600
+        )
+
+    # 与快照对比时，要等源桶列完才知道目的桶列哪些目录，不走流式模式。变化的源对象通常不多
+    if src_inventory or (JobsenderStreamMode and (snapshot is None or snapshot.full)):
+        ignore_records = []
+        job_stats = {'count': 0, 'max_size': 0}
+        if src_inventory:
+            # S3 Inventory 模式：从 Inventory 报告读取列表代替 API 列表，报告不按Key排序，
+            # 目的列表建索引后源列表逐条流过对比，直接按批发送 SQS
+            logger.info(f'Read source inventory: {src_inventory}')
+            if des_inventory:
+                logger.info(f'Read destination inventory: {des_inventory}')
+                des_file_iter = iter_des_inventory_list(
+                    s3_client=s3_des_client,
+                    manifest=des_inventory,
+                    bucket=des_bucket,
+                    S3Prefix=des_prefix,
+                    table=table,
+                    JobsenderCompareVersionId=JobsenderCompareVersionId,
+                    VersionIndexSegments=VersionIndexSegments
+                )
+            else:
+                des_file_iter = iter_des_file_list(
+                    s3_client=s3_des_client,
+                    bucket=des_bucket,
+                    S3Prefix=des_prefix,
+                    table=table,
+                    JobsenderCompareVersionId=JobsenderCompareVersionId,
+                    ListConcurrency=ListConcurrency,
+                    VersionIndexSegments=VersionIndexSegments,
+                    snapshot=None
+                )
+            job_iter = stream_index_delta_job_list(
+                src_file_iter=iter_src_inventory_list(
+                    s3_client=s3_src_client,
+                    manifest=src_inventory,
+                    S3Prefix=src_prefix,
+                    JobsenderCompareVersionId=JobsenderCompareVersionId
+                ),
+                des_file_iter=des_file_iter,
+                src_bucket=src_bucket,
+                src_prefix=src_prefix,
+                des_bucket=des_bucket,
+                des_prefix=des_prefix,
+                ignore_list=ignore_list,
+                ignore_records=ignore_records,
+                JobsenderCompareVersionId=JobsenderCompareVersionId
+            )
+        else:
+            # 流式模式：源/目的列表按页流经 merge-join 对比，直接按批发送 SQS，内存占用只跟分页大小有关
+            logger.info(f'Stream source and destination bucket: {pair_name}')
+            job_iter = stream_delta_job_list(
+                src_file_iter=iter_src_file_list(
+                    s3_client=s3_src_client,
+                    bucket=src_bucket,
+                    S3Prefix=src_prefix,
+                    JobsenderCompareVersionId=JobsenderCompareVersionId,
+                    ListConcurrency=ListConcurrency,
+                    snapshot=snapshot
+                ),
+                des_file_iter=iter_des_file_list(
+                    s3_client=s3_des_client,
+                    bucket=des_bucket,
+                    S3Prefix=des_prefix,
+                    table=table,
+                    JobsenderCompareVersionId=JobsenderCompareVersionId,
+                    ListConcurrency=ListConcurrency,
+                    VersionIndexSegments=VersionIndexSegments,
+                    snapshot=None
+                ),
+                src_bucket=src_bucket,
+                src_prefix=src_prefix,
+                des_bucket=des_bucket,
+                des_prefix=des_prefix,
+                ignore_list=ignore_list,
+                ignore_records=ignore_records,
+                JobsenderCompareVersionId=JobsenderCompareVersionId
+            )
+        try:
+            submit_count, sent_count = job_upload_sqs_ddb(
+                sqs=sqs,
+                sqs_queue=sqs_queue,
+                job_list=pack_small_jobs(
+                    job_list=backup_job_stream(job_iter, local_backup_list, job_stats, snapshot),
+                    ResumableThreshold=ResumableThreshold,
+                    JobsPerMessage=SmallFileJobsPerMessage
+                ),
+                SqsSendConcurrency=SqsSendConcurrency,
+                MaxRetry=MaxRetry,
+                send_pool=send_pool
+            )
+            if snapshot is not None:
+                snapshot.commit(all_sent=sent_count == submit_count)
+        except Exception as e:
+            logger.error(f'Fail to stream jobs of {src_bucket}/{src_prefix}, '
+                         f'jobs sent before the error are kept in queue: {str(e)}')
+        job_count, max_object_size = job_stats['count'], job_stats['max_size']
+        if job_count:
+            logger.info(f'Write Job List: {os.path.abspath(local_backup_list)}')
+        elif os.path.exists(local_backup_list):
+            os.remove(local_backup_list)
+    else:
+        # Get List on S3
+        logger.info(f'Get source bucket: {src_bucket}/{src_prefix}')
+        src_file_list = get_src_file_list(
+            s3_client=s3_src_client,
+            bucket=src_bucket,
+            S3Prefix=src_prefix,
+            JobsenderCompareVersionId=JobsenderCompareVersionId,
+            ListConcurrency=ListConcurrency,
+            snapshot=snapshot
+        )
+        logger.info(f'Get destination bucket: {des_bucket}/{des_prefix}')
+        des_file_list = get_des_file_list(
+            s3_client=s3_des_client,
+            bucket=des_bucket,
+            S3Prefix=des_prefix,
+            table=table,
+            JobsenderCompareVersionId=JobsenderCompareVersionId,
+            ListConcurrency=ListConcurrency,
+            VersionIndexSegments=VersionIndexSegments,
+            snapshot=snapshot
+        )
+        # Generate job list
+        job_list, ignore_records = delta_job_list(
+            src_file_list=src_file_list,
+            des_file_list=des_file_list,
+            src_bucket=src_bucket,
+            src_prefix=src_prefix,
+            des_bucket=des_bucket,
+            des_prefix=des_prefix,
+            ignore_list=ignore_list,
+            JobsenderCompareVersionId=JobsenderCompareVersionId
+        )
+
+        # Upload jobs to sqs
+        job_count = len(job_list)
+        if snapshot is not None:
+            for job in job_list:
+                snapshot.add_job(job['Src_key'])
+        submit_count, sent_count = 0, 0
+        if job_count != 0:
+            submit_count, sent_count = job_upload_sqs_ddb(
+                sqs=sqs,
+                sqs_queue=sqs_queue,
+                job_list=pack_small_jobs(
+                    job_list=job_list,
+                    ResumableThreshold=ResumableThreshold,
+                    JobsPerMessage=SmallFileJobsPerMessage
+                ),
+                SqsSendConcurrency=SqsSendConcurrency,
+                MaxRetry=MaxRetry,
+                send_pool=send_pool
+            )
+            max_object_size = max(job_list, key=itemgetter('Size'))['Size']
+
+            # Just backup for debug
+            logger.info('Writing job list to local file backup...')
+            with open(local_backup_list, 'w') as f:
+                json.dump(job_list, f)
+            logger.info(f'Write Job List: {os.path.abspath(local_backup_list)}')
+        # Job 全部发送后才保存快照，有消息发送失败时下次仍与上次的快照对比
+        if snapshot is not None:
+            snapshot.commit(all_sent=sent_count == submit_count)
+
+    if job_count != 0:
+        MaxChunkSize = int(max_object_size / 10000) + 1024
+        if MaxChunkSize < 5*1024*1024:
+            MaxChunkSize = 5*1024*1024
+        logger.warning(f'Max object size in job_list: {max_object_size}.\n Worker part buffers may take up to'
+                       f' MaxChunksize x MaxThread x MaxParallelFile, i.e. '
+                       f'{MaxChunkSize} x {MaxThread} x {MaxParallelFile} = '
+                       f'{MaxChunkSize*MaxThread*MaxParallelFile}.\n They are capped by WorkerMaxMemory: '
+                       f'{WorkerMaxMemory} MB (0: half of the instance memory), part downloads wait beyond it.')
+    else:
+        logger.info(f'Source list are all in Destination, no job to send: {pair_name}')
+
+    # Just backup for debug
+    if ignore_records:
+        logger.info('Writing ignore list to local file backup...')
+        local_ignore_records = f'{log_path}/ignore-records-{src_bucket}-{start_time}-{pair_no}.json'
+        with open(local_ignore_records, 'w') as f:
+            json.dump(ignore_records, f)
+        logger.info(f'Write Ignore List: {os.path.abspath(local_ignore_records)}')
+
+    logger.info(f'Finish bucket pair {pair_no}: {pair_name}, {job_count} jobs in '
+                f'{int(time.time() - pair_start)} Seconds')
+    return job_count
+
+
 # Main
 if __name__ == '__main__':
 
@@ -84,73 +331,24 @@ if __name__ == '__main__':
         except Exception as e:
             logger.error(f'Fail to get buckets info from ssm_parameter_bucket, fix and restart Jobsender. {str(e)}')
             sys.exit(0)
-        for bucket_para in load_bucket_para:
-            src_bucket = bucket_para['src_bucket']
-            src_prefix = bucket_para['src_prefix']
-            des_bucket = bucket_para['des_bucket']
-            des_prefix = bucket_para['des_prefix']
-
-            # Get List on S3
-            logger.info('Get source bucket')
-            src_file_list = get_src_file_list(
-                s3_client=s3_src_client,
-                bucket=src_bucket,
-                S3Prefix=src_prefix,
-                JobsenderCompareVersionId=JobsenderCompareVersionId
-            )
-            logger.info('Get destination bucket')
-            des_file_list = get_des_file_list(
-                s3_client=s3_des_client,
-                bucket=des_bucket,
-                S3Prefix=des_prefix,
-                table=table,
-                JobsenderCompareVersionId=JobsenderCompareVersionId
-            )
-            # Generate job list
-            job_list, ignore_records = delta_job_list(
-                src_file_list=src_file_list,
-                des_file_list=des_file_list,
-                src_bucket=src_bucket,
-                src_prefix=src_prefix,
-                des_bucket=des_bucket,
-                des_prefix=des_prefix,
-                ignore_list=ignore_list,
-                JobsenderCompareVersionId=JobsenderCompareVersionId
-            )
-
-            # Upload jobs to sqs
-            if len(job_list) != 0:
-                job_upload_sqs_ddb(
-                    sqs=sqs,
-                    sqs_queue=sqs_queue,
-                    job_list=job_list
-                )
-                max_object = max(job_list, key=itemgetter('Size'))
-                MaxChunkSize = int(max_object['Size'] / 10000) + 1024
-                if MaxChunkSize < 5*1024*1024:
-                    MaxChunkSize = 5*1024*1024
-                logger.warning(f'Max object size in job_list: {max_object["Size"]}.\n Require instance memory'
-                               f' > MaxChunksize x MaxThread x MaxParallelFile, i.e. '
-                               f'{MaxChunkSize} x {MaxThread} x {MaxParallelFile} = '
-                               f'{MaxChunkSize*MaxThread*MaxParallelFile}.\n If less memory, instance may crash!')
-            else:
-                logger.info('Source list are all in Destination, no job to send.')
-
-            # Just backup for debug
-            logger.info('Writing job and ignore list to local file backup...')
-            t = time.localtime()
-            start_time = f'{t.tm_year}-{t.tm_mon}-{t.tm_mday}-{t.tm_hour}-{t.tm_min}-{t.tm_sec}'
-            log_path = str(Path(log_file_name).parent)
-            if job_list:
-                local_backup_list = f'{log_path}/job-list-{src_bucket}-{start_time}.json'
-                with open(local_backup_list, 'w') as f:
-                    json.dump(job_list, f)
-                logger.info(f'Write Job List: {os.path.abspath(local_backup_list)}')
-            if ignore_records:
-                local_ignore_records = f'{log_path}/ignore-records-{src_bucket}-{start_time}.json'
-                with open(local_ignore_records, 'w') as f:
-                    json.dump(ignore_records, f)
-                logger.info(f'Write Ignore List: {os.path.abspath(local_ignore_records)}')
+        # 桶对之间并行列表/对比，SQS 发送共用一个线程池，总的发送并发仍是 SqsSendConcurrency
+        logger.info(f'Process {len(load_bucket_para)} bucket pairs, concurrency: {BucketPairConcurrency}')
+        all_start = time.time()
+        total_jobs = 0
+        with concurrent.futures.ThreadPoolExecutor(max_workers=SqsSendConcurrency) as send_pool, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=BucketPairConcurrency) as pair_pool:
+            futures = {pair_pool.submit(process_bucket_pair, pair_no, bucket_para, send_pool): bucket_para
+                       for pair_no, bucket_para in enumerate(load_bucket_para)}
+            for done_count, future in enumerate(concurrent.futures.as_completed(futures), 1):
+                bucket_para = futures[future]
+                try:
+                    total_jobs += future.result()
+                except Exception as e:
+                    logger.error(f'Fail to process bucket pair {bucket_para["src_bucket"]}/'
+                                 f'{bucket_para["src_prefix"]}: {str(e)}')
+                logger.info(f'Bucket pairs completed: {done_count}/{len(futures)}')
+        logger.info(f'Complete {len(load_bucket_para)} bucket pairs, {total_jobs} jobs in '
+                    f'{int(time.time() - all_start)} Seconds')
 
     else:
         logger.error('Job sqs queue is not empty or fail to get_queue_attributes. Stop process.')
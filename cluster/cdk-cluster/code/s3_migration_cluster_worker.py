@@ -2,10 +2,13 @@
 
 import os
 import sys
+import queue
+import threading
 import concurrent.futures
 from configparser import ConfigParser, NoOptionError
 
-from s3_migration_lib import set_env, set_log, job_looper
+from s3_migration_lib import set_env, set_log, job_looper, sqs_receiver, BufferPool, AdaptiveController, \
+    RateLimiter, parse_rate_schedule, RetryPolicy, PartExecutor
 
 # Read config.ini
 cfg = ConfigParser()
@@ -23,9 +26,25 @@ try:
     ChunkSize = cfg.getint('Debug', 'ChunkSize') * Megabytes
     ResumableThreshold = cfg.getint('Mode', 'ResumableThreshold') * Megabytes
     MaxRetry = cfg.getint('Mode', 'MaxRetry')
+    RetryMaxDelay = cfg.getfloat('Mode', 'RetryMaxDelay')
+    FileRetryBudget = cfg.getint('Mode', 'FileRetryBudget')
     MaxThread = cfg.getint('Mode', 'MaxThread')
+    MaxUploadThread = cfg.getint('Mode', 'MaxUploadThread')
+    AdaptiveTransfer = cfg.getboolean('Mode', 'AdaptiveTransfer')
+    MaxChunkSize = cfg.getint('Mode', 'MaxChunkSize') * Megabytes
     MaxParallelFile = cfg.getint('Mode', 'MaxParallelFile')
+    WorkerMaxThread = cfg.getint('Mode', 'WorkerMaxThread')
+    SmallFileMaxThread = cfg.getint('Mode', 'SmallFileMaxThread')
+    WorkerMaxMemory = cfg.getint('Mode', 'WorkerMaxMemory') * Megabytes
+    PartSpoolThreshold = cfg.getint('Mode', 'PartSpoolThreshold') * Megabytes
     JobTimeout = cfg.getint('Mode', 'JobTimeout')
+    SqsWaitTimeSeconds = cfg.getint('Mode', 'SqsWaitTimeSeconds')
+    SrcMaxBandwidth = cfg.getfloat('Mode', 'SrcMaxBandwidth') * Megabytes
+    SrcMaxRequestRate = cfg.getfloat('Mode', 'SrcMaxRequestRate')
+    DesMaxBandwidth = cfg.getfloat('Mode', 'DesMaxBandwidth') * Megabytes
+    DesMaxRequestRate = cfg.getfloat('Mode', 'DesMaxRequestRate')
+    RateLimitSchedule = parse_rate_schedule(cfg.get('Mode', 'RateLimitSchedule'))
+    RateLimitShareByDDB = cfg.getboolean('Mode', 'RateLimitShareByDDB')
     LoggingLevel = cfg.get('Debug', 'LoggingLevel')
     CleanUnfinishedUpload = cfg.getboolean('Debug', 'CleanUnfinishedUpload')
     LocalProfileMode = cfg.getboolean('Debug', 'LocalProfileMode')
@@ -68,13 +87,59 @@ if __name__ == '__main__':
     # Program start processing here
     #######
 
+    # 处理期间 heartbeat 按队列的 VisibilityTimeout 不断延长消息不可见时间
+    try:
+        VisibilityTimeout = int(sqs.get_queue_attributes(
+            QueueUrl=sqs_queue,
+            AttributeNames=['VisibilityTimeout']
+        )['Attributes']['VisibilityTimeout'])
+        logger.info(f'SQS VisibilityTimeout: {VisibilityTimeout}')
+    except Exception as e:
+        logger.error(f'Fail to get sqs VisibilityTimeout, fix and restart worker. {str(e)}')
+        sys.exit(0)
+
+    # 所有文件的分片缓冲区共用一个内存预算，默认为物理内存的一半
+    if WorkerMaxMemory <= 0:
+        WorkerMaxMemory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // 2
+    logger.info(f'Part buffers memory limit: {WorkerMaxMemory} Bytes')
+    buffer_pool = BufferPool(WorkerMaxMemory, PartSpoolThreshold)
+    adaptive = AdaptiveController(MaxChunkSize) if AdaptiveTransfer else None
+    rate_limiter = RateLimiter(
+        SrcMaxBandwidth=SrcMaxBandwidth,
+        SrcMaxRequestRate=SrcMaxRequestRate,
+        DesMaxBandwidth=DesMaxBandwidth,
+        DesMaxRequestRate=DesMaxRequestRate,
+        schedule=RateLimitSchedule,
+        table=table if RateLimitShareByDDB else None,
+        instance_id=instance_id
+    )
+    retry_policy = RetryPolicy(RetryMaxDelay=RetryMaxDelay, FileRetryBudget=FileRetryBudget)
+
+    # 所有文件共用的分片线程，默认与每个文件单独建线程池时的总线程数相同
+    if WorkerMaxThread <= 0:
+        WorkerMaxThread = MaxParallelFile * (MaxThread + MaxUploadThread)
+    logger.info(f'Start {WorkerMaxThread} part threads.')
+    part_executor = PartExecutor(WorkerMaxThread)
+
     # For concur jobs(files)
     logger.info(f'Start concurrent {MaxParallelFile} jobs.')
-    with concurrent.futures.ThreadPoolExecutor(max_workers=MaxParallelFile) as job_pool:
+    # 一个 receiver 线程 Long Polling 取消息，放入 work_queue 给 MaxParallelFile 个 job_looper 处理
+    work_queue = queue.Queue()
+    idle_slots = threading.Semaphore(MaxParallelFile)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=MaxParallelFile + 1) as job_pool:
+        job_pool.submit(sqs_receiver,
+                        sqs=sqs,
+                        sqs_queue=sqs_queue,
+                        work_queue=work_queue,
+                        idle_slots=idle_slots,
+                        WaitTimeSeconds=SqsWaitTimeSeconds
+                        )
         for i in range(MaxParallelFile):  # 这里只控制多个Job同时循环进行，每个Job的并发和超时在内层控制
             job_pool.submit(job_looper,
                             sqs=sqs,
                             sqs_queue=sqs_queue,
+                            work_queue=work_queue,
+                            idle_slots=idle_slots,
                             table=table,
                             s3_src_client=s3_src_client,
                             s3_des_client=s3_des_client,
@@ -85,10 +150,19 @@ if __name__ == '__main__':
                             MaxThread=MaxThread,
                             ResumableThreshold=ResumableThreshold,
                             JobTimeout=JobTimeout,
+                            VisibilityTimeout=VisibilityTimeout,
                             ifVerifyMD5Twice=ifVerifyMD5Twice,
                             CleanUnfinishedUpload=CleanUnfinishedUpload,
                             Des_bucket_default=Des_bucket_default,
                             Des_prefix_default=Des_prefix_default,
                             UpdateVersionId=UpdateVersionId,
-                            GetObjectWithVersionId=GetObjectWithVersionId
+                            GetObjectWithVersionId=GetObjectWithVersionId,
+                            JobType=JobType,
+                            buffer_pool=buffer_pool,
+                            MaxUploadThread=MaxUploadThread,
+                            adaptive=adaptive,
+                            rate_limiter=rate_limiter,
+                            retry_policy=retry_policy,
+                            part_executor=part_executor,
+                            SmallFileMaxThread=SmallFileMaxThread
                             )
@@ -1,9 +1,14 @@
 # PROJECT LONGBOW - LIB FOR TRANSMISSION BETWEEN AMAZON S3
 
 import datetime
+import functools
 import logging
 import hashlib
+import inspect
 import concurrent.futures
+import csv
+import gzip
+import io
 import threading
 import base64
 import urllib.request
@@ -14,13 +19,34 @@ from botocore.exceptions import ClientError
 # from boto3.dynamodb import conditions
 import json
 import os
+import random
+import re
+import sqlite3
 import sys
+import tempfile
 import time
-from fnmatch import fnmatchcase
+from array import array
+from bisect import bisect_right
+from collections import deque
+from fnmatch import translate
+from itertools import islice
 from pathlib import PurePosixPath, Path
 
 logger = logging.getLogger()
 Max_md5_retry = 2
+List_split_chars = ['0123456789', 'ABCDEFGHIJKLMNOPQRSTUVWXYZ', 'abcdefghijklmnopqrstuvwxyz']  # 并发列表切分 shard 的字符
+List_shard_pages = 2  # 并发列表时一个 shard 任务连续列出的页数
+Max_sqs_message_bytes = 256 * 1024  # SQS 单条消息和单个 send_message_batch 的总大小上限
+Read_block_size = 1024 * 1024  # 下载分片时每次从 Body 读入缓冲区的大小
+Part_target_seconds = 2  # 自适应分片大小：让单个分片的传输时间约为这么多秒，越过 TCP 慢启动
+Adaptive_start_threads = 4  # 自适应并发：单个文件每个方向的起始线程数
+Rate_limit_workers_key = '__ratelimit__/workers'  # DDB 里登记各 worker 心跳的 Key，桶名不能以 '_' 开头，不会与文件记录冲突
+Rate_limit_heartbeat = 20  # 共享限速时 worker 登记心跳的间隔秒数，超过 3 倍间隔没有心跳的 worker 不再计入
+Part_md5_flush_seconds = 10  # ifVerifyMD5Twice 时每隔多少秒把新完成分片的 MD5 批量写入 DDB
+Snapshot_insert_batch = 10000  # 写入列表快照时每批插入的行数
+Retry_base_delay = {'throttle': 1, 'server': 0.5, 'network': 0.2, 'other': 1}  # 各类错误第一次重试的基准等待秒数
+Retry_throttle_codes = {'SlowDown', 'Throttling', 'ThrottlingException', 'RequestLimitExceeded', 'TooManyRequests',
+                        'TooManyRequestsException', 'ServiceUnavailable', 'RequestThrottled'}
 
 
 # Configure logging
@@ -75,7 +101,8 @@ def set_env(*, JobType, LocalProfileMode, table_queue_name, sqs_queue_name, ssm_
             aws_secret_access_key=credentials["aws_secret_access_key"],
             region_name=credentials["region"]
         )
-        if JobType.upper() == "PUT":
+        # COPY 与 PUT 一样取凭证，用目标端 client 做 S3 服务端复制，需要目标 Account 的 credentials 能读源桶
+        if JobType.upper() in ["PUT", "COPY"]:
             s3_src_client = boto3.client('s3', region, config=s3_config)
             s3_des_client = credentials_session.client('s3', config=s3_config)
         elif JobType.upper() == "GET":
@@ -137,153 +164,855 @@ def check_sqs_empty(sqs, sqs_queue):
     return False  # sqs is not empty
 
 
-# Get source S3 bucket file list with versionId
-def get_src_file_list(*, s3_client, bucket, S3Prefix, JobsenderCompareVersionId):
-    # get s3 file list
-    file_list = []
-    if JobsenderCompareVersionId:
-        paginator = s3_client.get_paginator('list_object_versions')
-    else:
-        paginator = s3_client.get_paginator('list_objects_v2')  # 速度比 list_object_versions 快很多
-    try:
-        if S3Prefix == '/':
-            S3Prefix = ''
-        logger.info(f'Get s3 file list from: {bucket}/{S3Prefix}')
-        response_iterator = paginator.paginate(
+# List s3 pages of bucket/S3Prefix in key order, the same objects as paginator.paginate
+# ListConcurrency > 1: list key ranges (shards) page by page with StartAfter/KeyMarker and prefetch the next shards
+def list_s3_pages(*, s3_client, bucket, S3Prefix, list_method, ListConcurrency):
+    item_name = 'Versions' if list_method == 'list_object_versions' else 'Contents'
+    if ListConcurrency <= 1:
+        paginator = s3_client.get_paginator(list_method)
+        yield from paginator.paginate(
             Bucket=bucket,
             Prefix=S3Prefix
         )
-        for page in response_iterator:
-            if "Versions" in page:  # JobsenderCompareVersionId==True
-                logger.info(f'Got list_object_versions {bucket}/{S3Prefix}: {len(page["Versions"])}')
-                for n in page["Versions"]:
-                    # 只拿最新版本的列表
-                    if n["IsLatest"]:
-                        file_list.append({
-                            "Key": n["Key"],
-                            "Size": n["Size"],
-                            "versionId": n["VersionId"] if JobsenderCompareVersionId else 'null'
-                        })
-            elif "Contents" in page:  # JobsenderCompareVersionId==False
-                logger.info(f'Got list_objects_v2 {bucket}/{S3Prefix}: {len(page["Contents"])}')
-                for n in page["Contents"]:
-                    file_list.append({
+        return
+    versions = list_method == 'list_object_versions'
+    list_request = getattr(s3_client, list_method)
+
+    def start_marker(key):
+        return {'KeyMarker': key} if versions else {'StartAfter': key}
+
+    # 列出 shard (marker, end] 的一页，返回不超过 end 的对象，和下一页的 marker（shard 已列完则为 None）
+    def list_page(marker, end):
+        response = list_request(Bucket=bucket, Prefix=S3Prefix, **marker)
+        items = response.get(item_name, [])
+        if end is not None and items and items[-1]["Key"] > end:
+            return [n for n in items if n["Key"] <= end], None
+        if not response.get('IsTruncated'):
+            return items, None
+        if versions:
+            # 同一个Key的多个版本可能跨页，用 NextKeyMarker/NextVersionIdMarker 接着列
+            if end is not None and response['NextKeyMarker'] > end:
+                return items, None
+            return items, {'KeyMarker': response['NextKeyMarker'], 'VersionIdMarker': response['NextVersionIdMarker']}
+        if end is not None and items[-1]["Key"] >= end:
+            return items, None
+        return items, start_marker(items[-1]["Key"])
+
+    # 一个 shard 任务连续列出最多 List_shard_pages 页，刚好一页大小的 shard 不用再回到队列里排一次
+    def list_shard(marker, end):
+        pages = []
+        while marker is not None and len(pages) < List_shard_pages:
+            items, marker = list_page(marker, end)
+            pages.append(items)
+        return pages, marker
+
+    # shard 还没列完时，把 last_key 之后到 end 的剩余部分切分：从这一页Key开始不同的位置往前（浅）逐层，
+    # 取与 last_key 该位置字符同一类（数字、大写、小写字母）的更大字符作切分点。单词中间的字母（如 obj、data）
+    # 通常是固定的，跳过以免切出大量空区间。切分点按Key顺序，深层的区间小、浅层的大，大的区间列出第一段后再切分
+    def split_points(first_key, last_key, end):
+        depth = 0
+        while depth < min(len(first_key), len(last_key)) and first_key[depth] == last_key[depth]:
+            depth += 1
+        points = []
+        for k in range(min(depth, len(last_key) - 1), len(S3Prefix) - 1, -1):
+            char_class = next((chars for chars in List_split_chars if last_key[k] in chars), '')
+            if char_class and not char_class[0].isdigit() and k > 0 and last_key[k - 1].isalpha() and k != depth:
+                continue
+            for c in char_class[char_class.find(last_key[k]) + 1:]:
+                point = last_key[:k] + c
+                if end is not None and point >= end:
+                    return points
+                points.append(point)
+        return points
+
+    # 一个 shard 任务列完后，有剩余部分就切分成新的 shard 插在它后面
+    def expand(shard, index):
+        shard[3], next_marker = shard[2].result()
+        if next_marker is None:
+            return 0
+        points = []
+        if shard[3][0]:
+            last_key = next_marker.get('StartAfter', next_marker.get('KeyMarker'))
+            points = split_points(shard[3][0][0]["Key"], last_key, shard[1])
+        ends = points + [shard[1]]
+        new_shards = [[next_marker, ends[0], None, None]]
+        new_shards += [[start_marker(point), ends[i + 1], None, None] for i, point in enumerate(points)]
+        for i, new_shard in enumerate(new_shards):
+            shards.insert(index + 1 + i, new_shard)
+        return len(points)
+
+    # 按Key顺序排列的 shard 列表 [marker, end, future, pages]，前 ListConcurrency * 2 个 shard 提前列出，
+    # 列完一段的立即切分剩余部分，不等轮到它输出。内存中最多只有这些 shard 已列出的页，每页按顺序输出
+    window = ListConcurrency * 2
+    shard_count, request_count = 1, 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=ListConcurrency) as pool:
+        shards = deque([[{}, None, None, None]])
+        while shards:
+            pending = []
+            index = 0
+            while index < min(window, len(shards)):
+                shard = shards[index]
+                if shard[2] is None:
+                    shard[2] = pool.submit(list_shard, shard[0], shard[1])
+                if shard[3] is None and shard[2].done():
+                    shard_count += expand(shard, index)
+                    request_count += len(shard[3])
+                if shard[3] is None:
+                    pending.append(shard[2])
+                index += 1
+            if shards[0][3] is None:
+                concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                continue
+            for items in shards.popleft()[3]:
+                if items:
+                    yield {item_name: items}
+    logger.info(f'Listed {bucket}/{S3Prefix} in {shard_count} shards, {request_count} requests, '
+                f'concurrency {ListConcurrency}')
+
+
+# Compact file list of {"Key", "Size", "versionId"} entries, iterated, sorted and looked up like the list of dicts
+# Key 和 versionId 各自以 UTF-8 连续存放在一个 bytearray 中，用 offsets 定位，Size 在 array('q')，'null' 不占 versionId 空间
+# 每个对象约 Key 长度 + versionId 长度 + 24 字节，而 dict 列表每个对象要 300~400 字节以上
+# 按 Key 查找时才建开放寻址哈希索引 array，每个对象再加 8~16 字节，不需要排序
+class FileList:
+    def __init__(self, file_iter=()):
+        self.key_buffer = bytearray()
+        self.key_offsets = array('q', [0])
+        self.sizes = array('q')
+        self.version_buffer = bytearray()
+        self.version_offsets = array('q', [0])
+        self.index = None  # get() 用的哈希索引，列表变化后重建
+        self.extend(file_iter)
+
+    def append(self, file):
+        self.index = None
+        self.key_buffer += file["Key"].encode('utf-8')
+        self.key_offsets.append(len(self.key_buffer))
+        self.sizes.append(file["Size"])
+        if file["versionId"] != 'null':
+            self.version_buffer += file["versionId"].encode('utf-8')
+        self.version_offsets.append(len(self.version_buffer))
+
+    def extend(self, file_iter):
+        for file in file_iter:
+            self.append(file)
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def key_bytes(self, i):
+        return self.key_buffer[self.key_offsets[i]:self.key_offsets[i + 1]]
+
+    def version_id(self, i):
+        version = self.version_buffer[self.version_offsets[i]:self.version_offsets[i + 1]]
+        return version.decode('utf-8') if version else 'null'
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        return {
+            "Key": self.key_bytes(i).decode('utf-8'),
+            "Size": self.sizes[i],
+            "versionId": self.version_id(i)
+        }
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    # UTF-8 字节序与 S3 列表顺序一致，也与 Python 字符串按码位比较的顺序一致
+    def is_sorted(self):
+        return all(self.key_bytes(i) <= self.key_bytes(i + 1) for i in range(len(self) - 1))
+
+    # 按Key排序，重建连续存放的 Key/versionId 和 Size
+    def sort(self):
+        if self.is_sorted():
+            return
+        order = sorted(range(len(self)), key=self.key_bytes)
+
+        def reorder(buffer, offsets):
+            new_buffer, new_offsets = bytearray(), array('q', [0])
+            for i in order:
+                new_buffer += buffer[offsets[i]:offsets[i + 1]]
+                new_offsets.append(len(new_buffer))
+            return new_buffer, new_offsets
+
+        self.key_buffer, self.key_offsets = reorder(self.key_buffer, self.key_offsets)
+        self.version_buffer, self.version_offsets = reorder(self.version_buffer, self.version_offsets)
+        self.sizes = array('q', (self.sizes[i] for i in order))
+        self.index = None
+
+    # 槽数为对象数的 2~4 倍，槽里存对象序号+1，0 为空槽，冲突时线性探测。Key 重复时与 dict 一样保留最后一个
+    def build_index(self):
+        mask = (1 << (len(self) * 2).bit_length()) - 1
+        typecode = 'i' if len(self) < 2 ** 31 - 1 else 'q'
+        index = array(typecode, bytes(array(typecode).itemsize * (mask + 1)))
+        key_buffer, key_offsets = self.key_buffer, self.key_offsets
+        for i in range(len(self)):
+            key = bytes(key_buffer[key_offsets[i]:key_offsets[i + 1]])
+            slot = hash(key) & mask
+            while index[slot] and key_buffer[key_offsets[index[slot] - 1]:key_offsets[index[slot]]] != key:
+                slot = (slot + 1) & mask
+            index[slot] = i + 1
+        self.index = index
+
+    # 按 Key 查找，返回 (Size, versionId)，与 delta_job_list 的 dict 索引用法相同
+    def get(self, key, default=None):
+        if self.index is None:
+            self.build_index()
+        key = key.encode('utf-8')
+        index, mask = self.index, len(self.index) - 1
+        key_buffer, key_offsets = self.key_buffer, self.key_offsets
+        slot = hash(key) & mask
+        while index[slot]:
+            i = index[slot] - 1
+            if key_buffer[key_offsets[i]:key_offsets[i + 1]] == key:
+                return self.sizes[i], self.version_id(i)
+            slot = (slot + 1) & mask
+        return default
+
+
+# Local sqlite snapshot of a source bucket listing in the log directory, saved after the jobs of a run are all sent
+# 快照未超过 MaxAge 秒时仍完整列出源桶，按Key顺序与快照 merge-join，只有新增或 Size/versionId 改变的源对象参与对比，
+# 目的桶只列出这些对象所在的一级目录（或一级对象本身）。超过 MaxAge 或没有快照时完整对比两个桶并重建快照
+# 作为 Job 发送的Key在快照中记为待确认，之后每次都与目的桶对比，直到目的桶已有相同的对象，Worker 传输失败的会重新发送
+# 与快照相同的对象不再与目的桶对比：目的桶上被删除或覆盖的对象，要到超过 MaxAge 完整对比时才会发现
+class ListSnapshot:
+    def __init__(self, *, path, bucket, S3Prefix, MaxAge):
+        if S3Prefix == '/':
+            S3Prefix = ''
+        self.name = f'{bucket}/{S3Prefix}'
+        self.S3Prefix = S3Prefix
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS snapshots (name TEXT PRIMARY KEY, created REAL, gen INTEGER)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS objects (name TEXT, gen INTEGER, key TEXT, size INTEGER, '
+                        'versionId TEXT, PRIMARY KEY (name, gen, key)) WITHOUT ROWID')
+        row = self.db.execute('SELECT created, gen FROM snapshots WHERE name=?', (self.name,)).fetchone()
+        self.full = row is None or time.time() - row[0] >= MaxAge  # True: 完整对比
+        self.created = time.time() if self.full else row[0]
+        # 本次列表写入另一代，Job 全部发送后提交时才切换过去，上次没提交的一代先清空
+        self.gen = 0 if row is None else 1 - row[1]
+        self.old_gen = None if self.full else row[1]
+        self.db.execute('DELETE FROM objects WHERE name=? AND gen=?', (self.name, self.gen))
+        self.db.commit()
+        self.old_rows, self.old_pos, self.old_last = [], 0, ''
+        self.rows = []
+        self.pending = []  # 本次作为 Job 发送的Key
+        self.row_count = 0
+        self.changed_count = 0
+        self.units = []  # [一级目录或一级对象, 源对象数, 是否有变化]，只保留有变化的和当前的
+        self.list_units = None  # None: 目的桶完整列表
+        self.listed = False
+        if self.full:
+            logger.info(f'Full compare to refresh snapshot {self.name} in {path}')
+        else:
+            logger.info(f'Compare {self.name} with snapshot of {time.asctime(time.localtime(self.created))}')
+
+    # 快照中 key 的 (key, size, versionId)，没有则为 None。源对象按Key顺序传入，快照按批顺序读出
+    def old_row(self, key):
+        while self.old_gen is not None:
+            if self.old_pos == len(self.old_rows):
+                self.old_rows = self.db.execute(
+                    'SELECT key, size, versionId FROM objects WHERE name=? AND gen=? AND key>? ORDER BY key LIMIT ?',
+                    (self.name, self.old_gen, self.old_last, Snapshot_insert_batch)
+                ).fetchall()
+                self.old_pos = 0
+                if not self.old_rows:
+                    break
+                self.old_last = self.old_rows[-1][0]
+            old = self.old_rows[self.old_pos]
+            if old[0] > key:
+                break
+            self.old_pos += 1
+            if old[0] == key:
+                return old
+        return None
+
+    # 记录列出的源对象，返回它是否需要对比：完整对比时都需要，否则只有比快照新增或 Size/versionId 改变的
+    def diff(self, src):
+        key = src["Key"]
+        self.rows.append((self.name, self.gen, key, src["Size"], src["versionId"]))
+        if len(self.rows) >= Snapshot_insert_batch:
+            self.flush()
+        unit = key[:key.find('/', len(self.S3Prefix) + 1) + 1] or key
+        if not self.units or self.units[-1][0] != unit:
+            if self.units and not self.units[-1][2]:
+                self.units.pop()
+            self.units.append([unit, 0, False])
+        self.units[-1][1] += 1
+        if self.full:
+            return True
+        old = self.old_row(key)
+        if old is not None and old[1] == src["Size"] and old[2] == src["versionId"]:
+            return False
+        self.units[-1][2] = True
+        self.changed_count += 1
+        return True
+
+    # 本次作为 Job 发送的Key，在快照中的 Size 记为 -1，下次不会与快照相同。Job 的源对象都已经 diff 过
+    def add_job(self, key):
+        self.pending.append((self.name, self.gen, key))
+        if len(self.pending) >= Snapshot_insert_batch:
+            self.flush()
+
+    def flush(self):
+        self.db.executemany('INSERT INTO objects VALUES (?, ?, ?, ?, ?)', self.rows)
+        self.db.executemany('UPDATE objects SET size=-1 WHERE name=? AND gen=? AND key=?', self.pending)
+        self.db.commit()
+        self.row_count += len(self.rows)
+        self.rows = []
+        self.pending = []
+
+    # 源桶完整列出后调用。按有变化的一级目录中的源对象数估算目的桶的列表请求数，比完整列表少时才只列这些目录
+    def finish(self):
+        self.flush()
+        self.listed = True
+        if self.units and not self.units[-1][2]:
+            self.units.pop()
+        if self.full:
+            return
+        unit_requests = sum(count // 1000 + 1 for _, count, _ in self.units)
+        if unit_requests < self.row_count // 1000 + 1:
+            self.list_units = [unit for unit, _, _ in self.units]
+        logger.info(f'Snapshot diff {self.name}: {self.changed_count} of {self.row_count} objects changed in '
+                    f'{len(self.units)} first level prefixes, '
+                    f'{"list them" if self.list_units is not None else "list destination in full"}')
+
+    # Jobsender 发送完本次的 Job 后提交，all_sent: 全部消息都发送成功。列表不完整或有消息没发出时保留上次的快照，下次重新对比
+    def commit(self, *, all_sent):
+        if not self.listed:
+            logger.warning(f'Source listing of {self.name} is incomplete, keep the last snapshot')
+            return
+        if not all_sent:
+            logger.warning(f'Some jobs of {self.name} failed to send to SQS, keep the last snapshot')
+            return
+        self.flush()
+        self.db.execute('INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?)', (self.name, self.created, self.gen))
+        self.db.execute('DELETE FROM objects WHERE name=? AND gen=?', (self.name, 1 - self.gen))
+        self.db.commit()
+        logger.info(f'Saved snapshot {self.name}: {self.row_count} objects')
+
+
+# List pages of the objects under key_prefix + each ListSnapshot unit, in key order
+# 一级目录列出整个目录，一级对象只取Key完全相同的一个。各单元并发列出后按顺序输出
+def list_unit_pages(*, s3_client, bucket, units, key_prefix, ListConcurrency):
+    paginator = s3_client.get_paginator('list_objects_v2')
+
+    def list_unit(unit):
+        prefix = key_prefix + unit
+        if not unit.endswith('/'):
+            # 以 prefix 开头的Key中它自己排在最前，只取一个
+            items = s3_client.list_objects_v2(Bucket=bucket, Prefix=prefix, MaxKeys=1).get('Contents', [])
+            return [[n for n in items if n["Key"] == prefix]]
+        return [page["Contents"] for page in paginator.paginate(Bucket=bucket, Prefix=prefix) if "Contents" in page]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(ListConcurrency, 1)) as pool:
+        for pages in pool.map(list_unit, units):
+            for items in pages:
+                if items:
+                    yield {'Contents': items}
+
+
+# Iterate source S3 bucket file list with versionId, in key order
+# snapshot: 列出的对象都记录到 ListSnapshot，有未过期的快照时只输出比快照新增或改变的对象
+def iter_src_file_list(*, s3_client, bucket, S3Prefix, JobsenderCompareVersionId, ListConcurrency, snapshot):
+    if JobsenderCompareVersionId:
+        list_method = 'list_object_versions'
+    else:
+        list_method = 'list_objects_v2'  # 速度比 list_object_versions 快很多
+    if S3Prefix == '/':
+        S3Prefix = ''
+    logger.info(f'Get s3 file list from: {bucket}/{S3Prefix}')
+    response_iterator = list_s3_pages(
+        s3_client=s3_client,
+        bucket=bucket,
+        S3Prefix=S3Prefix,
+        list_method=list_method,
+        ListConcurrency=ListConcurrency
+    )
+    for page in response_iterator:
+        if "Versions" in page:  # JobsenderCompareVersionId==True
+            logger.info(f'Got list_object_versions {bucket}/{S3Prefix}: {len(page["Versions"])}')
+            for n in page["Versions"]:
+                # 只拿最新版本的列表
+                if n["IsLatest"]:
+                    src = {
                         "Key": n["Key"],
                         "Size": n["Size"],
-                        "versionId": 'null'
-                    })
+                        "versionId": n["VersionId"] if JobsenderCompareVersionId else 'null'
+                    }
+                    if snapshot is None or snapshot.diff(src):
+                        yield src
+        elif "Contents" in page:  # JobsenderCompareVersionId==False
+            logger.info(f'Got list_objects_v2 {bucket}/{S3Prefix}: {len(page["Contents"])}')
+            for n in page["Contents"]:
+                src = {
+                    "Key": n["Key"],
+                    "Size": n["Size"],
+                    "versionId": 'null'
+                }
+                if snapshot is None or snapshot.diff(src):
+                    yield src
+    if snapshot is not None:
+        snapshot.finish()
+
+
+# Get source S3 bucket file list with versionId
+def get_src_file_list(*, s3_client, bucket, S3Prefix, JobsenderCompareVersionId, ListConcurrency, snapshot):
+    # get s3 file list
+    file_list = FileList()
+    try:
+        for src in iter_src_file_list(
+                s3_client=s3_client,
+                bucket=bucket,
+                S3Prefix=S3Prefix,
+                JobsenderCompareVersionId=JobsenderCompareVersionId,
+                ListConcurrency=ListConcurrency,
+                snapshot=snapshot
+        ):
+            file_list.append(src)
     except Exception as err:
         logger.error(f'Fail to get s3 list versions {bucket}/{S3Prefix}: {str(err)}')
     logger.info(f'Bucket list length(get_src_file_list)：{str(len(file_list))}')
     return file_list
 
 
-# Get Destination S3 bucket file list with versionId from DDB
-def get_des_file_list(*, s3_client, bucket, S3Prefix, table, JobsenderCompareVersionId):
+# Iterate Destination S3 bucket file list with versionId from DDB, in key order
+# snapshot: 源桶列完后 ListSnapshot 有 list_units 时，只列出这些一级目录或一级对象
+def iter_des_file_list(*, s3_client, bucket, S3Prefix, table, JobsenderCompareVersionId, ListConcurrency,
+                       VersionIndexSegments, snapshot):
     if JobsenderCompareVersionId:
         ver_list = get_versionid_from_ddb(
             des_bucket=bucket,
-            table=table
+            table=table,
+            VersionIndexSegments=VersionIndexSegments
         )
     else:
         ver_list = {}
     # For delete prefix in des_prefix
     if S3Prefix == '' or S3Prefix == '/':
         # 目的bucket没有设置 Prefix
-        dp_len = 0
+        S3Prefix = ''
+    else:
+        # Worker 写入的目的Key是 str(PurePosixPath(des_prefix) / Src_key)，所以只列 "prefix/" 下的对象
+        # 否则 "prefix" 会匹配到 "prefix-other/..." 等不属于本任务的Key，去掉前缀后既对比不上，也打乱了Key的顺序
+        S3Prefix = str(PurePosixPath(S3Prefix)) + '/'
+    # 目的bucket的 "prefix/"长度
+    dp_len = len(S3Prefix)
+
+    logger.info(f'Get s3 file list from: {bucket}/{S3Prefix}')
+    if snapshot is not None and snapshot.list_units is not None:
+        response_iterator = list_unit_pages(
+            s3_client=s3_client,
+            bucket=bucket,
+            units=snapshot.list_units,
+            key_prefix=S3Prefix,
+            ListConcurrency=ListConcurrency
+        )
     else:
-        # 目的bucket的 "prefix/"长度
-        dp_len = len(S3Prefix) + 1
+        response_iterator = list_s3_pages(
+            s3_client=s3_client,
+            bucket=bucket,
+            S3Prefix=S3Prefix,
+            list_method='list_objects_v2',
+            ListConcurrency=ListConcurrency
+        )
+    for page in response_iterator:
+        if "Contents" in page:
+            logger.info(f'Got list_objects_v2 {bucket}/{S3Prefix}: {len(page["Contents"])}')
+            for n in page["Contents"]:
+                # 取这个key的versionId，如果是ver_list是空，则会全部都是None
+                ver = ver_list.get(n["Key"])
+                # 目的桶要去掉prefix
+                yield {
+                    "Key": n["Key"][dp_len:],
+                    "Size": n["Size"],
+                    "versionId": ver if (ver is not None and JobsenderCompareVersionId) else 'null'
+                }
+
 
+# Get Destination S3 bucket file list with versionId from DDB
+def get_des_file_list(*, s3_client, bucket, S3Prefix, table, JobsenderCompareVersionId, ListConcurrency,
+                      VersionIndexSegments, snapshot):
     # get s3 file list
-    file_list = []
-    paginator = s3_client.get_paginator('list_objects_v2')
+    file_list = FileList()
     try:
-        if S3Prefix == '/':
-            S3Prefix = ''
-        logger.info(f'Get s3 file list from: {bucket}/{S3Prefix}')
-        response_iterator = paginator.paginate(
-            Bucket=bucket,
-            Prefix=S3Prefix
-        )
-        for page in response_iterator:
-            if "Contents" in page:
-                logger.info(f'Got list_objects_v2 {bucket}/{S3Prefix}: {len(page["Contents"])}')
-                for n in page["Contents"]:
-                    # 取这个key的versionId，如果是ver_list是空，则会全部都是None
-                    ver = ver_list.get(n["Key"])
-                    # 目的桶要去掉prefix
-                    file_list.append({
-                        "Key": n["Key"][dp_len:],
-                        "Size": n["Size"],
-                        "versionId": ver if (ver is not None and JobsenderCompareVersionId) else 'null'
-                    })
+        for des in iter_des_file_list(
+                s3_client=s3_client,
+                bucket=bucket,
+                S3Prefix=S3Prefix,
+                table=table,
+                JobsenderCompareVersionId=JobsenderCompareVersionId,
+                ListConcurrency=ListConcurrency,
+                VersionIndexSegments=VersionIndexSegments,
+                snapshot=snapshot
+        ):
+            file_list.append(des)
     except Exception as err:
         logger.error(f'Fail to get s3 list_objects_v2 {bucket}/{S3Prefix}: {str(err)}')
     logger.info(f'Bucket list length(get_des_file_list)：{str(len(file_list))}')
     return file_list
 
 
-# Get s3 object versionId record in DDB
-def get_versionid_from_ddb(*, des_bucket, table):
+# Read S3 Inventory manifest.json from "s3://bucket/key" or a local path
+# 本地 manifest 的数据文件按文件名在 manifest 所在目录、其下的 data/、上一级的 data/ 中查找（与 aws s3 sync 下载的目录结构一致）
+def load_inventory_manifest(*, s3_client, manifest):
+    if manifest.startswith('s3://'):
+        inventory_bucket, manifest_key = manifest[len('s3://'):].split('/', 1)
+        body = s3_client.get_object(Bucket=inventory_bucket, Key=manifest_key)["Body"].read()
+        return json.loads(body), inventory_bucket, None
+    local_path = Path(manifest)
+    with open(local_path, 'rb') as f:
+        return json.load(f), None, local_path.parent
+
+
+def open_inventory_file(*, s3_client, inventory_bucket, local_dir, file_key):
+    if local_dir is None:
+        return s3_client.get_object(Bucket=inventory_bucket, Key=file_key)["Body"]
+    name = PurePosixPath(file_key).name
+    for local_path in [local_dir / name, local_dir / 'data' / name, local_dir.parent / 'data' / name]:
+        if local_path.exists():
+            return open(local_path, 'rb')
+    raise FileNotFoundError(f'Inventory data file {name} not found around {local_dir}')
+
+
+# Iterate (Key, Size, VersionId) of the latest, not deleted objects in an S3 Inventory report
+# CSV 用标准库 gzip/csv 逐行读取，Key 是 URL 编码的；ORC/Parquet 需要安装 pyarrow
+def iter_inventory_objects(*, s3_client, manifest):
+    manifest_json, inventory_bucket, local_dir = load_inventory_manifest(s3_client=s3_client, manifest=manifest)
+    file_format = manifest_json['fileFormat'].upper()
+    logger.info(f'Read inventory {manifest}: {file_format} of {manifest_json.get("sourceBucket")}, '
+                f'{len(manifest_json["files"])} data files')
+    if file_format != 'CSV':
+        try:
+            import pyarrow.orc
+            import pyarrow.parquet
+        except ImportError:
+            raise RuntimeError(f'Reading {file_format} inventory needs pyarrow: pip3 install pyarrow')
+    start_time = time.time()
+    row_count = 0
+    for inventory_file in manifest_json['files']:
+        data = open_inventory_file(
+            s3_client=s3_client,
+            inventory_bucket=inventory_bucket,
+            local_dir=local_dir,
+            file_key=inventory_file['key']
+        )
+        try:
+            # 列名统一成小写去掉下划线，CSV 的 VersionId 与 ORC/Parquet 的 version_id 对应
+            if file_format == 'CSV':
+                columns = [c.strip().replace('_', '').lower() for c in manifest_json['fileSchema'].split(',')]
+                rows = csv.reader(io.TextIOWrapper(gzip.GzipFile(fileobj=data), encoding='utf-8', newline=''))
+            else:
+                # pyarrow 需要可以 seek 的文件，S3 上的数据文件整个读入内存
+                buffer = io.BytesIO(data.read()) if local_dir is None else data
+                if file_format == 'ORC':
+                    table = pyarrow.orc.ORCFile(buffer).read()
+                else:
+                    table = pyarrow.parquet.read_table(buffer)
+                columns = [c.replace('_', '').lower() for c in table.column_names]
+                rows = (row for batch in table.to_batches()
+                        for row in zip(*(column.to_pylist() for column in batch.columns)))
+            key_i, size_i = columns.index('key'), columns.index('size')
+            ver_i, latest_i, delete_i = [columns.index(c) if c in columns else None
+                                         for c in ('versionid', 'islatest', 'isdeletemarker')]
+            for row in rows:
+                row_count += 1
+                if latest_i is not None and row[latest_i] in ('false', False):
+                    continue  # 旧版本
+                if delete_i is not None and row[delete_i] in ('true', True):
+                    continue  # 删除标记
+                key = row[key_i]
+                if file_format == 'CSV' and ('%' in key or '+' in key):
+                    key = urllib.parse.unquote_plus(key)
+                yield key, int(row[size_i]), (row[ver_i] if ver_i is not None else None) or 'null'
+        finally:
+            data.close()
+        spent_time = time.time() - start_time
+        logger.info(f'Read inventory file {inventory_file["key"]}: {row_count} rows in {spent_time:.1f} s, '
+                    f'{row_count / max(spent_time, 0.001):.0f} rows/s')
+    logger.info(f'Finish inventory {manifest}: {row_count} rows')
+
+
+# Iterate source S3 bucket file list from S3 Inventory, same entries as iter_src_file_list but not in key order
+def iter_src_inventory_list(*, s3_client, manifest, S3Prefix, JobsenderCompareVersionId):
+    if S3Prefix == '/':
+        S3Prefix = ''
+    for key, size, versionId in iter_inventory_objects(s3_client=s3_client, manifest=manifest):
+        if key.startswith(S3Prefix):
+            yield {
+                "Key": key,
+                "Size": size,
+                "versionId": versionId if JobsenderCompareVersionId else 'null'
+            }
+
+
+# Iterate Destination S3 bucket file list from S3 Inventory with versionId from DDB, not in key order
+def iter_des_inventory_list(*, s3_client, manifest, bucket, S3Prefix, table, JobsenderCompareVersionId,
+                            VersionIndexSegments):
+    if JobsenderCompareVersionId:
+        ver_list = get_versionid_from_ddb(
+            des_bucket=bucket,
+            table=table,
+            VersionIndexSegments=VersionIndexSegments
+        )
+    else:
+        ver_list = {}
+    # 与 iter_des_file_list 一样只取 "prefix/" 下的对象并去掉前缀
+    if S3Prefix == '' or S3Prefix == '/':
+        S3Prefix = ''
+    else:
+        S3Prefix = str(PurePosixPath(S3Prefix)) + '/'
+    dp_len = len(S3Prefix)
+    for key, size, _ in iter_inventory_objects(s3_client=s3_client, manifest=manifest):
+        if key.startswith(S3Prefix):
+            ver = ver_list.get(key)
+            yield {
+                "Key": key[dp_len:],
+                "Size": size,
+                "versionId": ver if (ver is not None and JobsenderCompareVersionId) else 'null'
+            }
+
+
+# Compact versionId map of the destination bucket, desKey/versionId packed in a FileList and looked up by its hash index
+# 千万级对象时比 dict 省内存：DDB 每页的记录直接存入 FileList，不保留每个对象的 str 和 dict 项，'null' 不占 versionId 空间
+class VersionIndex:
+    def __init__(self):
+        self.file_list = FileList()
+        self.lock = threading.Lock()  # 并行分段 Scan 时各段同时加入
+
+    def add_items(self, items):
+        with self.lock:
+            for i in items:
+                self.file_list.append({"Key": i['desKey'], "Size": 0, "versionId": i['versionId']})
+
+    def __len__(self):
+        return len(self.file_list)
+
+    # 同一个 desKey 有多条记录时取后加载的一条，与原来 dict 覆盖的结果一样
+    def get(self, key):
+        found = self.file_list.get(key)
+        return None if found is None else found[1]
+
+
+# Get s3 object versionId record in DDB, following LastEvaluatedKey until the last page
+# VersionIndexSegments > 1: scan desBucket-index in parallel segments instead of one paginated query
+def get_versionid_from_ddb(*, des_bucket, table, VersionIndexSegments):
     logger.info(f'Get des_bucket versionId list from DDB')
-    ver_list = {}
+    start_time = time.time()
+    ver_list = VersionIndex()
+
+    def load_pages(request, **kwargs):
+        while True:
+            r = request(
+                IndexName='desBucket-index',
+                ExpressionAttributeValues={":b": des_bucket},
+                ProjectionExpression='desKey, versionId',
+                **kwargs
+            )
+            ver_list.add_items(r.get('Items', []))
+            if 'LastEvaluatedKey' not in r:
+                return
+            kwargs['ExclusiveStartKey'] = r['LastEvaluatedKey']
+
     try:
-        r = table.query(
-            IndexName='desBucket-index',
-            KeyConditionExpression='desBucket=:b',
-            ExpressionAttributeValues={":b": des_bucket}
-        )
-        if 'Items' in r:
-            for i in r['Items']:
-                ver_list[i['desKey']] = i['versionId']
-        logger.info(f'Got versionId list {des_bucket}: {len(ver_list)}')
+        if VersionIndexSegments > 1:
+            # Scan 整个 index 会读到其他目的桶的记录，按 desBucket 过滤，消耗的 RCU 比 Query 多
+            with concurrent.futures.ThreadPoolExecutor(max_workers=VersionIndexSegments) as pool:
+                segments = [pool.submit(load_pages, table.scan, FilterExpression='desBucket=:b',
+                                        Segment=n, TotalSegments=VersionIndexSegments)
+                            for n in range(VersionIndexSegments)]
+                for f in segments:
+                    f.result()
+        else:
+            load_pages(table.query, KeyConditionExpression='desBucket=:b')
     except Exception as e:
         logger.error(f'Fail to query DDB for versionId {des_bucket}- {str(e)}')
+        ver_list = VersionIndex()
+    ver_list.file_list.build_index()
+    logger.info(f'Got versionId list {des_bucket}: {len(ver_list)}, loaded in {time.time() - start_time:.1f} s')
     return ver_list
 
 
-# Jobsender compare source and destination bucket list
-def delta_job_list(*, src_file_list, des_file_list, src_bucket, src_prefix, des_bucket, des_prefix, ignore_list,
-                   JobsenderCompareVersionId):
-    # Delta list，只对比key&size，version不做对比，只用来发Job
-    logger.info(f'Compare source s3://{src_bucket}/{src_prefix} and destination s3://{des_bucket}/{des_prefix}')
-    start_time = int(time.time())
-    job_list = []
-    ignore_records = []
-    for src in src_file_list:
+# Compile ignore_list into one matcher function, same result as fnmatchcase against each pattern
+def compile_ignore_list(ignore_list):
+    exact_set = set()
+    prefix_list = []  # 'bucket/prefix/*' 类型
+    suffix_list = []  # '*.tmp' 类型，反转后按前缀处理
+    regex_list = []  # 其他通配符，合并成一个正则
+    for ignore_key in ignore_list:
+        if ignore_key == '':
+            continue  # 空行不会匹配任何 bucket/key
+        magic = [i for i, c in enumerate(ignore_key) if c in '*?[']
+        if not magic:
+            exact_set.add(ignore_key)
+        elif magic == [len(ignore_key) - 1] and ignore_key[-1] == '*':
+            prefix_list.append(ignore_key[:-1])
+        elif magic == [0] and ignore_key[0] == '*':
+            suffix_list.append(ignore_key[1:][::-1])
+        else:
+            regex_list.append(translate(ignore_key))
+
+    # 有序前缀表：去掉被更短前缀覆盖的项后，二分查找最后一个 <= key 的前缀即可判断
+    def prefix_table(prefixes):
+        table = []
+        for p in sorted(set(prefixes)):
+            if not table or not p.startswith(table[-1]):
+                table.append(p)
+        return table
+
+    prefix_table_list = prefix_table(prefix_list)
+    suffix_table_list = prefix_table(suffix_list)
+    combined_regex = re.compile('|'.join(regex_list)) if regex_list else None
+
+    def in_table(table, key):
+        i = bisect_right(table, key)
+        return i > 0 and key.startswith(table[i - 1])
+
+    def ignore_match(bucket_key):
+        if bucket_key in exact_set:
+            return True
+        if prefix_table_list and in_table(prefix_table_list, bucket_key):
+            return True
+        if suffix_table_list and in_table(suffix_table_list, bucket_key[::-1]):
+            return True
+        if combined_regex is not None and combined_regex.match(bucket_key):
+            return True
+        return False
+
+    logger.info(f'Compiled ignore list: {len(exact_set)} exact, {len(prefix_table_list)} prefix, '
+                f'{len(suffix_table_list)} suffix, {len(regex_list)} wildcard patterns')
+    return ignore_match
+
+
+# Construct one SQS job from source file list entry
+def new_job(*, src, src_bucket, des_bucket, des_prefix):
+    Des_key = str(PurePosixPath(des_prefix) / src["Key"])
+    if src["Key"][-1] == '/':  # 源Key是个目录的情况，需要额外加 /
+        Des_key += '/'
+    return {
+        "Src_bucket": src_bucket,
+        "Src_key": src["Key"],  # Src_key已经包含了Prefix
+        "Des_bucket": des_bucket,
+        "Des_key": Des_key,
+        "Size": src["Size"],
+        "versionId": src['versionId']
+    }
+
+
+# Check the file list is sorted by key, as list_objects_v2 returns
+def is_sorted_by_key(file_list):
+    if isinstance(file_list, FileList):
+        return file_list.is_sorted()
+    return all(a["Key"] <= b["Key"] for a, b in zip(file_list, islice(file_list, 1, None)))
+
+
+# Merge-join source and destination file iterators sorted by key, yield jobs of source files not in destination
+# Only the current source/destination entries are held in memory
+def merge_join_jobs(*, src_file_iter, des_file_iter, src_bucket, des_bucket, des_prefix, ignore_match,
+                    ignore_records):
+    des_file_iter = iter(des_file_iter)
+    des = next(des_file_iter, None)
+    last_src_key, last_des_key = '', ''
+    order_warned = False
+    for src in src_file_iter:
+        # 列表顺序不对只会多发Job（匹配不到），不会漏掉文件，所以只告警
+        if src["Key"] < last_src_key and not order_warned:
+            logger.warning(f'Source list is not sorted by key: {src["Key"]} after {last_src_key}')
+            order_warned = True
+        last_src_key = src["Key"]
 
         # 排除掉 ignore_list 里面列的 bucket/key
         src_bucket_key = src_bucket + '/' + src['Key']
-        ignore_match = False
-        # 每个 ignore key 匹配一次，匹配上任何一个就跳过这个scr_key
-        for ignore_key in ignore_list:
-            if fnmatchcase(src_bucket_key, ignore_key):
-                ignore_match = True
-                break
-            # 匹配不上，循环下一个 ignore_key
-        if ignore_match:
+        if ignore_match(src_bucket_key):
+            ignore_records.append(src_bucket_key)
+            continue
+
+        # 目的列表前进到不小于源Key的位置
+        while des is not None and des["Key"] < src["Key"]:
+            last_des_key = des["Key"]
+            des = next(des_file_iter, None)
+            if des is not None and des["Key"] < last_des_key and not order_warned:
+                logger.warning(f'Destination list is not sorted by key: {des["Key"]} after {last_des_key}')
+                order_warned = True
+        # 比对源文件是否在目标中，会连带versionId一起比较
+        if des is not None and des["Key"] == src["Key"] \
+                and des["Size"] == src["Size"] and des["versionId"] == src["versionId"]:
+            continue
+        yield new_job(
+            src=src,
+            src_bucket=src_bucket,
+            des_bucket=des_bucket,
+            des_prefix=des_prefix
+        )
+
+
+# Look up each source file in the destination index {Key: (Size, versionId)}, yield jobs of files not in destination
+# Source file list can be in any order
+def hash_join_jobs(*, src_file_iter, des_index, src_bucket, des_bucket, des_prefix, ignore_match, ignore_records):
+    for src in src_file_iter:
+
+        # 排除掉 ignore_list 里面列的 bucket/key
+        src_bucket_key = src_bucket + '/' + src['Key']
+        # ignore_list 已预编译，匹配上任何一个 ignore key 就跳过这个scr_key
+        if ignore_match(src_bucket_key):
             ignore_records.append(src_bucket_key)
             continue  # 跳过当前 src
 
         # 比对源文件是否在目标中，会连带versionId一起比较
-        if src in des_file_list:
+        if des_index.get(src["Key"]) == (src["Size"], src["versionId"]):
             continue  # 在List中，下一个源文件
         # 不在List中，把源文件加入job list
+        yield new_job(
+            src=src,
+            src_bucket=src_bucket,
+            des_bucket=des_bucket,
+            des_prefix=des_prefix
+        )
+
+
+# Jobsender compare source and destination bucket list
+def delta_job_list(*, src_file_list, des_file_list, src_bucket, src_prefix, des_bucket, des_prefix, ignore_list,
+                   JobsenderCompareVersionId):
+    # Delta list，只对比key&size，version不做对比，只用来发Job
+    logger.info(f'Compare source s3://{src_bucket}/{src_prefix} and destination s3://{des_bucket}/{des_prefix}')
+    start_time = int(time.time())
+    job_list = []
+    ignore_records = []
+    ignore_match = compile_ignore_list(ignore_list)
+    if is_sorted_by_key(src_file_list) and is_sorted_by_key(des_file_list):
+        # 两个列表都是 list_objects_v2 返回的按Key排序，直接 merge-join 对比，O(N+M) 并且不需要额外内存
+        logger.info('Source and destination lists are sorted by key, compare with merge-join')
+        job_list.extend(merge_join_jobs(
+            src_file_iter=src_file_list,
+            des_file_iter=des_file_list,
+            src_bucket=src_bucket,
+            des_bucket=des_bucket,
+            des_prefix=des_prefix,
+            ignore_match=ignore_match,
+            ignore_records=ignore_records
+        ))
+    else:
+        # 目的桶列表只建一次 Key->(Size, versionId) 索引，源列表逐个查索引，对比复杂度 O(N+M)
+        # FileList 自带紧凑的哈希索引，不用另外建 dict 索引，也不改变调用者列表的顺序
+        if isinstance(des_file_list, FileList):
+            des_file_list.build_index()
+            des_index = des_file_list
         else:
-            Des_key = str(PurePosixPath(des_prefix) / src["Key"])
-            if src["Key"][-1] == '/':  # 源Key是个目录的情况，需要额外加 /
-                Des_key += '/'
-            job_list.append(
-                {
-                    "Src_bucket": src_bucket,
-                    "Src_key": src["Key"],  # Src_key已经包含了Prefix
-                    "Des_bucket": des_bucket,
-                    "Des_key": Des_key,
-                    "Size": src["Size"],
-                    "versionId": src['versionId']
-                }
-            )
+            des_index = {des["Key"]: (des["Size"], des["versionId"]) for des in des_file_list}
+        logger.info(f'Built destination index: {len(des_index)} keys in {int(time.time()) - start_time} Seconds')
+        job_list.extend(hash_join_jobs(
+            src_file_iter=src_file_list,
+            des_index=des_index,
+            src_bucket=src_bucket,
+            des_bucket=des_bucket,
+            des_prefix=des_prefix,
+            ignore_match=ignore_match,
+            ignore_records=ignore_records
+        ))
     spent_time = int(time.time()) - start_time
     if JobsenderCompareVersionId:
         logger.info(f'Finish compare key/size/versionId in {spent_time} Seconds (JobsenderCompareVersionId is enable)')
@@ -293,31 +1022,176 @@ def delta_job_list(*, src_file_list, des_file_list, src_bucket, src_prefix, des_
     return job_list, ignore_records
 
 
-def job_upload_sqs_ddb(*, sqs, sqs_queue, job_list):
-    sqs_batch = 0
-    sqs_message = []
-    logger.info(f'Start uploading jobs to queue: {sqs_queue}')
+# Streaming compare: merge-join source and destination file iterators, both sorted by key, and yield jobs
+def stream_delta_job_list(*, src_file_iter, des_file_iter, src_bucket, src_prefix, des_bucket, des_prefix,
+                          ignore_list, ignore_records, JobsenderCompareVersionId):
+    logger.info(f'Stream compare source s3://{src_bucket}/{src_prefix} and destination s3://{des_bucket}/{des_prefix}')
+    start_time = int(time.time())
+    job_count = 0
+    for job in merge_join_jobs(
+            src_file_iter=src_file_iter,
+            des_file_iter=des_file_iter,
+            src_bucket=src_bucket,
+            des_bucket=des_bucket,
+            des_prefix=des_prefix,
+            ignore_match=compile_ignore_list(ignore_list),
+            ignore_records=ignore_records
+    ):
+        job_count += 1
+        yield job
+    spent_time = int(time.time()) - start_time
+    if JobsenderCompareVersionId:
+        logger.info(f'Finish stream compare key/size/versionId in {spent_time} Seconds '
+                    f'(JobsenderCompareVersionId is enable)')
+    else:
+        logger.info(f'Finish stream compare key/size in {spent_time} Seconds (JobsenderCompareVersionId is disable)')
+    logger.info(f'Delta Job List: {job_count} - Ignore List: {len(ignore_records)}')
+
+
+# Streaming compare of file iterators not in key order, e.g. from S3 Inventory
+# 目的列表在内存中建 Key->(Size, versionId) 索引，源列表逐条流过索引对比并输出 Job，不在内存中保存源列表和 Job 列表
+def stream_index_delta_job_list(*, src_file_iter, des_file_iter, src_bucket, src_prefix, des_bucket, des_prefix,
+                                ignore_list, ignore_records, JobsenderCompareVersionId):
+    logger.info(f'Stream compare source s3://{src_bucket}/{src_prefix} and destination s3://{des_bucket}/{des_prefix} '
+                f'with destination index')
+    start_time = time.time()
+    des_index = FileList(des_file_iter)
+    des_index.build_index()
+    logger.info(f'Built destination index: {len(des_index)} keys in {int(time.time() - start_time)} Seconds')
+    job_count = 0
+    for job in hash_join_jobs(
+            src_file_iter=src_file_iter,
+            des_index=des_index,
+            src_bucket=src_bucket,
+            des_bucket=des_bucket,
+            des_prefix=des_prefix,
+            ignore_match=compile_ignore_list(ignore_list),
+            ignore_records=ignore_records
+    ):
+        job_count += 1
+        yield job
+    spent_time = int(time.time() - start_time)
+    if JobsenderCompareVersionId:
+        logger.info(f'Finish stream compare key/size/versionId in {spent_time} Seconds '
+                    f'(JobsenderCompareVersionId is enable)')
+    else:
+        logger.info(f'Finish stream compare key/size in {spent_time} Seconds (JobsenderCompareVersionId is disable)')
+    logger.info(f'Delta Job List: {job_count} - Ignore List: {len(ignore_records)}')
+
+
+# Send jobs to sqs in batch of 10 on a thread pool, job_list can be a list or a job generator
+# send_pool: 多个桶对共用的发送线程池，None 时自己建一个 SqsSendConcurrency 线程的池
+# 返回 (提交发送的消息数, 发送成功的消息数)，超过重试次数或 SenderFault 丢弃的消息使两者不相等
+def job_upload_sqs_ddb(*, sqs, sqs_queue, job_list, SqsSendConcurrency, MaxRetry, send_pool):
+    logger.info(f'Start uploading jobs to queue: {sqs_queue}, concurrency: {SqsSendConcurrency}')
+    start_time = time.time()
+    submit_count = 0
+    sent_count = [0]
+    count_lock = threading.Lock()
+    # 限制在途的 batch 数量，job_list 是生成器时不会一次性把所有消息都堆到线程池队列里
+    in_flight = threading.BoundedSemaphore(SqsSendConcurrency * 2)
+
+    def send_batch(sqs_message):
+        try:
+            sent = send_sqs_batch(sqs=sqs, sqs_queue=sqs_queue, sqs_message=sqs_message, MaxRetry=MaxRetry)
+            with count_lock:
+                sent_count[0] += sent
+        finally:
+            in_flight.release()
+
+    pool = send_pool or concurrent.futures.ThreadPoolExecutor(max_workers=SqsSendConcurrency)
     # create ddb writer
     # with table.batch_writer() as ddb_batch:
+    try:
+        sqs_message = []
+        batch_bytes = 0
+        for job in job_list:
+            MessageBody = json.dumps(job)
+            # write to sqs in batch 10, and the batch total size should not exceed 256KB
+            if sqs_message and batch_bytes + len(MessageBody) > Max_sqs_message_bytes:
+                in_flight.acquire()
+                pool.submit(send_batch, sqs_message)
+                submit_count += len(sqs_message)
+                sqs_message, batch_bytes = [], 0
+            # construct sqs messages
+            sqs_message.append({
+                "Id": str(len(sqs_message)),
+                "MessageBody": MessageBody,
+            })
+            batch_bytes += len(MessageBody)
+
+            if len(sqs_message) == 10:
+                in_flight.acquire()
+                pool.submit(send_batch, sqs_message)
+                submit_count += len(sqs_message)
+                sqs_message, batch_bytes = [], 0
+        # the last batch
+        if sqs_message:
+            in_flight.acquire()
+            pool.submit(send_batch, sqs_message)
+            submit_count += len(sqs_message)
+    finally:
+        # 共用线程池不能 shutdown，取回全部在途名额即等到本次提交的 batch 都发送完
+        for _ in range(SqsSendConcurrency * 2):
+            in_flight.acquire()
+        if send_pool is None:
+            pool.shutdown()
+
+    spent_time = time.time() - start_time
+    logger.info(f'Complete upload {sent_count[0]} messages to queue: {sqs_queue} in {int(spent_time)} Seconds, '
+                f'throughput: {sent_count[0] / max(spent_time, 0.001):.0f} messages/s')
+    if sent_count[0] != submit_count:
+        logger.error(f'Fail to send {submit_count - sent_count[0]} of {submit_count} messages to queue: {sqs_queue}')
+    return submit_count, sent_count[0]
+
+
+# Pack small file jobs into one SQS message {"Jobs": [job, ...]}, big file jobs are still one job per message
+def pack_small_jobs(*, job_list, ResumableThreshold, JobsPerMessage):
+    pack, pack_bytes = [], 0
+    pack_count = 0
     for job in job_list:
-        # construct sqs messages
-        sqs_message.append({
-            "Id": str(sqs_batch),
-            "MessageBody": json.dumps(job),
-        })
-        sqs_batch += 1
-
-        # write to sqs in batch 10 or is last one
-        if sqs_batch == 10 or job == job_list[-1]:
-            try:
-                sqs.send_message_batch(QueueUrl=sqs_queue, Entries=sqs_message)
-            except Exception as e:
-                logger.error(f'Fail to send sqs message: {str(sqs_message)}, {str(e)}')
-            sqs_batch = 0
-            sqs_message = []
-
-    logger.info(f'Complete upload job to queue: {sqs_queue}')
-    return
+        if job['Size'] > ResumableThreshold or JobsPerMessage <= 1:
+            yield job
+            continue
+        job_bytes = len(json.dumps(job)) + 2  # json list 的 ", " 分隔符
+        # 预留 1KB 给消息外层结构
+        if pack and (len(pack) >= JobsPerMessage or pack_bytes + job_bytes > Max_sqs_message_bytes - 1024):
+            pack_count += 1
+            yield {"Jobs": pack}
+            pack, pack_bytes = [], 0
+        pack.append(job)
+        pack_bytes += job_bytes
+    if pack:
+        pack_count += 1
+        yield {"Jobs": pack}
+    logger.info(f'Packed small file jobs into {pack_count} messages')
+
+
+# Send one sqs batch, retry only the failed entries, return the number of messages sent
+def send_sqs_batch(*, sqs, sqs_queue, sqs_message, MaxRetry):
+    sent = 0
+    for retryTime in range(MaxRetry + 1):
+        try:
+            response = sqs.send_message_batch(QueueUrl=sqs_queue, Entries=sqs_message)
+        except Exception as e:
+            logger.warning(f'Fail to send sqs message batch, Attempts: {retryTime} - {str(e)}')
+        else:
+            sent += len(response.get('Successful', []))
+            retry_id = []
+            for f in response.get('Failed', []):
+                if f.get('SenderFault'):
+                    # 消息本身的问题，重试也没用
+                    logger.error(f'Fail to send sqs message {f["Id"]}: {f.get("Code")} {f.get("Message")}')
+                else:
+                    retry_id.append(f['Id'])
+            if not retry_id:
+                return sent
+            sqs_message = [m for m in sqs_message if m['Id'] in retry_id]
+            logger.warning(f'Fail to send {len(sqs_message)} sqs messages in batch, Attempts: {retryTime}')
+        if retryTime < MaxRetry:
+            time.sleep(min(5 * (retryTime + 1), 30))
+    logger.error(f'Fail to send sqs message for Max retries: {str(sqs_message)}')
+    return sent
 
 
 # Split one file size into list of start byte position list
@@ -396,8 +1270,10 @@ def check_file_exist(*, prefix_and_key, UploadIdList):
 
 
 # Check uploaded part number list on Des_bucket
+# 返回已上传的 {PartNumber: ETag} 和 {PartNumber: Size}，续传时 ETag 直接用于合并文件，Size 用于核对分片大小
 def checkPartnumberList(*, Des_bucket, Des_key, uploadId, s3_des_client):
-    partnumberList = []
+    partnumberList = {}
+    part_sizes = {}
     logger.info(f'Get partnumber list - {Des_bucket}/{Des_key}')
     paginator = s3_des_client.get_paginator('list_parts')
     try:
@@ -410,45 +1286,616 @@ def checkPartnumberList(*, Des_bucket, Des_key, uploadId, s3_des_client):
             if "Parts" in page:
                 logger.info(f'Got list_parts: {len(page["Parts"])} - {Des_bucket}/{Des_key}')
                 for p in page["Parts"]:
-                    partnumberList.append(p["PartNumber"])
+                    partnumberList[p["PartNumber"]] = p["ETag"]
+                    part_sizes[p["PartNumber"]] = p["Size"]
     except Exception as e:
         logger.error(f'Fail to list parts in checkPartnumberList - {Des_bucket}/{Des_key} - {str(e)}')
-        return []
+        return {}, {}
 
     if partnumberList:  # 如果空则表示没有查到已上传的Part
-        logger.info(f"Found uploaded partnumber {len(partnumberList)} - {json.dumps(partnumberList)}"
+        logger.info(f"Found uploaded partnumber {len(partnumberList)} - {json.dumps(list(partnumberList))}"
                     f" - {Des_bucket}/{Des_key}")
     else:
         logger.info(f'Part number list is empty - {Des_bucket}/{Des_key}')
-    return partnumberList
+    return partnumberList, part_sizes
+
+
+# Chunk size to resume a multipart upload with, the first candidate that matches the sizes of all uploaded parts
+# 除最后一个分片外每个分片都是 ChunkSize 大，已上传的有第 1 个分片或至少两个分片时，其中最大的就是当时的分片大小，
+# 其次才用 DDB 记录的分片大小和配置的 ChunkSize。都对不上返回 0，不能续传，否则合并出的文件内容会错位
+def resume_chunk_size(*, Size, part_sizes, ChunkSize_ddb, ChunkSize):
+    candidates = [ChunkSize_ddb, ChunkSize]
+    if 1 in part_sizes or len(part_sizes) >= 2:
+        candidates.insert(0, max(part_sizes.values()))
+    for candidate in candidates:
+        if not candidate:
+            continue
+        indexList, ChunkSize_auto = split(Size, candidate)
+        if all(n <= len(indexList) and size == min(ChunkSize_auto, Size - indexList[n - 1])
+               for n, size in part_sizes.items()):
+            return candidate
+    return 0
+
+
+# Byte-budgeted pool of reusable part buffers, shared by all job_processor on a worker
+# 正在使用和空闲缓存的缓冲区总大小不超过 MaxMemory，超出时新的分片下载要等其他分片归还缓冲区（由 PartExecutor 先运行其他分片）
+# 大于 SpoolThreshold 的分片不占用内存预算，下载到临时文件再从文件上传（SpoolThreshold 为 0 则都用内存）
+class BufferPool:
+    def __init__(self, MaxMemory, SpoolThreshold=0):
+        self.MaxMemory = MaxMemory
+        self.SpoolThreshold = SpoolThreshold
+        self.used = 0  # 正在使用的缓冲区大小
+        self.cached = 0  # 空闲缓存的缓冲区大小
+        self.free_buffers = {}  # size: [bytearray]
+        self.lock = threading.Lock()
+
+    # 预算不够时不阻塞，返回 None
+    def try_acquire(self, size):
+        with self.lock:
+            # 单个分片大于整个预算时，等到没有其他分片在用时独占，避免永远等待
+            if self.used and self.used + size > self.MaxMemory:
+                return None
+            self.used += size
+            if self.free_buffers.get(size):
+                self.cached -= size
+                return self.free_buffers[size].pop()
+            # 丢弃其他大小的空闲缓冲区，腾出预算
+            for buffer_size, buffers in self.free_buffers.items():
+                while buffers and self.used + self.cached > self.MaxMemory:
+                    buffers.pop()
+                    self.cached -= buffer_size
+        return bytearray(size)
+
+    def release(self, buffer):
+        with self.lock:
+            self.used -= len(buffer)
+            if self.used + self.cached + len(buffer) <= self.MaxMemory:
+                self.free_buffers.setdefault(len(buffer), []).append(buffer)
+                self.cached += len(buffer)
+
+    def spool(self, size):
+        return bool(self.SpoolThreshold) and size > self.SpoolThreshold
+
+
+# Part buffer request yielded by a part task to PartExecutor, the task resumes with buffer set
+class BufferRequest:
+    def __init__(self, buffer_pool, size):
+        self.buffer_pool = buffer_pool
+        self.size = size
+        self.buffer = None
+
+    def try_acquire(self):
+        self.buffer = self.buffer_pool.try_acquire(self.size)
+        return self.buffer is not None
+
+
+# Worker-wide adaptive part size, from the measured per-part throughput of each direction
+class AdaptiveController:
+    def __init__(self, MaxChunkSize):
+        self.MaxChunkSize = MaxChunkSize
+        self.throughput = {}  # direction: 单个连接传输一个分片的速度 Bytes/s 的滑动平均
+        self.lock = threading.Lock()
+
+    def record(self, direction, size, seconds):
+        speed = size / max(seconds, 0.001)
+        with self.lock:
+            last = self.throughput.get(direction)
+            self.throughput[direction] = speed if last is None else last * 0.8 + speed * 0.2
+
+    # 按较慢方向的速度选分片大小，不超过 MaxChunkSize，分片数不少于 MaxThread 以用满并发，不小于配置的 ChunkSize
+    def chunk_size(self, *, Size, ChunkSize, MaxThread):
+        with self.lock:
+            if not self.throughput:
+                return ChunkSize
+            speed = min(self.throughput.values())
+        chunk = min(int(speed * Part_target_seconds), self.MaxChunkSize, Size // max(MaxThread, 1))
+        chunk = chunk // (1024 * 1024) * 1024 * 1024
+        return max(chunk, ChunkSize)
+
+
+# Concurrency limit of one direction for one file, tuned by measured throughput and errors if adaptive is set
+# 从 Adaptive_start_threads 开始慢启动，每个窗口的总吞吐有提升就加倍，之后每次加 1 试探，没有提升或吞吐明显下降就减 1，出错减半
+class ConcurrencyLimiter:
+    def __init__(self, *, MaxLimit, adaptive, direction):
+        self.MaxLimit = MaxLimit
+        self.adaptive = adaptive
+        self.direction = direction
+        self.limit = MaxLimit if adaptive is None else min(Adaptive_start_threads, MaxLimit)
+        self.active = 0
+        self.lock = threading.Lock()
+        self.slow_start = True
+        self.probing = False  # 上一个窗口是否加了线程
+        self.best = 0  # 窗口总吞吐的基准
+        self.new_window()
+
+    def new_window(self):
+        self.window_bytes, self.window_parts, self.window_start = 0, 0, time.time()
+
+    # 名额已满时不阻塞，返回 False
+    def try_acquire(self):
+        with self.lock:
+            if self.active >= self.limit:
+                return False
+            self.active += 1
+            return True
+
+    def release(self):
+        with self.lock:
+            self.active -= 1
+
+    def available(self):
+        with self.lock:
+            return self.active < self.limit
+
+    def record(self, size, seconds):
+        if self.adaptive is None:
+            return
+        self.adaptive.record(self.direction, size, seconds)
+        with self.lock:
+            self.window_bytes += size
+            self.window_parts += 1
+            if self.window_parts < self.limit:
+                return
+            throughput = self.window_bytes / max(time.time() - self.window_start, 0.001)
+            if throughput > self.best * 1.05:
+                self.best = throughput
+                new_limit = min(self.limit * 2 if self.slow_start else self.limit + 1, self.MaxLimit)
+                self.probing = new_limit > self.limit
+                self.limit = new_limit
+            else:
+                self.slow_start = False
+                if self.probing or throughput < self.best * 0.8:
+                    self.limit = max(self.limit - 1, 1)  # 加线程没有提升吞吐，退回
+                self.probing = False
+                self.best *= 0.95  # 基准慢慢降低，之后会再试探加线程
+            logger.debug(f'Adaptive {self.direction} threads: {self.limit}, throughput: {int(throughput)} Bytes/s')
+            self.new_window()
+
+    def record_error(self):
+        if self.adaptive is None:
+            return
+        with self.lock:
+            self.limit = max(self.limit // 2, 1)
+            self.slow_start = False
+            self.probing = False
+            self.best = 0
+            self.new_window()
+        logger.info(f'Adaptive {self.direction} threads reduced to {self.limit} for error')
+
+
+# Token bucket of one budget, rate can change on every acquire (schedule, number of workers)
+# 最多攒 1 秒的令牌。一次可以取超过剩余令牌的数量（如一个大分片），欠下的令牌由之后的请求排队等待补足
+class TokenBucket:
+    def __init__(self):
+        self.tokens = 0
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, n, rate):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.tokens + (now - self.last) * rate, rate)
+            self.last = now
+            wait = -self.tokens / rate if self.tokens < 0 else 0
+            self.tokens -= n
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+# Parse RateLimitSchedule: "HH:MM-HH:MM*factor, ..." to [(start_minute, end_minute, factor)]
+# 时段可以跨过零点，如 "18:00-09:00"，倍数省略为 1
+def parse_rate_schedule(Schedule):
+    schedule = []
+    for window in Schedule.split(','):
+        window = window.strip()
+        if not window:
+            continue
+        period, _, factor = window.partition('*')
+        minutes = []
+        for hh_mm in period.split('-'):
+            hour, minute = hh_mm.strip().split(':')
+            minutes.append(int(hour) * 60 + int(minute))
+        if len(minutes) != 2:
+            raise ValueError(f'Wrong RateLimitSchedule window: {window}')
+        schedule.append((minutes[0], minutes[1], float(factor) if factor else 1))
+    return schedule
+
+
+# Worker-wide rate limit of Bytes/s and requests/s, for source and destination separately, 0 means no limit
+# 所有文件的分片线程和小文件共用。schedule 为空则一直限速，否则只在列出的时段内限速，并把限速乘以该时段的倍数
+# 设置了 table 则各 worker 在 DDB 登记心跳，按存活的 worker 数平分整个集群的限速
+class RateLimiter:
+    def __init__(self, *, SrcMaxBandwidth, SrcMaxRequestRate, DesMaxBandwidth, DesMaxRequestRate, schedule,
+                 table, instance_id):
+        self.rates = {('src', 'bytes'): SrcMaxBandwidth, ('src', 'requests'): SrcMaxRequestRate,
+                      ('des', 'bytes'): DesMaxBandwidth, ('des', 'requests'): DesMaxRequestRate}
+        self.buckets = {budget: TokenBucket() for budget in self.rates}
+        self.schedule = schedule
+        self.table = table
+        self.instance_id = instance_id
+        self.workers = 1
+        self.heartbeat_at = 0
+        self.heartbeat_lock = threading.Lock()
+
+    def factor(self):
+        if not self.schedule:
+            return 1
+        t = time.localtime()
+        minute = t.tm_hour * 60 + t.tm_min
+        for start, end, factor in self.schedule:
+            if start <= minute < end or (end <= start and (minute >= start or minute < end)):
+                return factor
+        return 0  # 不在任何时段内，不限速
+
+    # 在 DDB 同一个 item 的 workers map 里登记本 worker 的心跳时间，并数出最近还有心跳的 worker
+    def heartbeat(self):
+        now = int(time.time())
+        try:
+            try:
+                response = self.table.update_item(
+                    Key={"Key": Rate_limit_workers_key},
+                    UpdateExpression="SET workers.#i = :t",
+                    ExpressionAttributeNames={"#i": self.instance_id},
+                    ExpressionAttributeValues={":t": now},
+                    ReturnValues="ALL_NEW"
+                )
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'ValidationException':
+                    raise
+                # 还没有 workers map
+                response = self.table.update_item(
+                    Key={"Key": Rate_limit_workers_key},
+                    UpdateExpression="SET workers = if_not_exists(workers, :m)",
+                    ExpressionAttributeValues={":m": {self.instance_id: now}},
+                    ReturnValues="ALL_NEW"
+                )
+            alive = [i for i, t in response['Attributes']['workers'].items()
+                     if int(t) > now - 3 * Rate_limit_heartbeat]
+            if len(alive) != self.workers:
+                logger.info(f'Rate limit shared by {len(alive)} workers')
+            self.workers = max(len(alive), 1)
+        except Exception as e:
+            logger.warning(f'Fail to update rate limit workers in DDB, keep {self.workers} workers - {str(e)}')
+
+    # 发起一个请求前调用：取 1 个请求令牌和 size 个字节令牌，超出限速则等待，返回等待的秒数
+    def acquire(self, direction, size):
+        factor = self.factor()
+        if not factor:
+            return 0
+        if self.table is not None and time.time() - self.heartbeat_at > Rate_limit_heartbeat:
+            if self.heartbeat_lock.acquire(blocking=False):
+                try:
+                    self.heartbeat_at = time.time()
+                    self.heartbeat()
+                finally:
+                    self.heartbeat_lock.release()
+        waited = 0
+        for budget, n in (('requests', 1), ('bytes', size)):
+            rate = self.rates[(direction, budget)] * factor / self.workers
+            if rate > 0 and n > 0:
+                waited += self.buckets[(direction, budget)].acquire(n, rate)
+        if waited > 1:
+            logger.debug(f'Rate limit {direction} waited {waited:.1f}s for {size} Bytes')
+        return waited
+
+
+# Per-file retry budget shared by all parts of the file, limit 0 means no limit
+class RetryBudget:
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0  # 已重试次数
+        self.waited = 0  # 重试等待的总秒数
+        self.lock = threading.Lock()
+
+    def spend(self, delay):
+        with self.lock:
+            if self.limit and self.used >= self.limit:
+                return False
+            self.used += 1
+            self.waited += delay
+            return True
+
+
+# Retry backoff of all transfers on a worker, decorrelated jitter: sleep = random(base, last sleep x 3), capped
+# 按错误类型选择起始等待并分别计数：throttle（SlowDown/503 等限流），server（其他 5xx），
+# network（超时、连接断开、读不完整等非 S3 返回的错误），other（其他 S3 返回的错误）
+class RetryPolicy:
+    def __init__(self, *, RetryMaxDelay, FileRetryBudget):
+        self.RetryMaxDelay = RetryMaxDelay
+        self.FileRetryBudget = FileRetryBudget
+        self.counters = {kind: [0, 0] for kind in Retry_base_delay}  # kind: [重试次数, 等待秒数]
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def error_kind(err):
+        if not isinstance(err, ClientError):
+            return 'network'
+        code = err.response.get('Error', {}).get('Code')
+        status = err.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0)
+        if code in Retry_throttle_codes or status in (429, 503):
+            return 'throttle'
+        if code == 'RequestTimeout':
+            return 'network'
+        if status >= 500 or code == 'InternalError':
+            return 'server'
+        return 'other'
+
+    def file_budget(self):
+        return RetryBudget(self.FileRetryBudget)
+
+    # 按错误类型等待后返回这次等待的秒数，同一个请求下次重试时作为 last_delay 传入；文件的重试预算用完则不等待，返回 None
+    def backoff(self, err, last_delay, budget):
+        kind = self.error_kind(err)
+        base = Retry_base_delay[kind]
+        delay = min(random.uniform(base, max(last_delay, base) * 3), self.RetryMaxDelay)
+        if not budget.spend(delay):
+            return None
+        with self.lock:
+            self.counters[kind][0] += 1
+            self.counters[kind][1] += delay
+        time.sleep(delay)
+        return delay
+
+    def summary(self):
+        with self.lock:
+            return ', '.join(f'{kind} {n} times {waited:.1f}s' for kind, (n, waited) in self.counters.items() if n)
+
+
+# Parts of one file handed to PartExecutor, taken one by one when a thread is free
+# 分片任务是无参数的函数，返回结果；或返回生成器，每次 yield 一个需要的名额（有 try_acquire 的 ConcurrencyLimiter、
+# BufferRequest），PartExecutor 取得名额后才在空闲线程上恢复它，名额由分片自己归还。取不到名额的分片挂在 parked，不占线程
+class FileParts:
+    def __init__(self, tasks, MaxRunning, can_start, cond):
+        self.tasks = tasks  # 分片任务的迭代器
+        self.MaxRunning = MaxRunning  # 本文件同时进行中（含 parked）的分片数上限
+        self.can_start = can_start  # 取下一个新分片前的检查，如源端并发有空闲名额，None 则不检查
+        self.cond = cond
+        self.running = 0
+        self.done = 0
+        self.parked = deque()  # (分片生成器, 等待的名额)
+        self.exhausted = False  # 已取完所有分片任务
+        self.cancelled = False
+        self.quit = False  # 有分片返回 QUIT
+        self.error = None  # 分片任务抛出的第一个异常
+
+    def finished(self):
+        return (self.exhausted or self.cancelled) and not self.running
+
+    # 等待本文件已开始的分片都结束、且不再有新的分片，超时返回 False
+    def wait(self, timeout=None):
+        with self.cond:
+            return self.cond.wait_for(self.finished, timeout)
+
+    # 不再开始新的分片，已开始的分片由 stop_signal 通知退出
+    def cancel(self):
+        with self.cond:
+            self.cancelled = True
+            self.close_parked()
+            self.cond.notify_all()
+
+    # 在 cond 内调用：关闭等待名额的分片，生成器的 finally 归还它已取得的缓冲区
+    def close_parked(self):
+        while self.parked:
+            part, want = self.parked.popleft()
+            part.close()
+            self.running -= 1
+
+
+# Worker-wide part threads shared by all files, instead of a thread pool per file
+# 各文件的分片任务按文件轮流取（round-robin），有空闲线程时才取下一个分片，大文件不会占满线程让小文件等待
+# 线程只运行已取得本文件并发名额的分片，不会停在某个文件的并发限制上等待，名额满的文件轮到时直接跳过
+class PartExecutor:
+    def __init__(self, MaxWorkers):
+        self.files = deque()
+        self.cond = threading.Condition()
+        for i in range(MaxWorkers):
+            threading.Thread(target=self.worker, daemon=True).start()
+
+    def submit(self, tasks, MaxRunning, can_start):
+        file_parts = FileParts(iter(tasks), MaxRunning, can_start, self.cond)
+        with self.cond:
+            self.files.append(file_parts)
+            self.cond.notify_all()
+        return file_parts
+
+    # 在 cond 内调用：从下一个文件取一个能运行的分片，先恢复取到名额的 parked 分片，再取新分片
+    # 取完且没有进行中分片的文件，或已取消的文件移出队列
+    def next_task(self):
+        for i in range(len(self.files)):
+            file_parts = self.files.popleft()
+            if file_parts.cancelled:
+                self.cond.notify_all()
+                continue
+            for n, (part, want) in enumerate(file_parts.parked):
+                if want.try_acquire():
+                    del file_parts.parked[n]
+                    self.files.append(file_parts)
+                    return file_parts, part
+            if not file_parts.exhausted and file_parts.running < file_parts.MaxRunning and \
+                    (file_parts.can_start is None or file_parts.can_start()):
+                task = next(file_parts.tasks, None)
+                if task is None:
+                    file_parts.exhausted = True
+                    self.cond.notify_all()
+                else:
+                    file_parts.running += 1
+                    self.files.append(file_parts)
+                    return file_parts, task
+            if not file_parts.finished():
+                self.files.append(file_parts)
+        return None, None
+
+    # 运行分片生成器直到结束；需要的名额取不到时挂到 parked，返回 (None, True)，线程去运行其他分片
+    def run_part(self, file_parts, part):
+        while True:
+            try:
+                want = part.send(None)
+            except StopIteration as e:
+                return e.value, False
+            if want.try_acquire():
+                continue
+            with self.cond:
+                if not file_parts.cancelled:
+                    file_parts.parked.append((part, want))
+                    return None, True
+            part.close()
+            return "TIMEOUT", False
+
+    def worker(self):
+        while True:
+            with self.cond:
+                file_parts, part = self.next_task()
+                while part is None:
+                    self.cond.wait()
+                    file_parts, part = self.next_task()
+            result, error, parked = None, None, False
+            try:
+                if not inspect.isgenerator(part):
+                    part = part()  # 新分片
+                if inspect.isgenerator(part):
+                    result, parked = self.run_part(file_parts, part)
+                else:
+                    result = part
+            except Exception as e:
+                error = e
+            with self.cond:
+                if not parked:
+                    file_parts.running -= 1
+                    file_parts.done += 1
+                    if result == "QUIT":
+                        # 其他分片已由 stop_signal 通知退出，剩下的分片不用再开始
+                        file_parts.quit = True
+                        file_parts.cancelled = True
+                        file_parts.close_parked()
+                    if error is not None and file_parts.error is None:
+                        file_parts.error = error
+                self.cond.notify_all()
+
+
+# MD5 of parts of one multipart upload, written to the file's DDB item in batches as parts complete,
+# so a resumed job with ifVerifyMD5Twice rebuilds the whole file ETag without downloading uploaded parts again
+# 记录在 partMd5 字符串集合，每个元素为 "分片号:MD5的base64"（10000 个分片约 280KB，不超过 DDB item 400KB 的上限），
+# 并记录 partMd5UploadId，换了新的 upload 则覆盖旧的记录
+class PartMd5Log:
+    def __init__(self, *, table, Src_bucket, Src_key, uploadId):
+        self.table = table
+        self.table_key = str(PurePosixPath(Src_bucket) / Src_key)
+        if Src_key[-1] == '/':  # 针对空目录对象
+            self.table_key += '/'
+        self.uploadId = uploadId
+        self.pending = {}  # partnumber: digest
+        self.last_flush = time.time()
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+
+    def add(self, partnumber, digest):
+        with self.lock:
+            self.pending[partnumber] = digest
+            if time.time() - self.last_flush < Part_md5_flush_seconds:
+                return
+        self.flush()
+
+    def flush(self):
+        with self.lock:
+            batch, self.pending = self.pending, {}
+            self.last_flush = time.time()
+        if not batch:
+            return
+        part_md5 = {f'{n}:{base64.b64encode(digest).decode("utf-8").rstrip("=")}' for n, digest in batch.items()}
+        with self.write_lock:
+            try:
+                try:
+                    self.table.update_item(
+                        Key={"Key": self.table_key},
+                        UpdateExpression="ADD partMd5 :m",
+                        ConditionExpression="partMd5UploadId = :u",
+                        ExpressionAttributeValues={":m": part_md5, ":u": self.uploadId}
+                    )
+                except ClientError as e:
+                    if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                        raise
+                    # 还没有记录，或记录的是之前放弃的 upload
+                    self.table.update_item(
+                        Key={"Key": self.table_key},
+                        UpdateExpression="SET partMd5 = :m, partMd5UploadId = :u",
+                        ExpressionAttributeValues={":m": part_md5, ":u": self.uploadId}
+                    )
+                logger.info(f'Write {len(batch)} part MD5 to DDB - {self.table_key}')
+            except Exception as e:
+                # 没写进去的分片续传时重新下载校验
+                logger.warning(f'Fail to write part MD5 to DDB - {self.table_key} - {str(e)}')
+
+
+# Read get_object Body block by block and update md5 on the way, return the number of bytes read
+# buffer 为 bytearray 则读入内存缓冲区，为文件则从头写入文件，为 None 则只计算 MD5 不保留数据
+def read_body_into(response_get_object, buffer, md5):
+    body = response_get_object["Body"]
+    size = 0
+    if isinstance(buffer, bytearray):
+        readinto = getattr(body, 'readinto', None)
+        view = memoryview(buffer)
+        try:
+            while size < len(buffer):
+                if readinto:
+                    n = readinto(view[size:size + Read_block_size])
+                else:  # botocore StreamingBody 没有 readinto，按块读入后拷贝
+                    block = body.read(min(Read_block_size, len(buffer) - size))
+                    n = len(block)
+                    view[size:size + n] = block
+                if not n:
+                    break
+                md5.update(view[size:size + n])
+                size += n
+        finally:
+            view.release()
+    else:
+        if buffer is not None:
+            buffer.seek(0)
+            buffer.truncate()
+        while True:
+            block = body.read(Read_block_size)
+            if not block:
+                break
+            md5.update(block)
+            if buffer is not None:
+                buffer.write(block)
+            size += len(block)
+    if size != response_get_object['ContentLength']:
+        raise Exception(f'Incomplete read: {size} of {response_get_object["ContentLength"]} Bytes')
+    return size
 
 
 # Process one job
-def job_processor(*, uploadId, indexList, partnumberList, job, s3_src_client, s3_des_client,
-                  MaxThread, ChunkSize, MaxRetry, JobTimeout, ifVerifyMD5Twice, GetObjectWithVersionId):
-    # 线程生成器，配合thread pool给出每个线程的对应关系，便于设置超时控制
-    def thread_gen(woker_thread, pool,
-                   stop_signal, partnumber, total, md5list, partnumberList, complete_list):
+# progress 不为 None 时，JobTimeout 是无进度超时：每完成一个分片的下载或上传就刷新 progress['last']，
+# 超过 JobTimeout 没有任何进度才退出；progress 为 None（如 Lambda）则 JobTimeout 是整个文件的超时时间
+# 每个分片上传成功后把返回的 ETag 记入 part_etags，供 completeUpload 合并文件时直接使用
+# JobType 为 COPY 时用 upload_part_copy 在 S3 服务端复制分片，数据不经过 worker
+def job_processor(*, uploadId, indexList, partnumberList, part_etags, job, s3_src_client, s3_des_client,
+                  MaxThread, ChunkSize, MaxRetry, JobTimeout, ifVerifyMD5Twice, GetObjectWithVersionId, progress,
+                  JobType, buffer_pool, MaxUploadThread, adaptive, rate_limiter, retry_policy, part_md5s, part_md5_log,
+                  part_executor):
+    # 分片任务生成器，part_executor 有空闲线程时才取下一个分片，不在开始时一次提交所有分片
+    def part_tasks(woker_thread, stop_signal, partnumber, total, md5list, partnumberList, complete_list):
         for partStartIndex in indexList:
             # start to upload part
             if partnumber not in partnumberList:
                 dryrun = False  # dryrun 是为了沿用现有的流程做出完成列表，方便后面计算 MD5
             else:
                 dryrun = True
-            th = pool.submit(woker_thread,
-                             stop_signal=stop_signal,
-                             partnumber=partnumber,
-                             partStartIndex=partStartIndex,
-                             total=total,
-                             md5list=md5list,
-                             dryrun=dryrun,
-                             complete_list=complete_list
-                             )
+            yield functools.partial(woker_thread,
+                                    stop_signal=stop_signal,
+                                    partnumber=partnumber,
+                                    partStartIndex=partStartIndex,
+                                    total=total,
+                                    md5list=md5list,
+                                    dryrun=dryrun,
+                                    complete_list=complete_list
+                                    )
             partnumber += 1
-            yield th
 
     # download part from src. s3 and upload to dest. s3
-    def woker_thread(*, stop_signal, partnumber, partStartIndex, total, md5list, dryrun, complete_list):
+    def woker_thread(*, stop_signal, partnumber, partStartIndex, total, md5list, dryrun, complete_list, part_buffer):
         if stop_signal.is_set():
             return "TIMEOUT"
         Src_bucket = job['Src_bucket']
@@ -456,202 +1903,398 @@ def job_processor(*, uploadId, indexList, partnumberList, job, s3_src_client, s3
         Des_bucket = job['Des_bucket']
         Des_key = job['Des_key']
         versionId = job['versionId']
-        getBody, chunkdata_md5 = b'', b''  # init
+        getBody, getBody_size, chunkdata_md5 = b'', 0, b''  # init
 
         # 下载文件
-        if ifVerifyMD5Twice or not dryrun:  # 如果 ifVerifyMD5Twice 则无论是否已有上传过都重新下载，作为校验整个文件用
-            if GetObjectWithVersionId:
-                logger.info(f"--->Downloading {ChunkSize} Bytes {Src_bucket}/{Src_key} - {partnumber}/{total}"
-                            f" - versionId: {versionId}")
-            else:
-                logger.info(f"--->Downloading {ChunkSize} Bytes {Src_bucket}/{Src_key} - {partnumber}/{total}")
-            retryTime = 0
-
-            # 正常工作情况下出现 stop_signal 需要退出 Thread
-            while retryTime <= MaxRetry and not stop_signal.is_set():
-                retryTime += 1
-                try:
-                    if GetObjectWithVersionId:  # 按VersionId获取Object
-                        response_get_object = s3_src_client.get_object(
-                            Bucket=Src_bucket,
-                            Key=Src_key,
-                            VersionId=versionId,
-                            Range="bytes=" + str(partStartIndex) + "-" + str(partStartIndex + ChunkSize - 1)
-                        )
-                    else:  # 不带VersionId，即获取最新对象
-                        response_get_object = s3_src_client.get_object(
-                            Bucket=Src_bucket,
-                            Key=Src_key,
-                            Range="bytes=" + str(partStartIndex) + "-" + str(partStartIndex + ChunkSize - 1)
-                        )
-                    getBody = response_get_object["Body"].read()
-                    chunkdata_md5 = hashlib.md5(getBody)
-                    md5list[partnumber - 1] = chunkdata_md5
-                    break  # 完成下载，不用重试
-                except ClientError as err:
-                    if err.response['Error']['Code'] in ['NoSuchKey', 'AccessDenied']:
-                        # 没这个ID，文件已经删除，或者无权限访问
-                        logger.error(f"ClientError: Fail to access {Src_bucket}/{Src_key} - ERR: {str(err)}.")
-                        stop_signal.set()
-                        return "QUIT"
-                    logger.warning(f"ClientError: Fail to download {Src_bucket}/{Src_key} - ERR: {str(err)}. "
-                                   f"Retry part: {partnumber} - Attempts: {retryTime}")
-                    if retryTime >= MaxRetry:  # 超过次数退出
-                        logger.error(f"ClientError: Quit for Max Download retries: {retryTime} - "
-                                     f"{Src_bucket}/{Src_key}")
-                        stop_signal.set()
-                        return "TIMEOUT"  # 退出Thread
-                    else:
-                        time.sleep(5 * retryTime)
-                        continue
-                        # 递增延迟，返回重试
-                except Exception as e:
-                    logger.warning(f"Fail to download {Src_bucket}/{Src_key} - ERR: {str(e)}. "
-                                   f"Retry part: {partnumber} - Attempts: {retryTime}")
-                    if retryTime >= MaxRetry:  # 超过次数退出
-                        logger.error(f"Quit for Max Download retries: {retryTime} - {Src_bucket}/{Src_key}")
-                        stop_signal.set()
-                        return "TIMEOUT"  # 退出Thread
-                    else:
-                        time.sleep(5 * retryTime)
-                        continue
+        if dryrun and partnumber in part_md5s and part_etags[partnumber].strip('"') == part_md5s[partnumber].hex():
+            # 续传时已上传的分片用 DDB 记录的 MD5，目的端分片的 ETag 与之一致就不用重新下载
+            md5list[partnumber - 1] = part_md5s[partnumber]
+        elif ifVerifyMD5Twice or not dryrun:  # 如果 ifVerifyMD5Twice 则无论是否已有上传过都重新下载，作为校验整个文件用
+            yield download_slots  # 源端并发，part_executor 取得名额后才继续
+            try:
+                if GetObjectWithVersionId:
+                    logger.info(f"--->Downloading {ChunkSize} Bytes {Src_bucket}/{Src_key} - {partnumber}/{total}"
+                                f" - versionId: {versionId}")
+                else:
+                    logger.info(f"--->Downloading {ChunkSize} Bytes {Src_bucket}/{Src_key} - {partnumber}/{total}")
+                retryTime, retry_delay = 0, 0
+
+                # 正常工作情况下出现 stop_signal 需要退出 Thread
+                while retryTime <= MaxRetry and not stop_signal.is_set():
+                    retryTime += 1
+                    try:
+                        rate_limiter.acquire('src', min(ChunkSize, job['Size'] - partStartIndex))
+                        part_start = time.time()
+                        if GetObjectWithVersionId:  # 按VersionId获取Object
+                            response_get_object = s3_src_client.get_object(
+                                Bucket=Src_bucket,
+                                Key=Src_key,
+                                VersionId=versionId,
+                                Range="bytes=" + str(partStartIndex) + "-" + str(partStartIndex + ChunkSize - 1)
+                            )
+                        else:  # 不带VersionId，即获取最新对象
+                            response_get_object = s3_src_client.get_object(
+                                Bucket=Src_bucket,
+                                Key=Src_key,
+                                Range="bytes=" + str(partStartIndex) + "-" + str(partStartIndex + ChunkSize - 1)
+                            )
+                        chunkdata_md5 = hashlib.md5()
+                        getBody_size = read_body_into(response_get_object, part_buffer, chunkdata_md5)
+                        if isinstance(part_buffer, bytearray) and getBody_size < len(part_buffer):
+                            getBody = bytes(memoryview(part_buffer)[:getBody_size])  # 最后一个分片小于 ChunkSize
+                        else:
+                            getBody = part_buffer  # 内存缓冲区，临时文件，或只校验 MD5 时为 None
+                        md5list[partnumber - 1] = chunkdata_md5.digest()
+                        download_slots.record(getBody_size, time.time() - part_start)
+                        if progress is not None:
+                            progress['last'] = time.time()
+                        break  # 完成下载，不用重试
+                    except ClientError as err:
+                        if err.response['Error']['Code'] in ['NoSuchKey', 'AccessDenied']:
+                            # 没这个ID，文件已经删除，或者无权限访问
+                            logger.error(f"ClientError: Fail to access {Src_bucket}/{Src_key} - ERR: {str(err)}.")
+                            stop_signal.set()
+                            return "QUIT"
+                        logger.warning(f"ClientError: Fail to download {Src_bucket}/{Src_key} - ERR: {str(err)}. "
+                                       f"Retry part: {partnumber} - Attempts: {retryTime}")
+                        download_slots.record_error()
+                        if retryTime >= MaxRetry:  # 超过次数退出
+                            logger.error(f"ClientError: Quit for Max Download retries: {retryTime} - "
+                                         f"{Src_bucket}/{Src_key}")
+                            stop_signal.set()
+                            return "TIMEOUT"  # 退出Thread
+                        else:
+                            retry_delay = retry_policy.backoff(err, retry_delay, retry_budget)
+                            if retry_delay is None:
+                                logger.error(f"Quit for file retry budget: {retry_budget.limit} - "
+                                             f"{Src_bucket}/{Src_key}")
+                                stop_signal.set()
+                                return "TIMEOUT"
+                            continue
+                    except Exception as e:
+                        logger.warning(f"Fail to download {Src_bucket}/{Src_key} - ERR: {str(e)}. "
+                                       f"Retry part: {partnumber} - Attempts: {retryTime}")
+                        download_slots.record_error()
+                        if retryTime >= MaxRetry:  # 超过次数退出
+                            logger.error(f"Quit for Max Download retries: {retryTime} - {Src_bucket}/{Src_key}")
+                            stop_signal.set()
+                            return "TIMEOUT"  # 退出Thread
+                        else:
+                            retry_delay = retry_policy.backoff(e, retry_delay, retry_budget)
+                            if retry_delay is None:
+                                logger.error(f"Quit for file retry budget: {retry_budget.limit} - "
+                                             f"{Src_bucket}/{Src_key}")
+                                stop_signal.set()
+                                return "TIMEOUT"
+                            continue
+            finally:
+                download_slots.release()
         # 上传文件
         if not dryrun:  # 这里就不用考虑 ifVerifyMD5Twice 了，
-            retryTime = 0
+            yield upload_slots  # 目的端并发，下载完的分片在这里排队时不占用线程
+            try:
+                retryTime, retry_delay = 0, 0
+                while retryTime <= MaxRetry and not stop_signal.is_set():
+                    retryTime += 1
+                    try:
+                        logger.info(f'--->Uploading {getBody_size} Bytes {Des_bucket}/{Des_key} - {partnumber}/{total}')
+                        rate_limiter.acquire('des', getBody_size)
+                        if hasattr(getBody, 'seek'):  # 临时文件每次都从头上传
+                            getBody.seek(0)
+                        part_start = time.time()
+                        response_upload_part = s3_des_client.upload_part(
+                            Body=getBody,
+                            Bucket=Des_bucket,
+                            Key=Des_key,
+                            PartNumber=partnumber,
+                            UploadId=uploadId,
+                            ContentMD5=base64.b64encode(chunkdata_md5.digest()).decode('utf-8')
+                        )
+                        # 请求已经带上md5，如果s3校验是错的就Exception
+                        part_etags[partnumber] = response_upload_part['ETag']
+                        upload_slots.record(getBody_size, time.time() - part_start)
+                        if progress is not None:
+                            progress['last'] = time.time()
+                        break
+                    except ClientError as err:
+                        if err.response['Error']['Code'] == 'NoSuchUpload':
+                            # 没这个ID，则是别人已经完成这个Job了。
+                            logger.warning(f'ClientError: Fail to upload part - might be duplicated job:'
+                                           f' {Des_bucket}/{Des_key}, {str(err)}')
+                            stop_signal.set()
+                            return "QUIT"
+                        logger.warning(f"ClientError: Fail to upload part - {Des_bucket}/{Des_key} -  {str(err)}, "
+                                       f"retry part: {partnumber} Attempts: {retryTime}")
+                        upload_slots.record_error()
+                        if retryTime >= MaxRetry:
+                            logger.error(f"ClientError: Quit for Max Upload retries: {retryTime} - "
+                                         f"{Des_bucket}/{Des_key}")
+                            # 改为跳下一个文件
+                            stop_signal.set()
+                            return "TIMEOUT"
+                        else:
+                            retry_delay = retry_policy.backoff(err, retry_delay, retry_budget)
+                            if retry_delay is None:
+                                logger.error(f"Quit for file retry budget: {retry_budget.limit} - "
+                                             f"{Des_bucket}/{Des_key}")
+                                stop_signal.set()
+                                return "TIMEOUT"
+                            continue
+                    except Exception as e:
+                        logger.warning(f"Fail to upload part - {Des_bucket}/{Des_key} -  {str(e)}, "
+                                       f"retry part: {partnumber} Attempts: {retryTime}")
+                        upload_slots.record_error()
+                        if retryTime >= MaxRetry:
+                            logger.error(f"Quit for Max Upload retries: {retryTime} - {Des_bucket}/{Des_key}")
+                            # 改为跳下一个文件
+                            stop_signal.set()
+                            return "TIMEOUT"
+                        else:
+                            retry_delay = retry_policy.backoff(e, retry_delay, retry_budget)
+                            if retry_delay is None:
+                                logger.error(f"Quit for file retry budget: {retry_budget.limit} - "
+                                             f"{Des_bucket}/{Des_key}")
+                                stop_signal.set()
+                                return "TIMEOUT"
+                            continue
+            finally:
+                upload_slots.release()
+
+        if not stop_signal.is_set():
+            if part_md5_log is not None and chunkdata_md5:
+                part_md5_log.add(partnumber, chunkdata_md5.digest())
+            complete_list.append(partnumber)
+            if not dryrun:
+                logger.info(
+                    f'--->Complete {getBody_size} Bytes {Src_bucket}/{Src_key}'
+                    f' - {partnumber}/{total} {len(complete_list) / total:.2%}')
+        else:
+            return "TIMEOUT"
+        return "COMPLETE"
+
+    # woker_thread END
+
+    # copy part from src. s3 to dest. s3 inside S3
+    def copy_thread(*, stop_signal, partnumber, partStartIndex, total, md5list, dryrun, complete_list):
+        if stop_signal.is_set():
+            return "TIMEOUT"
+        Src_bucket = job['Src_bucket']
+        Src_key = job['Src_key']
+        Des_bucket = job['Des_bucket']
+        Des_key = job['Des_key']
+        versionId = job['versionId']
+        partEndIndex = min(partStartIndex + ChunkSize, job['Size']) - 1  # CopySourceRange 不能超出文件大小
+
+        if not dryrun:
+            CopySource = {'Bucket': Src_bucket, 'Key': Src_key}
+            if GetObjectWithVersionId:
+                CopySource['VersionId'] = versionId
+            retryTime, retry_delay = 0, 0
             while retryTime <= MaxRetry and not stop_signal.is_set():
                 retryTime += 1
                 try:
-                    logger.info(f'--->Uploading {len(getBody)} Bytes {Des_bucket}/{Des_key} - {partnumber}/{total}')
-                    s3_des_client.upload_part(
-                        Body=getBody,
+                    logger.info(f'--->Copying {partEndIndex - partStartIndex + 1} Bytes {Src_bucket}/{Src_key} to '
+                                f'{Des_bucket}/{Des_key} - {partnumber}/{total}')
+                    rate_limiter.acquire('src', 0)  # 服务端复制不占用 worker 的带宽，只计请求数
+                    rate_limiter.acquire('des', 0)
+                    response_copy_part = s3_des_client.upload_part_copy(
+                        CopySource=CopySource,
+                        CopySourceRange=f'bytes={partStartIndex}-{partEndIndex}',
                         Bucket=Des_bucket,
                         Key=Des_key,
                         PartNumber=partnumber,
-                        UploadId=uploadId,
-                        ContentMD5=base64.b64encode(chunkdata_md5.digest()).decode('utf-8')
+                        UploadId=uploadId
                     )
-                    # 请求已经带上md5，如果s3校验是错的就Exception
+                    part_etags[partnumber] = response_copy_part['CopyPartResult']['ETag']
+                    if progress is not None:
+                        progress['last'] = time.time()
                     break
                 except ClientError as err:
-                    if err.response['Error']['Code'] == 'NoSuchUpload':
-                        # 没这个ID，则是别人已经完成这个Job了。
-                        logger.warning(f'ClientError: Fail to upload part - might be duplicated job:'
-                                       f' {Des_bucket}/{Des_key}, {str(err)}')
+                    if err.response['Error']['Code'] in ['NoSuchKey', 'AccessDenied', 'NoSuchUpload']:
+                        # 源文件已删除或无权限访问，或者别人已经完成这个Job了
+                        logger.error(f"ClientError: Fail to copy part {Src_bucket}/{Src_key} - ERR: {str(err)}.")
                         stop_signal.set()
                         return "QUIT"
-                    logger.warning(f"ClientError: Fail to upload part - {Des_bucket}/{Des_key} -  {str(err)}, "
+                    logger.warning(f"ClientError: Fail to copy part - {Des_bucket}/{Des_key} -  {str(err)}, "
                                    f"retry part: {partnumber} Attempts: {retryTime}")
                     if retryTime >= MaxRetry:
-                        logger.error(f"ClientError: Quit for Max Upload retries: {retryTime} - {Des_bucket}/{Des_key}")
-                        # 改为跳下一个文件
+                        logger.error(f"ClientError: Quit for Max Copy retries: {retryTime} - {Des_bucket}/{Des_key}")
                         stop_signal.set()
                         return "TIMEOUT"
                     else:
-                        time.sleep(5 * retryTime)  # 递增延迟重试
+                        retry_delay = retry_policy.backoff(err, retry_delay, retry_budget)
+                        if retry_delay is None:
+                            logger.error(f"Quit for file retry budget: {retry_budget.limit} - {Des_bucket}/{Des_key}")
+                            stop_signal.set()
+                            return "TIMEOUT"
                         continue
                 except Exception as e:
-                    logger.warning(f"Fail to upload part - {Des_bucket}/{Des_key} -  {str(e)}, "
+                    logger.warning(f"Fail to copy part - {Des_bucket}/{Des_key} -  {str(e)}, "
                                    f"retry part: {partnumber} Attempts: {retryTime}")
                     if retryTime >= MaxRetry:
-                        logger.error(f"Quit for Max Upload retries: {retryTime} - {Des_bucket}/{Des_key}")
-                        # 改为跳下一个文件
+                        logger.error(f"Quit for Max Copy retries: {retryTime} - {Des_bucket}/{Des_key}")
                         stop_signal.set()
                         return "TIMEOUT"
                     else:
-                        time.sleep(5 * retryTime)
+                        retry_delay = retry_policy.backoff(e, retry_delay, retry_budget)
+                        if retry_delay is None:
+                            logger.error(f"Quit for file retry budget: {retry_budget.limit} - {Des_bucket}/{Des_key}")
+                            stop_signal.set()
+                            return "TIMEOUT"
                         continue
 
         if not stop_signal.is_set():
+            # 分片的 ETag 就是分片的 MD5（SSE-KMS 加密的对象除外），用来计算整个文件的 ETag
+            if partnumber in part_etags:
+                md5list[partnumber - 1] = bytes.fromhex(part_etags[partnumber].strip('"'))
             complete_list.append(partnumber)
             if not dryrun:
                 logger.info(
-                    f'--->Complete {len(getBody)} Bytes {Src_bucket}/{Src_key}'
+                    f'--->Complete copy {Src_bucket}/{Src_key}'
                     f' - {partnumber}/{total} {len(complete_list) / total:.2%}')
         else:
             return "TIMEOUT"
         return "COMPLETE"
 
-    # woker_thread END
+    # copy_thread END
+
+    # 需要下载上传的分片从 buffer_pool 借一个 ChunkSize 的缓冲区，传完或失败都归还；超过 SpoolThreshold 的分片用临时文件
+    # 已上传的分片（dryrun）即使 ifVerifyMD5Twice 重新下载，也只是边读边算 MD5，不需要缓冲区
+    def buffered_thread(*, stop_signal, partnumber, partStartIndex, total, md5list, dryrun, complete_list):
+        part_kwargs = dict(stop_signal=stop_signal, partnumber=partnumber, partStartIndex=partStartIndex,
+                           total=total, md5list=md5list, dryrun=dryrun, complete_list=complete_list)
+        if dryrun:
+            return (yield from woker_thread(part_buffer=None, **part_kwargs))
+        if buffer_pool.spool(ChunkSize):
+            with tempfile.TemporaryFile() as part_file:
+                return (yield from woker_thread(part_buffer=part_file, **part_kwargs))
+        buffer_request = BufferRequest(buffer_pool, ChunkSize)
+        yield buffer_request  # 预算不够时 part_executor 先运行其他分片，有缓冲区归还后再继续
+        try:
+            return (yield from woker_thread(part_buffer=buffer_request.buffer, **part_kwargs))
+        finally:
+            buffer_pool.release(buffer_request.buffer)
 
     # job_processor Main
     partnumber = 1  # 当前循环要上传的Partnumber
     total = len(indexList)
-    md5list = [hashlib.md5(b'')] * total
+
+    # 流水线：MaxThread 个线程下载源端分片，MaxUploadThread 个线程上传目的端分片，下载第 N+k 个分片与上传第 N 个分片同时进行
+    # 已下载等待上传的分片在两者之间排队，排队数量受同时运行的分片数和 buffer_pool 限制。MaxUploadThread 为 0 则每个线程下载完接着上传
+    # 设置了 adaptive 则两个方向的并发数在上限内按测得的吞吐和出错情况自动调整
+    download_slots = ConcurrencyLimiter(MaxLimit=MaxThread, adaptive=adaptive, direction='download')
+    if MaxUploadThread > 0 and JobType.upper() != "COPY":
+        upload_slots = ConcurrencyLimiter(MaxLimit=MaxUploadThread, adaptive=adaptive, direction='upload')
+        pool_size = MaxThread + MaxUploadThread
+    else:
+        upload_slots = ConcurrencyLimiter(MaxLimit=MaxThread, adaptive=None, direction='upload')
+        pool_size = MaxThread
+    md5list = [hashlib.md5(b'').digest()] * total
     complete_list = []
+    retry_budget = retry_policy.file_budget()  # 本文件所有分片共用的重试次数
 
-    # 线程池
+    # 分片交给 worker 共用的 part_executor，本文件进行中的分片数不超过 pool_size，
+    # 同时在下载/上传的分片数不超过 download_slots/upload_slots 当前的名额，源端有空闲名额时才开始新的分片
     try:
         stop_signal = threading.Event()  # 用于JobTimeout终止当前文件的所有线程
-        with concurrent.futures.ThreadPoolExecutor(max_workers=MaxThread) as pool:
-            # 这里要用迭代器拿到threads对象
-            threads = list(thread_gen(woker_thread, pool, stop_signal,
-                                      partnumber, total, md5list, partnumberList, complete_list))
-
-            result = concurrent.futures.wait(threads, timeout=JobTimeout, return_when="ALL_COMPLETED")
-
-            # 异常退出
-            if "QUIT" in [t.result() for t in result[0]]:  # result[0] 是函数done
-                logger.warning(f'QUIT. Canceling {len(result[1])} waiting threads in pool ...')
-                stop_signal.set()
-                for t in result[1]:
-                    t.cancel()
-                logger.warning(f'QUIT Job: {job["Src_bucket"]}/{job["Src_key"]}')
-                return "QUIT"
-            # 超时
-            if len(result[1]) > 0:  # # result[0] 是函数not_done, 即timeout有未完成的
-                logger.warning(f'TIMEOUT. Canceling {len(result[1])} waiting threads in pool ...')
+        part_thread = copy_thread if JobType.upper() == "COPY" else buffered_thread
+        file_parts = part_executor.submit(
+            part_tasks(part_thread, stop_signal, partnumber, total, md5list, partnumberList, complete_list),
+            MaxRunning=pool_size,
+            can_start=None if JobType.upper() == "COPY" else download_slots.available
+        )
+        try:
+            if progress is None:
+                finished = file_parts.wait(timeout=JobTimeout)
+            else:
+                progress['last'] = time.time()
+                while True:
+                    finished = file_parts.wait(timeout=min(JobTimeout, 60))
+                    if finished or time.time() - progress['last'] > JobTimeout:
+                        break
+        finally:
+            if not file_parts.finished():
+                # 超时或异常退出，不再开始新的分片，并等已开始的分片退出后再返回
+                logger.warning(f'Canceling {total - file_parts.done - file_parts.running} waiting parts ...')
                 stop_signal.set()
-                for t in result[1]:
-                    t.cancel()
+                file_parts.cancel()
+                file_parts.wait()
+        if file_parts.error is not None:
+            raise file_parts.error
+
+        # 异常退出
+        if file_parts.quit:
+            logger.warning(f'QUIT Job: {job["Src_bucket"]}/{job["Src_key"]}')
+            return "QUIT"
+        # 超时，或有分片重试次数用完已经放弃（stop_signal）
+        if not finished or stop_signal.is_set():
+            if finished:
+                logger.warning(f'TIMEOUT parts quit for retries Job: {job["Src_bucket"]}/{job["Src_key"]}')
+            elif progress is None:
                 logger.warning(f'TIMEOUT {JobTimeout}S Job: {job["Src_bucket"]}/{job["Src_key"]}')
-                return "TIMEOUT"
+            else:
+                logger.warning(f'TIMEOUT no progress in {JobTimeout}S Job: {job["Src_bucket"]}/{job["Src_key"]}')
+            return "TIMEOUT"
 
-        # 线程池End
         logger.info(f'All parts uploaded: {job["Src_bucket"]}/{job["Src_key"]} - Size:{job["Size"]}')
 
         # 计算所有分片列表的总etag: cal_etag
-        digests = b"".join(m.digest() for m in md5list)
+        digests = b"".join(md5list)
         md5full = hashlib.md5(digests)
         cal_etag = '"%s-%s"' % (md5full.hexdigest(), len(md5list))
     except Exception as e:
         logger.error(f'Exception in job_processor: {str(e)}')
         return "ERR"
+    finally:
+        if part_md5_log is not None:
+            part_md5_log.flush()
+        if retry_budget.used:
+            logger.info(f'Retried {retry_budget.used} times, waited {retry_budget.waited:.1f}s - '
+                        f'{job["Src_bucket"]}/{job["Src_key"]}. Worker retries: {retry_policy.summary()}')
     return cal_etag
 
 
 # Complete multipart upload
-# 通过查询回来的所有Part列表uploadedListParts来构建completeStructJSON
-def completeUpload(*, uploadId, Des_bucket, Des_key, len_indexList, s3_des_client):
-    # 查询S3的所有Part列表uploadedListParts构建completeStructJSON
+# 优先用本地记录的 part_etags 构建completeStructJSON，本地不完整时才查询S3的所有Part列表uploadedListParts
+def completeUpload(*, uploadId, Des_bucket, Des_key, len_indexList, part_etags, s3_des_client):
     uploadedListPartsClean = []
-    logger.info(f'Get partnumber list - {Des_bucket}/{Des_key}')
-    paginator = s3_des_client.get_paginator('list_parts')
-    try:
-        response_iterator = paginator.paginate(
-            Bucket=Des_bucket,
-            Key=Des_key,
-            UploadId=uploadId
-        )
-        # 把 ETag 加入到 Part List
-        for page in response_iterator:
-            if "Parts" in page:
-                logger.info(f'Got list_parts: {len(page["Parts"])} - {Des_bucket}/{Des_key}')
-                for p in page["Parts"]:
-                    uploadedListPartsClean.append({
-                        "ETag": p["ETag"],
-                        "PartNumber": p["PartNumber"]
-                    })
-    except ClientError as e:
-        if e.response['Error']['Code'] == 'NoSuchUpload':
-            # 没这个ID，则是别人已经完成这个Job了。
-            logger.warning(f'ClientError: Fail to list parts while completeUpload - might be duplicated job:'
-                           f' {Des_bucket}/{Des_key}, {str(err)}')
-            return "QUIT"
-        logger.error(f'ClientError: Fail to list parts while completeUpload - {Des_bucket}/{Des_key} - {str(e)}')
-        return "ERR"
-    except Exception as e:
-        logger.error(f'Fail to list parts while completeUpload - {Des_bucket}/{Des_key} - {str(e)}')
-        return "ERR"
+    if len(part_etags) == len_indexList and all(n in part_etags for n in range(1, len_indexList + 1)):
+        logger.info(f'Use local part ETags: {len(part_etags)} - {Des_bucket}/{Des_key}')
+        for n in range(1, len_indexList + 1):
+            uploadedListPartsClean.append({
+                "ETag": part_etags[n],
+                "PartNumber": n
+            })
+    else:
+        logger.info(f'Local part ETags incomplete: {len(part_etags)}/{len_indexList}, '
+                    f'get partnumber list - {Des_bucket}/{Des_key}')
+        paginator = s3_des_client.get_paginator('list_parts')
+        try:
+            response_iterator = paginator.paginate(
+                Bucket=Des_bucket,
+                Key=Des_key,
+                UploadId=uploadId
+            )
+            # 把 ETag 加入到 Part List
+            for page in response_iterator:
+                if "Parts" in page:
+                    logger.info(f'Got list_parts: {len(page["Parts"])} - {Des_bucket}/{Des_key}')
+                    for p in page["Parts"]:
+                        uploadedListPartsClean.append({
+                            "ETag": p["ETag"],
+                            "PartNumber": p["PartNumber"]
+                        })
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'NoSuchUpload':
+                # 没这个ID，则是别人已经完成这个Job了。
+                logger.warning(f'ClientError: Fail to list parts while completeUpload - might be duplicated job:'
+                               f' {Des_bucket}/{Des_key}, {str(e)}')
+                return "QUIT"
+            logger.error(f'ClientError: Fail to list parts while completeUpload - {Des_bucket}/{Des_key} - {str(e)}')
+            return "ERR"
+        except Exception as e:
+            logger.error(f'Fail to list parts while completeUpload - {Des_bucket}/{Des_key} - {str(e)}')
+            return "ERR"
     if len(uploadedListPartsClean) != len_indexList:
         logger.error(f'Uploaded parts size not match - {Des_bucket}/{Des_key}')
         return "ERR"
@@ -677,118 +2320,203 @@ def completeUpload(*, uploadId, Des_bucket, Des_key, len_indexList, s3_des_clien
     return result
 
 
+# Long polling sqs and feed messages to job_looper through work_queue
+# 只有在有空闲 job_looper 时才取消息，避免消息在本地排队时消耗 SQS 可见性超时
+def sqs_receiver(*, sqs, sqs_queue, work_queue, idle_slots, WaitTimeSeconds):
+    while True:
+        idle_slots.acquire()  # 至少一个空闲 job_looper
+        slots = 1
+        while slots < 10 and idle_slots.acquire(blocking=False):
+            slots += 1
+        messages = []
+        try:
+            logger.info(f'Get Job from sqs queue, max messages: {slots}...')
+            sqs_job_get = sqs.receive_message(
+                QueueUrl=sqs_queue,
+                MaxNumberOfMessages=slots,
+                WaitTimeSeconds=WaitTimeSeconds
+            )
+            messages = sqs_job_get.get('Messages', [])
+            if not messages:  # Long polling 已等待 WaitTimeSeconds
+                logger.info('No message in queue available, wait...')
+        except Exception as e:
+            logger.error(f'Fail to receive sqs message. Wait for 5 seconds. ERR: {str(e)}')
+            time.sleep(5)
+        for sqs_job in messages:
+            work_queue.put(sqs_job)
+        for i in range(slots - len(messages)):
+            idle_slots.release()
+
+
+# Keep sqs message invisible while the job is making progress
+# 每 VisibilityTimeout/3 秒延长一次消息的不可见时间，超过 JobTimeout 没有进度就不再延长，消息超时后由其他 worker 续传
+# SQS 限制一条消息从收到起最长不可见 12 小时，超过后延长会失败，消息会重新可见
+def sqs_heartbeat(*, sqs, sqs_queue, job_receipt, progress, stop_signal, VisibilityTimeout, JobTimeout):
+    while not stop_signal.wait(max(VisibilityTimeout // 3, 1)):
+        stall_time = time.time() - progress['last']
+        if stall_time > JobTimeout:
+            logger.warning(f'No progress in {int(stall_time)} Seconds, stop extending sqs message visibility')
+            return
+        try:
+            sqs.change_message_visibility(
+                QueueUrl=sqs_queue,
+                ReceiptHandle=job_receipt,
+                VisibilityTimeout=VisibilityTimeout
+            )
+        except Exception as e:
+            logger.warning(f'Fail to extend sqs message visibility, stop heartbeat: {str(e)}')
+            return
+
+
 # Continuely get job message to invoke one processor per job
-def job_looper(*, sqs, sqs_queue, table, s3_src_client, s3_des_client, instance_id,
+# 每条消息单独处理、单独删除，一条失败不影响同批取回的其他消息
+def job_looper(*, sqs, sqs_queue, work_queue, idle_slots, table, s3_src_client, s3_des_client, instance_id,
                StorageClass, ChunkSize, MaxRetry, MaxThread, ResumableThreshold,
-               JobTimeout, ifVerifyMD5Twice, CleanUnfinishedUpload,
-               Des_bucket_default, Des_prefix_default, UpdateVersionId, GetObjectWithVersionId):
+               JobTimeout, VisibilityTimeout, ifVerifyMD5Twice, CleanUnfinishedUpload,
+               Des_bucket_default, Des_prefix_default, UpdateVersionId, GetObjectWithVersionId, JobType,
+               buffer_pool, MaxUploadThread, adaptive, rate_limiter, retry_policy, part_executor, SmallFileMaxThread):
     while True:
-        # Get Job from sqs
+        sqs_job = work_queue.get()
+        heartbeat_stop = threading.Event()
         try:
-            logger.info('Get Job from sqs queue...')
-            sqs_job_get = sqs.receive_message(QueueUrl=sqs_queue)
+            job = json.loads(sqs_job["Body"])
+            job_receipt = sqs_job["ReceiptHandle"]  # 用于后面删除message
+
+            # 判断是S3来的消息，而不是jodsender来的就转换一下
+            if 'Records' in job:  # S3来的消息带着'Records'
+                for One_record in job['Records']:
+                    if 's3' in One_record:
+                        Src_bucket = One_record['s3']['bucket']['name']
+                        Src_key = One_record['s3']['object']['key']
+                        Src_key = urllib.parse.unquote_plus(Src_key)
+                        Size = One_record['s3']['object']['size']
+                        if "versionId" in One_record['s3']['object']:
+                            versionId = One_record['s3']['object']['versionId']
+                        else:
+                            versionId = 'null'
+                        Des_bucket, Des_prefix = Des_bucket_default, Des_prefix_default
+                        Des_key = str(PurePosixPath(Des_prefix) / Src_key)
+                        if Src_key[-1] == '/':  # 针对空目录对象
+                            Des_key += '/'
+                        job = {
+                            'Src_bucket': Src_bucket,
+                            'Src_key': Src_key,
+                            'Size': Size,
+                            'Des_bucket': Des_bucket,
+                            'Des_key': Des_key,
+                            'versionId': versionId
+                        }
+            if 'Des_bucket' not in job and 'Event' not in job and 'Jobs' not in job:
+                logger.warning(f'Wrong sqs job: {json.dumps(job, default=str)}')
+                logger.warning('Try to handle next message')
+                time.sleep(1)
+                continue
+            if 'versionId' not in job and 'Jobs' not in job:
+                job['versionId'] = 'null'
+
+            # 处理期间由 heartbeat 线程延长消息不可见时间
+            progress = {'last': time.time()}
+            threading.Thread(target=sqs_heartbeat, daemon=True, kwargs=dict(
+                sqs=sqs,
+                sqs_queue=sqs_queue,
+                job_receipt=job_receipt,
+                progress=progress,
+                stop_signal=heartbeat_stop,
+                VisibilityTimeout=VisibilityTimeout,
+                JobTimeout=JobTimeout
+            )).start()
+
+            # 主流程
+            if 'Jobs' in job:  # jobsender 打包的多个小文件 Job
+                upload_etag_full = process_job_pack(
+                    job_pack=job,
+                    sqs=sqs,
+                    sqs_queue=sqs_queue,
+                    table=table,
+                    s3_src_client=s3_src_client,
+                    s3_des_client=s3_des_client,
+                    instance_id=instance_id,
+                    StorageClass=StorageClass,
+                    MaxRetry=MaxRetry,
+                    SmallFileMaxThread=SmallFileMaxThread,
+                    UpdateVersionId=UpdateVersionId,
+                    GetObjectWithVersionId=GetObjectWithVersionId,
+                    JobType=JobType,
+                    rate_limiter=rate_limiter,
+                    retry_policy=retry_policy
+                )
+            elif 'Event' not in job:
+                if job['Size'] > ResumableThreshold:
+                    upload_etag_full = step_function(
+                        job=job,
+                        table=table,
+                        s3_src_client=s3_src_client,
+                        s3_des_client=s3_des_client,
+                        instance_id=instance_id,
+                        StorageClass=StorageClass,
+                        ChunkSize=ChunkSize,
+                        MaxRetry=MaxRetry,
+                        MaxThread=MaxThread,
+                        JobTimeout=JobTimeout,
+                        ifVerifyMD5Twice=ifVerifyMD5Twice,
+                        CleanUnfinishedUpload=CleanUnfinishedUpload,
+                        UpdateVersionId=UpdateVersionId,
+                        GetObjectWithVersionId=GetObjectWithVersionId,
+                        progress=progress,
+                        JobType=JobType,
+                        buffer_pool=buffer_pool,
+                        MaxUploadThread=MaxUploadThread,
+                        adaptive=adaptive,
+                        rate_limiter=rate_limiter,
+                        retry_policy=retry_policy,
+                        part_executor=part_executor
+                    )
+                else:
+                    upload_etag_full = step_fn_small_file(
+                        job=job,
+                        table=table,
+                        s3_src_client=s3_src_client,
+                        s3_des_client=s3_des_client,
+                        instance_id=instance_id,
+                        StorageClass=StorageClass,
+                        MaxRetry=MaxRetry,
+                        UpdateVersionId=UpdateVersionId,
+                        GetObjectWithVersionId=GetObjectWithVersionId,
+                        JobType=JobType,
+                        rate_limiter=rate_limiter,
+                        retry_policy=retry_policy
+                    )
+            else:
+                if job['Event'] == 's3:TestEvent':
+                    logger.info('Skip s3:TestEvent')
+                    upload_etag_full = "s3:TestEvent"
+                else:
+                    upload_etag_full = "OtherEvent"
 
-            # Empty queue message available
-            if 'Messages' not in sqs_job_get:  # No message on sqs queue
-                logger.info('No message in queue available, wait...')
-                time.sleep(60)
+            heartbeat_stop.set()
 
-            # 拿到 Job message
-            else:
-                # TODO: 尚未完整处理 SQS 存在多条消息的情况的意外中断处理，建议只用于针对一次取一个SQS消息
-                for sqs_job in sqs_job_get["Messages"]:
-                    job = json.loads(sqs_job["Body"])
-                    job_receipt = sqs_job["ReceiptHandle"]  # 用于后面删除message
-
-                    # 判断是S3来的消息，而不是jodsender来的就转换一下
-                    if 'Records' in job:  # S3来的消息带着'Records'
-                        for One_record in job['Records']:
-                            if 's3' in One_record:
-                                Src_bucket = One_record['s3']['bucket']['name']
-                                Src_key = One_record['s3']['object']['key']
-                                Src_key = urllib.parse.unquote_plus(Src_key)
-                                Size = One_record['s3']['object']['size']
-                                if "versionId" in One_record['s3']['object']:
-                                    versionId = One_record['s3']['object']['versionId']
-                                else:
-                                    versionId = 'null'
-                                Des_bucket, Des_prefix = Des_bucket_default, Des_prefix_default
-                                Des_key = str(PurePosixPath(Des_prefix) / Src_key)
-                                if Src_key[-1] == '/':  # 针对空目录对象
-                                    Des_key += '/'
-                                job = {
-                                    'Src_bucket': Src_bucket,
-                                    'Src_key': Src_key,
-                                    'Size': Size,
-                                    'Des_bucket': Des_bucket,
-                                    'Des_key': Des_key,
-                                    'versionId': versionId
-                                }
-                    if 'Des_bucket' not in job and 'Event' not in job:
-                        logger.warning(f'Wrong sqs job: {json.dumps(job, default=str)}')
-                        logger.warning('Try to handle next message')
-                        time.sleep(1)
-                        continue
-                    if 'versionId' not in job:
-                        job['versionId'] = 'null'
+            # Del Job on sqs
+            logger.info(f'upload_etag_full={upload_etag_full}, job={str(job)}')
+            if upload_etag_full != "TIMEOUT":
+                # 如果是超时的就不删SQS消息，是正常结束或QUIT就删
+                # QUIT 是 NoSuchUpload, NoSuchKey, AccessDenied，可以认为没必要再让下一个worker再试了
+                # 直接删除SQS，并且DDB并不会记录结束状态
 
-                    # 主流程
-                    if 'Event' not in job:
-                        if job['Size'] > ResumableThreshold:
-                            upload_etag_full = step_function(
-                                job=job,
-                                table=table,
-                                s3_src_client=s3_src_client,
-                                s3_des_client=s3_des_client,
-                                instance_id=instance_id,
-                                StorageClass=StorageClass,
-                                ChunkSize=ChunkSize,
-                                MaxRetry=MaxRetry,
-                                MaxThread=MaxThread,
-                                JobTimeout=JobTimeout,
-                                ifVerifyMD5Twice=ifVerifyMD5Twice,
-                                CleanUnfinishedUpload=CleanUnfinishedUpload,
-                                UpdateVersionId=UpdateVersionId,
-                                GetObjectWithVersionId=GetObjectWithVersionId
-                            )
-                        else:
-                            upload_etag_full = step_fn_small_file(
-                                job=job,
-                                table=table,
-                                s3_src_client=s3_src_client,
-                                s3_des_client=s3_des_client,
-                                instance_id=instance_id,
-                                StorageClass=StorageClass,
-                                MaxRetry=MaxRetry,
-                                UpdateVersionId=UpdateVersionId,
-                                GetObjectWithVersionId=GetObjectWithVersionId
-                            )
-                    else:
-                        if job['Event'] == 's3:TestEvent':
-                            logger.info('Skip s3:TestEvent')
-                            upload_etag_full = "s3:TestEvent"
-                        else:
-                            upload_etag_full = "OtherEvent"
-
-                    # Del Job on sqs
-                    logger.info(f'upload_etag_full={upload_etag_full}, job={str(job)}')
-                    if upload_etag_full != "TIMEOUT":
-                        # 如果是超时的就不删SQS消息，是正常结束或QUIT就删
-                        # QUIT 是 NoSuchUpload, NoSuchKey, AccessDenied，可以认为没必要再让下一个worker再试了
-                        # 直接删除SQS，并且DDB并不会记录结束状态
-
-                        try:
-                            logger.info(f'Try to finsh job message on sqs. {str(job)}')
-                            sqs.delete_message(
-                                QueueUrl=sqs_queue,
-                                ReceiptHandle=job_receipt
-                            )
-                        except Exception as e:
-                            logger.error(f'Fail to delete sqs message: {str(sqs_job)}, {str(e)}')
+                try:
+                    logger.info(f'Try to finsh job message on sqs. {str(job)}')
+                    sqs.delete_message(
+                        QueueUrl=sqs_queue,
+                        ReceiptHandle=job_receipt
+                    )
+                except Exception as e:
+                    logger.error(f'Fail to delete sqs message: {str(sqs_job)}, {str(e)}')
 
         except Exception as e:
-            logger.error(f'Fail. Wait for 5 seconds. ERR: {str(e)}')
-            time.sleep(5)
+            logger.error(f'Fail to handle sqs message, it will be visible again after timeout: '
+                         f'{str(sqs_job)}, ERR: {str(e)}')
+        finally:
+            heartbeat_stop.set()
+            idle_slots.release()
         # Finish Job, go back to get next job in queue
 
 
@@ -809,7 +2537,9 @@ def clean_multipart_upload(*, s3_client, multipart_uploaded_list, Des_bucket):
 # Steps func for multipart upload for one job
 def step_function(*, job, table, s3_src_client, s3_des_client, instance_id,
                   StorageClass, ChunkSize, MaxRetry, MaxThread,
-                  JobTimeout, ifVerifyMD5Twice, CleanUnfinishedUpload, UpdateVersionId, GetObjectWithVersionId):
+                  JobTimeout, ifVerifyMD5Twice, CleanUnfinishedUpload, UpdateVersionId, GetObjectWithVersionId,
+                  progress, JobType, buffer_pool, MaxUploadThread, adaptive, rate_limiter, retry_policy,
+                  part_executor):
     # 正常开始处理
     Src_bucket = job['Src_bucket']
     Src_key = job['Src_key']
@@ -846,6 +2576,47 @@ def step_function(*, job, table, s3_src_client, s3_des_client, instance_id,
             prefix_and_key=Des_key,
             UploadIdList=multipart_uploaded_list
         )
+        if response_check_upload != 'UPLOAD':
+            reponse_uploadId = response_check_upload
+            logger.info(f'Resume upload id: {Des_bucket}/{Des_key}')
+            # 获取已上传partnumberList
+            partnumberList, part_sizes = checkPartnumberList(
+                Des_bucket=Des_bucket,
+                Des_key=Des_key,
+                uploadId=reponse_uploadId,
+                s3_des_client=s3_des_client
+            )
+            # Get versionId/Size from DDB，如果传输前或中断后文件被替换，Size可能改变，所以重新取启动时候的versionId和当时的Size
+            if UpdateVersionId:
+                versionId, Size = ddb_get(
+                    table=table,
+                    Src_bucket=Src_bucket,
+                    Src_key=Src_key
+                )
+                if versionId == "ERR":
+                    break
+                job['versionId'] = versionId
+                job['Size'] = Size
+            # 续传的文件按已上传分片的大小核对当时的分片大小，对不上则放弃这个 Upload 重新上传
+            ChunkSize_obj = resume_chunk_size(
+                Size=Size,
+                part_sizes=part_sizes,
+                ChunkSize_ddb=ddb_get_chunksize(
+                    table=table,
+                    Src_bucket=Src_bucket,
+                    Src_key=Src_key
+                ),
+                ChunkSize=ChunkSize
+            )
+            if not ChunkSize_obj:
+                logger.warning(f'Uploaded part sizes match no chunkSize, restart upload - {Des_bucket}/{Des_key}')
+                clean_multipart_upload(
+                    s3_client=s3_des_client,
+                    multipart_uploaded_list=multipart_uploaded_list,
+                    Des_bucket=Des_bucket
+                )
+                multipart_uploaded_list = []
+                response_check_upload = 'UPLOAD'
         if response_check_upload == 'UPLOAD':
             try:
                 logger.info(f'Create multipart upload - {Des_bucket}/{Des_key}')
@@ -867,54 +2638,61 @@ def step_function(*, job, table, s3_src_client, s3_des_client, instance_id,
                     job['versionId'] = versionId
                     job['Size'] = Size
                 reponse_uploadId = response_new_upload["UploadId"]
-                partnumberList = []
+                partnumberList = {}
                 # Write log to DDB in first round of job
                 # ddb_first_round(table, Src_bucket, Src_key, Size, versionId)
             except Exception as e:
                 logger.error(f'Fail to create new multipart upload - {Des_bucket}/{Des_key} - {str(e)}')
                 upload_etag_full = "ERR"
                 break
-        else:
-            reponse_uploadId = response_check_upload
-            logger.info(f'Resume upload id: {Des_bucket}/{Des_key}')
-            # 获取已上传partnumberList
-            partnumberList = checkPartnumberList(
-                Des_bucket=Des_bucket,
-                Des_key=Des_key,
-                uploadId=reponse_uploadId,
-                s3_des_client=s3_des_client
-            )
-            # Get versionId/Size from DDB，如果传输前或中断后文件被替换，Size可能改变，所以重新取启动时候的versionId和当时的Size
-            if UpdateVersionId:
-                versionId, Size = ddb_get(
-                    table=table,
-                    Src_bucket=Src_bucket,
-                    Src_key=Src_key
-                )
-                if versionId == "ERR":
-                    break
-                job['versionId'] = versionId
-                job['Size'] = Size
+            # 新上传的文件，设置了 adaptive 则按测得的吞吐选择分片大小
+            if adaptive is None:
+                ChunkSize_obj = ChunkSize
+            else:
+                ChunkSize_obj = adaptive.chunk_size(Size=Size, ChunkSize=ChunkSize, MaxThread=MaxThread)
         # 获取文件拆分片索引列表，例如[0, 10, 20]
         indexList, ChunkSize_auto = split(
             Size,
-            ChunkSize
+            ChunkSize_obj
         )  # 对于大于10000分片的大文件，自动调整为Chunksize_auto
 
         # Write log to DDB in first round of job
         percent = int(len(partnumberList) / len(indexList) * 100)
         # ddb_this_round(table, percent, Src_bucket, Src_key, instance_id)
-        ddb_start(table=table,
-                  percent=percent,
-                  job=job,
-                  instance_id=instance_id,
-                  new_upload=(response_check_upload == 'UPLOAD'))
+        chunk_saved = ddb_start(table=table,
+                                percent=percent,
+                                job=job,
+                                instance_id=instance_id,
+                                new_upload=(response_check_upload == 'UPLOAD'),
+                                ChunkSize=ChunkSize_auto)
+        # 自适应的分片大小没写进 DDB 时不用它，改用配置的 ChunkSize，续传时更容易核对上
+        if not chunk_saved and response_check_upload == 'UPLOAD' and ChunkSize_obj != ChunkSize:
+            logger.warning(f'Fail to save chunkSize {ChunkSize_auto}, use ChunkSize {ChunkSize} - '
+                           f'{Des_bucket}/{Des_key}')
+            indexList, ChunkSize_auto = split(Size, ChunkSize)
+
+        # ifVerifyMD5Twice 时记录每个分片的 MD5，续传时读回已上传分片的 MD5，不用重新下载
+        if ifVerifyMD5Twice:
+            part_md5_log = PartMd5Log(table=table, Src_bucket=Src_bucket, Src_key=Src_key, uploadId=reponse_uploadId)
+            if response_check_upload == 'UPLOAD':
+                part_md5s = {}
+            else:
+                part_md5s = ddb_get_part_md5(
+                    table=table,
+                    Src_bucket=Src_bucket,
+                    Src_key=Src_key,
+                    uploadId=reponse_uploadId
+                )
+        else:
+            part_md5_log, part_md5s = None, {}
 
         # Job Thread: uploadPart, 超时或Key不对返回 TIMEOUT/QUIT
+        part_etags = dict(partnumberList)  # 续传时已上传分片的 ETag，加上本次上传的
         upload_etag_full = job_processor(
             uploadId=reponse_uploadId,
             indexList=indexList,
             partnumberList=partnumberList,
+            part_etags=part_etags,
             job=job,
             s3_src_client=s3_src_client,
             s3_des_client=s3_des_client,
@@ -923,7 +2701,17 @@ def step_function(*, job, table, s3_src_client, s3_des_client, instance_id,
             MaxRetry=MaxRetry,
             JobTimeout=JobTimeout,
             ifVerifyMD5Twice=ifVerifyMD5Twice,
-            GetObjectWithVersionId=GetObjectWithVersionId
+            GetObjectWithVersionId=GetObjectWithVersionId,
+            progress=progress,
+            JobType=JobType,
+            buffer_pool=buffer_pool,
+            MaxUploadThread=MaxUploadThread,
+            adaptive=adaptive,
+            rate_limiter=rate_limiter,
+            retry_policy=retry_policy,
+            part_md5s=part_md5s,
+            part_md5_log=part_md5_log,
+            part_executor=part_executor
         )
         if upload_etag_full == "TIMEOUT" or upload_etag_full == "QUIT":
             logger.warning(f'Quit job upload_etag_full == {upload_etag_full} - {str(job)}')
@@ -949,6 +2737,7 @@ def step_function(*, job, table, s3_src_client, s3_des_client, instance_id,
             Des_bucket=Des_bucket,
             Des_key=Des_key,
             len_indexList=len(indexList),
+            part_etags=part_etags,
             s3_des_client=s3_des_client
         )
         if complete_etag == "ERR":
@@ -1041,8 +2830,51 @@ def ddb_get(*, table, Src_bucket, Src_key):
     return versionId, Size
 
 
+# Get chunkSize of the multipart upload from DDB, 0 if not recorded
+def ddb_get_chunksize(*, table, Src_bucket, Src_key):
+    table_key = str(PurePosixPath(Src_bucket) / Src_key)
+    if Src_key[-1] == '/':  # 针对空目录对象
+        table_key += '/'
+    try:
+        response = table.get_item(
+            Key={"Key": table_key},
+            AttributesToGet=["chunkSize"],
+            ConsistentRead=True
+        )
+        ChunkSize = int(response['Item']['chunkSize'])
+        logger.info(f'Got chunkSize: {ChunkSize} - {Src_bucket}/{Src_key}')
+    except Exception as e:
+        logger.info(f'No chunkSize in DDB - {Src_bucket}/{Src_key} - {str(e)}')
+        return 0
+    return ChunkSize
+
+
+# Get MD5 of uploaded parts of the multipart upload from DDB, {partnumber: digest}, empty if recorded for another upload
+def ddb_get_part_md5(*, table, Src_bucket, Src_key, uploadId):
+    table_key = str(PurePosixPath(Src_bucket) / Src_key)
+    if Src_key[-1] == '/':  # 针对空目录对象
+        table_key += '/'
+    part_md5s = {}
+    try:
+        response = table.get_item(
+            Key={"Key": table_key},
+            AttributesToGet=["partMd5", "partMd5UploadId"],
+            ConsistentRead=True
+        )
+        item = response.get('Item', {})
+        if item.get('partMd5UploadId') == uploadId:
+            for n_md5 in item.get('partMd5', []):
+                n, md5 = n_md5.split(':')
+                part_md5s[int(n)] = base64.b64decode(md5 + '==')
+        logger.info(f'Got part MD5 from DDB: {len(part_md5s)} - {Src_bucket}/{Src_key}')
+    except Exception as e:
+        logger.warning(f'Fail to get part MD5 from DDB - {Src_bucket}/{Src_key} - {str(e)}')
+    return part_md5s
+
+
 # # Write log to DDB in first round of job
-def ddb_start(*, table, percent, job, instance_id, new_upload):
+# ChunkSize 不为 0 时记录分片大小，续传时按同样的分片大小切分。返回是否写入成功
+def ddb_start(*, table, percent, job, instance_id, new_upload, ChunkSize):
     Src_bucket = job['Src_bucket']
     Src_key = job['Src_key']
     Size = job['Size']
@@ -1070,6 +2902,9 @@ def ddb_start(*, table, percent, job, instance_id, new_upload):
         ExpressionAttributeValues[":s"] = int(cur_time)
         ExpressionAttributeValues[":v"] = versionId
         UpdateExpression += ", firstTime =:s, versionId =:v"
+    if ChunkSize:
+        ExpressionAttributeValues[":c"] = ChunkSize
+        UpdateExpression += ", chunkSize =:c"
     try:
         table.update_item(
             Key={"Key": table_key},
@@ -1079,7 +2914,8 @@ def ddb_start(*, table, percent, job, instance_id, new_upload):
     except Exception as e:
         # 日志写不了
         logger.error(f'Fail to put log to DDB at start job - {Src_bucket}/{Src_key} - {str(e)}')
-        return
+        return False
+    return True
 
 
 # DynamoDB log: ADD status: DONE/ERR(upload_etag_full)
@@ -1104,6 +2940,7 @@ def ddb_complete(*, upload_etag_full, table, Src_bucket, Src_key):
     if status == "DONE":
         UpdateExpression += ", lastTimeProgress=:p"
         ExpressionAttributeValues[":p"] = 100
+    UpdateExpression += " REMOVE partMd5, partMd5UploadId"  # 文件结束后不再需要分片的 MD5 记录
 
     # update DDB
     logger.info(f'Write job complete status to DDB: {status} - {Src_bucket}/{Src_key}')
@@ -1118,37 +2955,53 @@ def ddb_complete(*, upload_etag_full, table, Src_bucket, Src_key):
     return
 
 
-def step_fn_small_file(*, job, table, s3_src_client, s3_des_client, instance_id, StorageClass, MaxRetry,
-                       UpdateVersionId, GetObjectWithVersionId):
-    # 开始处理小文件
+# Head source object to update versionId and Size of the job, return False if fail
+def update_job_version(*, job, s3_src_client):
+    versionId, Size = head_s3_version(
+        s3_src_client=s3_src_client,
+        Src_bucket=job['Src_bucket'],
+        Src_key=job['Src_key']
+    )
+    if versionId == "ERR":
+        return False
+    job['versionId'] = versionId
+    job['Size'] = Size
+    return True
+
+
+# Get and put (or copy) one small file with retries, return ETag, or QUIT/TIMEOUT
+def transfer_small_file(*, job, s3_src_client, s3_des_client, StorageClass, MaxRetry, GetObjectWithVersionId, JobType,
+                        rate_limiter, retry_policy):
     Src_bucket = job['Src_bucket']
     Src_key = job['Src_key']
     Size = job['Size']
     Des_bucket = job['Des_bucket']
     Des_key = job['Des_key']
     versionId = job['versionId']
-    # If update versionID enabled, update s3 versionID
-    if UpdateVersionId:
-        versionId = head_s3_version(
-                        s3_src_client=s3_src_client,
-                        Src_bucket=Src_bucket,
-                        Src_key=Src_key
-                    )
-        job['versionId'] = versionId
-
-    logger.info(f'Start small: {Src_bucket}/{Src_key}, Size: {Size}, versionId: {versionId}')
-    # Write DDB log for first round
-    ddb_start(table=table,
-              percent=0,
-              job=job,
-              instance_id=instance_id,
-              new_upload=True)
-
     upload_etag_full = []
+    retry_budget, retry_delay = retry_policy.file_budget(), 0
     for retryTime in range(MaxRetry + 1):
         try:
+            if JobType.upper() == "COPY":  # S3 服务端复制，数据不经过 worker
+                CopySource = {'Bucket': Src_bucket, 'Key': Src_key}
+                if GetObjectWithVersionId:
+                    CopySource['VersionId'] = versionId
+                logger.info(f'--->Copying {Size} Bytes {Src_bucket}/{Src_key} to {Des_bucket}/{Des_key}'
+                            f' - Small file 1/1')
+                rate_limiter.acquire('src', 0)
+                rate_limiter.acquire('des', 0)
+                response_copy_object = s3_des_client.copy_object(
+                    CopySource=CopySource,
+                    Bucket=Des_bucket,
+                    Key=Des_key,
+                    StorageClass=StorageClass
+                )
+                upload_etag_full = response_copy_object['CopyObjectResult']['ETag']
+                break
+
             # Get object
             logger.info(f'--->Downloading {Size} Bytes {Src_bucket}/{Src_key} - Small file 1/1')
+            rate_limiter.acquire('src', Size)
             if GetObjectWithVersionId:
                 response_get_object = s3_src_client.get_object(
                     Bucket=Src_bucket,
@@ -1166,6 +3019,7 @@ def step_fn_small_file(*, job, table, s3_src_client, s3_des_client, instance_id,
 
             # Put object
             logger.info(f'--->Uploading {Size} Bytes {Des_bucket}/{Des_key} - Small file 1/1')
+            rate_limiter.acquire('des', Size)
             response_put_object = s3_des_client.put_object(
                 Body=getBody,
                 Bucket=Des_bucket,
@@ -1186,11 +3040,53 @@ def step_fn_small_file(*, job, table, s3_src_client, s3_des_client, instance_id,
             if retryTime >= MaxRetry:
                 logger.error(f'Fail MaxRetry Download/Upload small file: {Des_bucket}/{Des_key}')
                 return "TIMEOUT"
-            else:
-                time.sleep(5 * retryTime)
+            retry_delay = retry_policy.backoff(e, retry_delay, retry_budget)
+            if retry_delay is None:
+                logger.error(f'Quit for file retry budget: {retry_budget.limit} - {Des_bucket}/{Des_key}')
+                return "TIMEOUT"
         except Exception as e:
-            logger.error(f'Fail in step_fn_small - {Des_bucket}/{Des_key} - {str(e)}')
-            return "TIMEOUT"
+            # 超时、连接断开等网络错误同样退避重试
+            logger.warning(f'Fail to transfer small file - {Des_bucket}/{Des_key} - {str(e)}, Attempts: {retryTime}')
+            if retryTime >= MaxRetry:
+                logger.error(f'Fail MaxRetry Download/Upload small file: {Des_bucket}/{Des_key}')
+                return "TIMEOUT"
+            retry_delay = retry_policy.backoff(e, retry_delay, retry_budget)
+            if retry_delay is None:
+                logger.error(f'Quit for file retry budget: {retry_budget.limit} - {Des_bucket}/{Des_key}')
+                return "TIMEOUT"
+    return upload_etag_full
+
+
+def step_fn_small_file(*, job, table, s3_src_client, s3_des_client, instance_id, StorageClass, MaxRetry,
+                       UpdateVersionId, GetObjectWithVersionId, JobType, rate_limiter, retry_policy):
+    # 开始处理小文件
+    # If update versionID enabled, update s3 versionID
+    if UpdateVersionId and not update_job_version(job=job, s3_src_client=s3_src_client):
+        return "TIMEOUT"
+    Src_bucket = job['Src_bucket']
+    Src_key = job['Src_key']
+    logger.info(f'Start small: {Src_bucket}/{Src_key}, Size: {job["Size"]}, versionId: {job["versionId"]}')
+    # Write DDB log for first round
+    ddb_start(table=table,
+              percent=0,
+              job=job,
+              instance_id=instance_id,
+              new_upload=True,
+              ChunkSize=0)
+
+    upload_etag_full = transfer_small_file(
+        job=job,
+        s3_src_client=s3_src_client,
+        s3_des_client=s3_des_client,
+        StorageClass=StorageClass,
+        MaxRetry=MaxRetry,
+        GetObjectWithVersionId=GetObjectWithVersionId,
+        JobType=JobType,
+        rate_limiter=rate_limiter,
+        retry_policy=retry_policy
+    )
+    if upload_etag_full in ["QUIT", "TIMEOUT"]:
+        return upload_etag_full
 
     # Write DDB log for complete
     ddb_complete(
@@ -1201,3 +3097,51 @@ def step_fn_small_file(*, job, table, s3_src_client, s3_des_client, instance_id,
     )
     # complete one job
     return upload_etag_full
+
+
+# Process a packed message of small file jobs in parallel, and re-queue the failed jobs one job per message
+# Return TIMEOUT if fail to re-queue, so the packed message is not deleted and will be retried as a whole
+# 整包的小文件在 SmallFileMaxThread 个线程上并发按 step_fn_small_file 处理，传输前后的 ddb_start/ddb_complete
+# 也在这些线程上并发写入，与单个小文件一样用 UpdateItem 累加 tryTimes/instanceID/jobStatus
+def process_job_pack(*, job_pack, sqs, sqs_queue, table, s3_src_client, s3_des_client, instance_id,
+                     StorageClass, MaxRetry, SmallFileMaxThread, UpdateVersionId, GetObjectWithVersionId, JobType,
+                     rate_limiter, retry_policy):
+    jobs = job_pack['Jobs']
+    logger.info(f'Start job pack: {len(jobs)} small files')
+    for job in jobs:
+        if 'versionId' not in job:
+            job['versionId'] = 'null'
+
+    def small_file(job):
+        return step_fn_small_file(
+            job=job,
+            table=table,
+            s3_src_client=s3_src_client,
+            s3_des_client=s3_des_client,
+            instance_id=instance_id,
+            StorageClass=StorageClass,
+            MaxRetry=MaxRetry,
+            UpdateVersionId=UpdateVersionId,
+            GetObjectWithVersionId=GetObjectWithVersionId,
+            JobType=JobType,
+            rate_limiter=rate_limiter,
+            retry_policy=retry_policy
+        )
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(min(SmallFileMaxThread, len(jobs)), 1)) as pool:
+        results = list(pool.map(small_file, jobs))
+    failed_jobs = [job for job, result in zip(jobs, results) if result == "TIMEOUT"]
+    if not failed_jobs:
+        logger.info(f'Complete job pack: {len(jobs)} small files')
+        return "DONE"
+
+    # 失败的 Job 单独重新发回 SQS，让下一个 worker 再试
+    logger.warning(f'Re-queue {len(failed_jobs)} failed jobs of job pack: {len(jobs)} small files')
+    for i in range(0, len(failed_jobs), 10):
+        sqs_message = [{"Id": str(n), "MessageBody": json.dumps(job)}
+                       for n, job in enumerate(failed_jobs[i:i + 10])]
+        sent = send_sqs_batch(sqs=sqs, sqs_queue=sqs_queue, sqs_message=sqs_message, MaxRetry=MaxRetry)
+        if sent != len(sqs_message):
+            logger.error('Fail to re-queue failed jobs of job pack, keep the job pack message in queue')
+            return "TIMEOUT"
+    return "DONE"
@@ -34,12 +34,29 @@ Des_prefix_default = 'from-jp'
 JobType = 'PUT'
 # 'PUT': Destination Bucket is not the same account as Lambda.
 # 'GET': Source bucket is not the same account as Lambda.
+# 'COPY': Source and destination are in the same partition. Copy inside S3 with destination credentials (as 'PUT'),
+#   data never goes through Lambda. The destination credentials need to read the source bucket.
 
 MaxRetry = '20'  # Max retry for requests
+RetryMaxDelay = '20'  # Cap of seconds to wait before a retry, exponential backoff with jitter by error type
+FileRetryBudget = '100'  # Max retries of all parts of one file, '0' for no limit
 MaxThread = '50'  # Max threads per file
+MaxUploadThread = '0'  # Max uploading threads per file, pipelined with MaxThread downloading threads. 0: not pipelined
+AdaptiveTransfer = 'False'  # Adaptive part size per file and per-file threads from measured throughput
+MaxChunkSize = '64'  # MBytes, max part size when AdaptiveTransfer
+SrcMaxBandwidth = '0'  # MBytes/s, downloading from source of all running Lambda, '0' for no limit
+SrcMaxRequestRate = '0'  # Requests/s to source of all running Lambda, '0' for no limit
+DesMaxBandwidth = '0'  # MBytes/s, uploading to destination of all running Lambda, '0' for no limit
+DesMaxRequestRate = '0'  # Requests/s to destination of all running Lambda, '0' for no limit
+RateLimitSchedule = ''  # e.g. '01:00-09:00*0.5' (UTC): only limit in the windows with the factor, '' for always limit
 MaxParallelFile = '1'  # Recommend to be 1 in AWS Lambda
 JobTimeout = '870'  # Timeout for each job, should be less than AWS Lambda timeout
 JobsenderCompareVersionId = 'False'  # Jobsender should compare versioinId of source B3 bucket and versionId in DDB
+VersionIndexSegments = '1'  # Jobsender scan versionId in DDB with parallel segments, '1' for one paginated query
+ListConcurrency = '1'  # >1: Jobsender list each bucket with concurrent threads on key range shards, '1' for serial
+SqsSendConcurrency = '10'  # Jobsender send SQS message batches with concurrent threads
+SmallFileJobsPerMessage = '1'  # >1: Jobsender packs small file jobs into one SQS message, '1' for one job per message
+SmallFileMaxThread = '50'  # Threads to transfer the small files of one packed message and write their DDB logs
 UpdateVersionId = 'False'  # get lastest version id from s3 before before get object
 GetObjectWithVersionId = 'False'  # get object together with the specified version id
 
@@ -152,7 +169,18 @@ class CdkResourceStack(core.Stack):
                                    'ssm_parameter_credentials': ssm_parameter_credentials,
                                    'JobType': JobType,
                                    'MaxRetry': MaxRetry,
+                                   'RetryMaxDelay': RetryMaxDelay,
+                                   'FileRetryBudget': FileRetryBudget,
                                    'MaxThread': MaxThread,
+                                   'MaxUploadThread': MaxUploadThread,
+                                   'SmallFileMaxThread': SmallFileMaxThread,
+                                   'AdaptiveTransfer': AdaptiveTransfer,
+                                   'MaxChunkSize': MaxChunkSize,
+                                   'SrcMaxBandwidth': SrcMaxBandwidth,
+                                   'SrcMaxRequestRate': SrcMaxRequestRate,
+                                   'DesMaxBandwidth': DesMaxBandwidth,
+                                   'DesMaxRequestRate': DesMaxRequestRate,
+                                   'RateLimitSchedule': RateLimitSchedule,
                                    'MaxParallelFile': MaxParallelFile,
                                    'JobTimeout': JobTimeout,
                                    'UpdateVersionId': UpdateVersionId,
@@ -176,13 +204,18 @@ class CdkResourceStack(core.Stack):
                                              'ssm_parameter_bucket': ssm_bucket_para.parameter_name,
                                              'JobType': JobType,
                                              'MaxRetry': MaxRetry,
-                                             'JobsenderCompareVersionId': JobsenderCompareVersionId
+                                             'JobsenderCompareVersionId': JobsenderCompareVersionId,
+                                             'VersionIndexSegments': VersionIndexSegments,
+                                             'ListConcurrency': ListConcurrency,
+                                             'SqsSendConcurrency': SqsSendConcurrency,
+                                             'SmallFileJobsPerMessage': SmallFileJobsPerMessage
                                          })
 
         # Allow lambda read/write DDB, SQS
         ddb_file_list.grant_read_write_data(handler)
         ddb_file_list.grant_read_write_data(handler_jobsender)
         sqs_queue.grant_send_messages(handler_jobsender)
+        sqs_queue.grant_send_messages(handler)  # Lambda worker re-queue failed jobs of a job pack
         # SQS trigger Lambda worker
         handler.add_event_source(SqsEventSource(sqs_queue, batch_size=1))
 
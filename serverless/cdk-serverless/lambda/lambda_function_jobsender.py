@@ -7,7 +7,8 @@ import ssl
 import urllib.request
 import urllib.error
 from operator import itemgetter
-from s3_migration_lib import get_des_file_list, get_src_file_list, job_upload_sqs_ddb, delta_job_list, check_sqs_empty
+from s3_migration_lib import get_des_file_list, get_src_file_list, job_upload_sqs_ddb, delta_job_list, check_sqs_empty, \
+    pack_small_jobs
 from botocore.config import Config
 import boto3
 
@@ -22,6 +23,13 @@ ssm_parameter_bucket = os.environ['ssm_parameter_bucket']
 JobType = os.environ['JobType']
 MaxRetry = int(os.environ['MaxRetry'])  # 最大请求重试次数
 JobsenderCompareVersionId = os.environ['JobsenderCompareVersionId'].upper() == 'TRUE'
+ListConcurrency = int(os.environ['ListConcurrency'])  # 并发列表 S3 的线程数
+VersionIndexSegments = int(os.environ['VersionIndexSegments'])  # 从 DDB 并行分段读取目的桶 versionId 的线程数
+SqsSendConcurrency = int(os.environ['SqsSendConcurrency'])  # 并发发送 SQS batch 的线程数
+SmallFileJobsPerMessage = int(os.environ['SmallFileJobsPerMessage'])  # 多个小文件 Job 打包成一条 SQS 消息
+
+# 内部参数
+ResumableThreshold = 5 * 1024 * 1024  # Same as Lambda worker, small file is not multipart uploaded
 
 # Set environment
 s3_config = Config(max_pool_connections=50, retries={'max_attempts': MaxRetry})  # 最大连接数
@@ -95,7 +103,9 @@ def lambda_handler(event, context):
                 s3_client=s3_src_client,
                 bucket=src_bucket,
                 S3Prefix=src_prefix,
-                JobsenderCompareVersionId=JobsenderCompareVersionId
+                JobsenderCompareVersionId=JobsenderCompareVersionId,
+                ListConcurrency=ListConcurrency,
+                snapshot=None
             )
             logger.info('Get destination bucket')
             des_file_list = get_des_file_list(
@@ -103,7 +113,10 @@ def lambda_handler(event, context):
                 bucket=des_bucket,
                 S3Prefix=des_prefix,
                 table=table,
-                JobsenderCompareVersionId=JobsenderCompareVersionId
+                JobsenderCompareVersionId=JobsenderCompareVersionId,
+                ListConcurrency=ListConcurrency,
+                VersionIndexSegments=VersionIndexSegments,
+                snapshot=None
             )
             # Generate job list
             job_list, ignore_records = delta_job_list(
@@ -122,7 +135,14 @@ def lambda_handler(event, context):
                 job_upload_sqs_ddb(
                     sqs=sqs,
                     sqs_queue=sqs_queue,
-                    job_list=job_list
+                    job_list=pack_small_jobs(
+                        job_list=job_list,
+                        ResumableThreshold=ResumableThreshold,
+                        JobsPerMessage=SmallFileJobsPerMessage
+                    ),
+                    SqsSendConcurrency=SqsSendConcurrency,
+                    MaxRetry=MaxRetry,
+                    send_pool=None
                 )
                 max_object = max(job_list, key=itemgetter('Size'))
                 MaxChunkSize = int(max_object['Size'] / 10000) + 1024
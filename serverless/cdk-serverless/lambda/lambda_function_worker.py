@@ -14,7 +14,8 @@ from pathlib import PurePosixPath
 import boto3
 from botocore.config import Config
 
-from s3_migration_lib import step_function, step_fn_small_file
+from s3_migration_lib import step_function, step_fn_small_file, process_job_pack, BufferPool, AdaptiveController, \
+    RateLimiter, parse_rate_schedule, RetryPolicy, PartExecutor
 
 # 环境变量
 table_queue_name = os.environ['table_queue_name']
@@ -29,17 +30,32 @@ ssm_parameter_credentials = os.environ['ssm_parameter_credentials']
 checkip_url = os.environ['checkip_url']
 JobType = os.environ['JobType']
 MaxRetry = int(os.environ['MaxRetry'])  # 最大请求重试次数
+RetryMaxDelay = float(os.environ['RetryMaxDelay'])  # 重试等待的上限秒数
+FileRetryBudget = int(os.environ['FileRetryBudget'])  # 单个文件所有分片合计的最多重试次数
 MaxThread = int(os.environ['MaxThread'])  # 最大线程数
+MaxUploadThread = int(os.environ['MaxUploadThread'])  # 上传目的端线程数，与下载流水线同时进行
+SmallFileMaxThread = int(os.environ['SmallFileMaxThread'])  # 并发传输一条打包消息中小文件的线程数
 MaxParallelFile = int(os.environ['MaxParallelFile'])  # Lambda 中暂时没用到
 JobTimeout = int(os.environ['JobTimeout'])
 UpdateVersionId = os.environ['UpdateVersionId'].upper() == 'TRUE'  # get lastest version id from s3 before get object
+AdaptiveTransfer = os.environ['AdaptiveTransfer'].upper() == 'TRUE'  # 按测得的吞吐自适应分片大小和并发
+MaxChunkSize = int(os.environ['MaxChunkSize']) * 1024 * 1024
 GetObjectWithVersionId = os.environ['GetObjectWithVersionId'].upper() == 'TRUE'  # get object with version id
+# 所有运行中的 Lambda 合计的限速，0 不限，各 Lambda 实例在 DDB 登记心跳后平分
+SrcMaxBandwidth = float(os.environ['SrcMaxBandwidth']) * 1024 * 1024
+SrcMaxRequestRate = float(os.environ['SrcMaxRequestRate'])
+DesMaxBandwidth = float(os.environ['DesMaxBandwidth']) * 1024 * 1024
+DesMaxRequestRate = float(os.environ['DesMaxRequestRate'])
+RateLimitSchedule = parse_rate_schedule(os.environ['RateLimitSchedule'])
 
 # 内部参数
 ResumableThreshold = 5 * 1024 * 1024  # Accelerate to ignore small file
 CleanUnfinishedUpload = False  # For debug
 ChunkSize = 5 * 1024 * 1024  # For debug, will be auto-change
 ifVerifyMD5Twice = False  # For debug
+# 分片缓冲区在同一个 Lambda 实例的多次调用间复用，上限为 Lambda 内存的一半
+buffer_pool = BufferPool(int(os.environ['AWS_LAMBDA_FUNCTION_MEMORY_SIZE']) * 1024 * 1024 // 2)
+adaptive = AdaptiveController(MaxChunkSize) if AdaptiveTransfer else None  # 测得的吞吐在同一个 Lambda 实例的多次调用间保留
 s3_config = Config(max_pool_connections=200,
                    retries={'max_attempts': MaxRetry})  # 最大连接数
 
@@ -49,6 +65,7 @@ logger.setLevel(logging.INFO)
 
 dynamodb = boto3.resource('dynamodb')
 table = dynamodb.Table(table_queue_name)
+sqs = boto3.client('sqs')
 
 # 取另一个Account的credentials
 ssm = boto3.client('ssm')
@@ -76,6 +93,17 @@ try:
 except urllib.error.URLError as e:
     logger.warning(f'Fail to connect to checkip api: {checkip_url} - {str(e)}')
     instance_id = 'lambda-ip-timeout'
+rate_limiter = RateLimiter(
+    SrcMaxBandwidth=SrcMaxBandwidth,
+    SrcMaxRequestRate=SrcMaxRequestRate,
+    DesMaxBandwidth=DesMaxBandwidth,
+    DesMaxRequestRate=DesMaxRequestRate,
+    schedule=RateLimitSchedule,
+    table=table if SrcMaxBandwidth or SrcMaxRequestRate or DesMaxBandwidth or DesMaxRequestRate else None,
+    instance_id=os.environ['AWS_LAMBDA_LOG_STREAM_NAME']  # 每个 Lambda 实例的日志流不同，NAT 出口 IP 则可能相同
+)
+retry_policy = RetryPolicy(RetryMaxDelay=RetryMaxDelay, FileRetryBudget=FileRetryBudget)
+part_executor = PartExecutor(MaxThread + MaxUploadThread)  # 分片线程在同一个 Lambda 实例的多次调用间复用
 
 
 class TimeoutOrMaxRetry(Exception):
@@ -101,6 +129,32 @@ def lambda_handler(event, context):
                 logger.info('Skip s3:TestEvent')
                 continue
 
+        # jobsender 打包的多个小文件 Job，并发处理，失败的 Job 单独发回 SQS
+        if 'Jobs' in job:
+            # 从 eventSourceARN 取 SQS 队列，arn:aws:sqs:region:account:queue_name
+            _, _, _, _, queue_account, queue_name = trigger_record['eventSourceARN'].split(':')
+            sqs_queue = sqs.get_queue_url(QueueName=queue_name, QueueOwnerAWSAccountId=queue_account)['QueueUrl']
+            upload_etag_full = process_job_pack(
+                job_pack=job,
+                sqs=sqs,
+                sqs_queue=sqs_queue,
+                table=table,
+                s3_src_client=s3_src_client,
+                s3_des_client=s3_des_client,
+                instance_id=instance_id,
+                StorageClass=StorageClass,
+                MaxRetry=MaxRetry,
+                SmallFileMaxThread=SmallFileMaxThread,
+                UpdateVersionId=UpdateVersionId,
+                GetObjectWithVersionId=GetObjectWithVersionId,
+                JobType=JobType,
+                rate_limiter=rate_limiter,
+                retry_policy=retry_policy
+            )
+            if upload_etag_full == "TIMEOUT":
+                raise TimeoutOrMaxRetry
+            continue
+
         # 判断是S3来的消息，而不是jodsender来的就转换一下
         if 'Records' in job:  # S3来的消息带着'Records'
             for One_record in job['Records']:
@@ -148,7 +202,15 @@ def lambda_handler(event, context):
                                 ifVerifyMD5Twice=ifVerifyMD5Twice,
                                 CleanUnfinishedUpload=CleanUnfinishedUpload,
                                 UpdateVersionId=UpdateVersionId,
-                                GetObjectWithVersionId=GetObjectWithVersionId
+                                GetObjectWithVersionId=GetObjectWithVersionId,
+                                progress=None,  # Lambda 有运行时长上限，JobTimeout 保持为整个文件的超时时间
+                                JobType=JobType,
+                                buffer_pool=buffer_pool,
+                                MaxUploadThread=MaxUploadThread,
+                                adaptive=adaptive,
+                                rate_limiter=rate_limiter,
+                                retry_policy=retry_policy,
+                                part_executor=part_executor
                             )
         else:
             upload_etag_full = step_fn_small_file(
@@ -160,7 +222,10 @@ def lambda_handler(event, context):
                                 StorageClass=StorageClass,
                                 MaxRetry=MaxRetry,
                                 UpdateVersionId=UpdateVersionId,
-                                GetObjectWithVersionId=GetObjectWithVersionId
+                                GetObjectWithVersionId=GetObjectWithVersionId,
+                                JobType=JobType,
+                                rate_limiter=rate_limiter,
+                                retry_policy=retry_policy
                             )
         if upload_etag_full != "TIMEOUT" and upload_etag_full != "ERR":
             # 如果是超时或ERR的就不删SQS消息，是正常结束就删
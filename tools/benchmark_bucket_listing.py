@@ -0,0 +1,100 @@
+# Benchmark bucket listing on a local stub S3: serial paginator vs key-range sharded concurrent listing
+# 在本地模拟的 S3 列表接口（带请求延迟）上，对比单线程 paginator 与按Key区间分片并发列表的速度，
+# Key 可以是多层目录、单层平铺的递增序号，或单层平铺的随机 hash
+
+import argparse
+import hashlib
+import logging
+import sys
+import time
+from bisect import bisect_left, bisect_right
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'cluster' / 'cdk-cluster' / 'code'))
+from s3_migration_lib import get_src_file_list  # noqa: E402
+
+logging.basicConfig(level=logging.WARNING)
+
+
+# 模拟 list_objects_v2 paginator：每页最多 1000 个，支持 Prefix 和 Delimiter，每次请求 sleep latency 秒
+class StubPaginator:
+    def __init__(self, keys, latency):
+        self.keys = keys
+        self.latency = latency
+
+    def paginate(self, Bucket, Prefix='', Delimiter=None):
+        i = bisect_left(self.keys, Prefix)
+        contents, common_prefixes = [], []
+        while i < len(self.keys) and self.keys[i].startswith(Prefix):
+            key = self.keys[i]
+            if Delimiter and Delimiter in key[len(Prefix):]:
+                common = key[:key.index(Delimiter, len(Prefix)) + 1]
+                common_prefixes.append({"Prefix": common})
+                i = bisect_left(self.keys, common[:-1] + chr(ord(Delimiter) + 1))  # 跳过整个子目录
+            else:
+                contents.append({"Key": key, "Size": len(key)})
+                i += 1
+            if len(contents) + len(common_prefixes) == 1000:
+                time.sleep(self.latency)
+                yield {"Contents": contents, "CommonPrefixes": common_prefixes}
+                contents, common_prefixes = [], []
+        time.sleep(self.latency)
+        yield {"Contents": contents, "CommonPrefixes": common_prefixes}
+
+
+class StubS3Client:
+    def __init__(self, keys, latency):
+        self.keys = sorted(keys)
+        self.latency = latency
+
+    def get_paginator(self, operation_name):
+        return StubPaginator(self.keys, self.latency)
+
+    # 单次 list_objects_v2 请求，支持 StartAfter
+    def list_objects_v2(self, Bucket, Prefix='', StartAfter='', MaxKeys=1000):
+        time.sleep(self.latency)
+        i = bisect_right(self.keys, StartAfter) if StartAfter > Prefix else bisect_left(self.keys, Prefix)
+        contents = []
+        while i < len(self.keys) and self.keys[i].startswith(Prefix) and len(contents) < MaxKeys:
+            contents.append({"Key": self.keys[i], "Size": len(self.keys[i])})
+            i += 1
+        return {"Contents": contents, "IsTruncated": i < len(self.keys) and self.keys[i].startswith(Prefix)}
+
+
+def gen_keys(total, dirs, layout):
+    if layout == 'flat':
+        return [f'flat/obj-{i:09d}' for i in range(total)]
+    if layout == 'hash':
+        return [f'flat/{hashlib.md5(str(i).encode()).hexdigest()}' for i in range(total)]
+    return [f'data/{i % dirs:04d}/{i // dirs % 10}/obj-{i:09d}' for i in range(total)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark serial vs sharded bucket listing on stub S3')
+    parser.add_argument('--keys', type=int, default=1000000, help='Number of objects, default 1000000')
+    parser.add_argument('--dirs', type=int, default=200, help='Number of first level directories, default 200')
+    parser.add_argument('--layout', choices=['dirs', 'flat', 'hash'], default='dirs',
+                        help='dirs: 3 levels of directories, flat: sequence numbers in one prefix, '
+                             'hash: random hex names in one prefix. Default dirs')
+    parser.add_argument('--latency', type=float, default=0.05, help='Seconds per list request, default 0.05')
+    parser.add_argument('--concurrency', default='1,4,16,32', help='Comma separated ListConcurrency values')
+    args = parser.parse_args()
+
+    s3_client = StubS3Client(gen_keys(args.keys, args.dirs, args.layout), args.latency)
+    baseline, serial_time = None, None
+    for concurrency in [int(c) for c in args.concurrency.split(',')]:
+        start = time.perf_counter()
+        file_list = get_src_file_list(
+            s3_client=s3_client,
+            bucket='stub-bucket',
+            S3Prefix='',
+            JobsenderCompareVersionId=False,
+            ListConcurrency=concurrency,
+            snapshot=None
+        )
+        spent = time.perf_counter() - start
+        if baseline is None:
+            baseline, serial_time = file_list, spent
+        assert file_list == baseline, 'Sharded listing differs from the first listing'
+        print(f'ListConcurrency {concurrency:3d}: {len(file_list):,} objects in {spent:.2f} s, '
+              f'speedup: x{serial_time / spent:.1f}')
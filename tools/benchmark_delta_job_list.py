@@ -0,0 +1,105 @@
+# Benchmark jobsender compare time (delta_job_list) on synthetic bucket listings
+# 用合成的源/目的桶列表测试 Jobsender 对比耗时，对比旧的 O(N×M) 列表查找与新的索引查找
+
+import argparse
+import logging
+import random
+import sys
+import time
+from fnmatch import fnmatchcase
+from pathlib import Path, PurePosixPath
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'cluster' / 'cdk-cluster' / 'code'))
+from s3_migration_lib import delta_job_list  # noqa: E402
+
+logging.basicConfig(level=logging.WARNING)
+
+
+# 生成合成列表：目的桶包含 done_ratio 比例的源文件，其余为需要迁移的 delta
+def gen_listing(total, done_ratio, seed=0):
+    rnd = random.Random(seed)
+    src_file_list, des_file_list = [], []
+    for i in range(total):
+        entry = {
+            "Key": f'data/{i % 1000:03d}/part-{i:010d}.bin',
+            "Size": rnd.randint(0, 64 * 1024 * 1024),
+            "versionId": 'null'
+        }
+        src_file_list.append(entry)
+        if rnd.random() < done_ratio:
+            des_file_list.append(dict(entry))
+    rnd.shuffle(des_file_list)
+    return src_file_list, des_file_list
+
+
+# 旧版 delta_job_list 的对比逻辑（src in des_file_list），仅用于基准对比
+def legacy_delta_job_list(*, src_file_list, des_file_list, src_bucket, des_bucket, des_prefix, ignore_list):
+    job_list = []
+    ignore_records = []
+    for src in src_file_list:
+        src_bucket_key = src_bucket + '/' + src['Key']
+        if any(fnmatchcase(src_bucket_key, ignore_key) for ignore_key in ignore_list):
+            ignore_records.append(src_bucket_key)
+            continue
+        if src in des_file_list:
+            continue
+        Des_key = str(PurePosixPath(des_prefix) / src["Key"])
+        if src["Key"][-1] == '/':
+            Des_key += '/'
+        job_list.append({
+            "Src_bucket": src_bucket,
+            "Src_key": src["Key"],
+            "Des_bucket": des_bucket,
+            "Des_key": Des_key,
+            "Size": src["Size"],
+            "versionId": src['versionId']
+        })
+    return job_list, ignore_records
+
+
+def run(total, done_ratio, legacy_max):
+    src_file_list, des_file_list = gen_listing(total, done_ratio)
+    print(f'--- {total:,} keys (destination has {len(des_file_list):,})')
+
+    start = time.perf_counter()
+    job_list, ignore_records = delta_job_list(
+        src_file_list=src_file_list,
+        des_file_list=des_file_list,
+        src_bucket='src-bucket',
+        src_prefix='',
+        des_bucket='des-bucket',
+        des_prefix='',
+        ignore_list=[],
+        JobsenderCompareVersionId=False
+    )
+    after = time.perf_counter() - start
+    print(f'after : {after:10.2f} s  jobs: {len(job_list):,}')
+
+    # 旧算法是 O(N×M)，只在 legacy_max 规模的子集上实测，再按平方关系外推到全量
+    sample = min(total, legacy_max)
+    sample_src, sample_des = gen_listing(sample, done_ratio)
+    start = time.perf_counter()
+    legacy_jobs, _ = legacy_delta_job_list(
+        src_file_list=sample_src,
+        des_file_list=sample_des,
+        src_bucket='src-bucket',
+        des_bucket='des-bucket',
+        des_prefix='',
+        ignore_list=[]
+    )
+    before = (time.perf_counter() - start) * (total / sample) ** 2
+    note = '' if sample == total else f' (extrapolated from {sample:,} keys)'
+    print(f'before: {before:10.2f} s{note}  speedup: x{before / after:,.0f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark jobsender delta_job_list compare time')
+    parser.add_argument('--sizes', default='1000000,5000000,10000000',
+                        help='Comma separated listing sizes, default 1M,5M,10M')
+    parser.add_argument('--done-ratio', type=float, default=0.9,
+                        help='Ratio of source keys already in destination, default 0.9')
+    parser.add_argument('--legacy-max', type=int, default=20000,
+                        help='Max listing size to really run the old O(NxM) compare on, default 20000')
+    args = parser.parse_args()
+    for size in args.sizes.split(','):
+        run(int(size), args.done_ratio, args.legacy_max)
@@ -0,0 +1,88 @@
+# Benchmark memory of the jobsender file list: list of dicts vs compact FileList
+# 对比 Jobsender 文件列表用 dict 列表和 FileList 存放时的内存占用，以及构建、遍历、排序、查找（与 dict 索引对比）的耗时
+
+import argparse
+import logging
+import random
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'cluster' / 'cdk-cluster' / 'code'))
+from s3_migration_lib import FileList  # noqa: E402
+
+logging.basicConfig(level=logging.WARNING)
+
+
+# 与 list_objects_v2 返回的一样，每个对象的 Key 都是新的字符串
+def gen_files(total, versioned):
+    for i in range(total):
+        yield {
+            "Key": f'data/{i % 1000:03d}/year=2020/month={i % 12 + 1:02d}/part-{i:010d}.snappy.parquet',
+            "Size": i * 7 % (64 * 1024 * 1024),
+            "versionId": f'{i:032x}' if versioned else 'null'
+        }
+
+
+def measure(build):
+    tracemalloc.start()
+    start = time.perf_counter()
+    file_list = build()
+    spent = time.perf_counter() - start
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return file_list, memory, spent
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark memory of list of dicts vs FileList')
+    parser.add_argument('--sizes', default='1000000,10000000', help='Comma separated numbers of objects')
+    parser.add_argument('--versioned', action='store_true', help='Every object has its own versionId')
+    parser.add_argument('--lookups', type=int, default=100000, help='Number of key lookups, default 100000')
+    args = parser.parse_args()
+
+    MB = 1024 * 1024
+    for total in [int(n) for n in args.sizes.split(',')]:
+        print(f'--- {total:,} objects')
+        dict_list, dict_memory, dict_spent = measure(lambda: list(gen_files(total, args.versioned)))
+        print(f'list of dicts: {dict_memory / MB:8.1f} MB, {dict_memory / total:5.0f} bytes/object, '
+              f'built in {dict_spent:.1f} s')
+        del dict_list
+
+        file_list, list_memory, list_spent = measure(lambda: FileList(gen_files(total, args.versioned)))
+        print(f'FileList:      {list_memory / MB:8.1f} MB, {list_memory / total:5.0f} bytes/object, '
+              f'built in {list_spent:.1f} s, x{dict_memory / list_memory:.1f} smaller')
+
+        start = time.perf_counter()
+        count = sum(1 for _ in file_list)
+        print(f'Iterate {count:,} objects in {time.perf_counter() - start:.1f} s')
+
+        # 打乱后排序
+        rnd = random.Random(0)
+        order = list(range(total))
+        rnd.shuffle(order)
+        shuffled = FileList(file_list[i] for i in order)
+        del order
+        start = time.perf_counter()
+        shuffled.sort()
+        print(f'Sort shuffled FileList in {time.perf_counter() - start:.1f} s')
+        assert len(shuffled) == total and shuffled.is_sorted()
+        del shuffled
+
+        # 建哈希索引后随机查找，与 dict 索引对比
+        start = time.perf_counter()
+        file_list.build_index()
+        index_memory = file_list.index.itemsize * len(file_list.index)
+        print(f'Build FileList index in {time.perf_counter() - start:.1f} s, {index_memory / total:.0f} bytes/object')
+        keys = [file_list[rnd.randrange(total)]["Key"] for _ in range(args.lookups)]
+        keys += [key + '-missing' for key in keys[:args.lookups // 10]]
+        start = time.perf_counter()
+        found = sum(file_list.get(key) is not None for key in keys)
+        print(f'{len(keys):,} FileList lookups in {time.perf_counter() - start:.2f} s')
+        assert found == args.lookups
+        dict_index = {file["Key"]: (file["Size"], file["versionId"]) for file in file_list}
+        start = time.perf_counter()
+        assert sum(dict_index.get(key) is not None for key in keys) == found
+        print(f'{len(keys):,} dict lookups in {time.perf_counter() - start:.2f} s')
+        del file_list, dict_index
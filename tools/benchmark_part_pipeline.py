@@ -0,0 +1,129 @@
+# Benchmark part transfer in job_processor on a local stub S3 with injected latency and link bandwidth
+# 在本地模拟的源/目的 S3（各自的请求延迟和共享带宽）上，对比每个线程下载完接着上传与下载/上传流水线的吞吐
+
+import argparse
+import hashlib
+import logging
+import os
+import sys
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'cluster' / 'cdk-cluster' / 'code'))
+from s3_migration_lib import BufferPool, PartExecutor, RateLimiter, RetryPolicy, job_processor, split  # noqa: E402
+
+logging.basicConfig(level=logging.WARNING)
+
+
+# 模拟一个方向的网络链路：并发传输共享带宽，按先后排队占用链路时间，每个请求再加上固定延迟
+class StubLink:
+    def __init__(self, latency, bandwidth):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.free_at = 0
+        self.lock = threading.Lock()
+
+    def transfer(self, size):
+        with self.lock:
+            start = max(time.perf_counter(), self.free_at)
+            self.free_at = start + size / self.bandwidth
+            done_at = self.free_at
+        time.sleep(max(done_at - time.perf_counter(), 0) + self.latency)
+
+
+class StubBody:
+    def __init__(self, data):
+        self.data = memoryview(data)
+        self.pos = 0
+
+    def read(self, amt):
+        block = self.data[self.pos:self.pos + amt]
+        self.pos += len(block)
+        return bytes(block)
+
+
+class StubSrcClient:
+    def __init__(self, data, link):
+        self.data = data
+        self.link = link
+
+    def get_object(self, Bucket, Key, Range):
+        start, end = map(int, Range[len('bytes='):].split('-'))
+        part = self.data[start:end + 1]
+        self.link.transfer(len(part))
+        return {"Body": StubBody(part), "ContentLength": len(part)}
+
+
+class StubDesClient:
+    def __init__(self, link):
+        self.link = link
+
+    def upload_part(self, Body, Bucket, Key, PartNumber, UploadId, ContentMD5):
+        if hasattr(Body, 'read'):  # 临时文件
+            Body = Body.read()
+        self.link.transfer(len(Body))
+        return {"ETag": '"%s"' % hashlib.md5(Body).hexdigest()}
+
+
+def run(data, chunk_size, src_link, des_link, max_thread, max_upload_thread, spool_threshold=0):
+    job = {'Src_bucket': 'src', 'Src_key': 'obj', 'Des_bucket': 'des', 'Des_key': 'obj',
+           'versionId': 'null', 'Size': len(data)}
+    indexList, ChunkSize = split(len(data), chunk_size)
+    start = time.perf_counter()
+    etag = job_processor(
+        uploadId='stub',
+        indexList=indexList,
+        partnumberList={},
+        part_etags={},
+        job=job,
+        s3_src_client=StubSrcClient(data, src_link),
+        s3_des_client=StubDesClient(des_link),
+        MaxThread=max_thread,
+        ChunkSize=ChunkSize,
+        MaxRetry=1,
+        JobTimeout=3600,
+        ifVerifyMD5Twice=False,
+        GetObjectWithVersionId=False,
+        progress=None,
+        JobType='PUT',
+        buffer_pool=BufferPool(1024 * 1024 * 1024, spool_threshold),
+        MaxUploadThread=max_upload_thread,
+        adaptive=None,
+        rate_limiter=RateLimiter(SrcMaxBandwidth=0, SrcMaxRequestRate=0, DesMaxBandwidth=0, DesMaxRequestRate=0,
+                                 schedule=[], table=None, instance_id='stub'),
+        retry_policy=RetryPolicy(RetryMaxDelay=20, FileRetryBudget=0),
+        part_md5s={},
+        part_md5_log=None,
+        part_executor=PartExecutor(max_thread + max_upload_thread)
+    )
+    return etag, time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark serial vs pipelined part transfer on stub S3')
+    parser.add_argument('--size', type=int, default=400, help='Object size in MB, default 400')
+    parser.add_argument('--chunk', type=int, default=5, help='ChunkSize in MB, default 5')
+    parser.add_argument('--src-latency', type=float, default=0.3, help='Seconds per source request, default 0.3')
+    parser.add_argument('--des-latency', type=float, default=0.3, help='Seconds per destination request, default 0.3')
+    parser.add_argument('--bandwidth', type=float, default=100, help='MB/s of each direction, default 100')
+    parser.add_argument('--spool-threshold', type=int, default=0,
+                        help='PartSpoolThreshold in MB, parts larger than it go through temp files, default 0')
+    parser.add_argument('--configs', default='8:0,8:8,16:0,8:4',
+                        help='Comma separated MaxThread:MaxUploadThread, MaxUploadThread 0 means not pipelined')
+    args = parser.parse_args()
+
+    MB = 1024 * 1024
+    data = os.urandom(args.size * MB)
+    baseline = None
+    for config in args.configs.split(','):
+        max_thread, max_upload_thread = map(int, config.split(':'))
+        etag, spent = run(data, args.chunk * MB,
+                          StubLink(args.src_latency, args.bandwidth * MB),
+                          StubLink(args.des_latency, args.bandwidth * MB),
+                          max_thread, max_upload_thread, args.spool_threshold * MB)
+        if baseline is None:
+            baseline = etag
+        assert etag == baseline, f'ETag differs: {etag} - {baseline}'
+        print(f'MaxThread {max_thread:3d}, MaxUploadThread {max_upload_thread:3d}: {args.size} MB in {spent:.2f} s, '
+              f'{args.size / spent:.1f} MB/s')
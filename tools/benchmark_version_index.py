@@ -0,0 +1,87 @@
+# Benchmark loading destination versionId from a local stub DDB table with 1MB pages and injected latency
+# 在本地模拟的 DDB desBucket-index（按 1MB 分页，带请求延迟）上，对比单个分页 Query 与并行分段 Scan 的加载时间，
+# 以及 VersionIndex 与 dict（每个 key/versionId 都是新字符串）的内存占用
+
+import argparse
+import logging
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'cluster' / 'cdk-cluster' / 'code'))
+from s3_migration_lib import get_versionid_from_ddb  # noqa: E402
+
+logging.basicConfig(level=logging.WARNING)
+
+
+# 模拟 desBucket-index 的 query/scan：每页约 1MB，Scan 按 Segment 切分整个 index，每次请求 sleep latency 秒
+class StubTable:
+    def __init__(self, items, page_items, latency):
+        self.items = items
+        self.partitions = {}
+        for i in items:
+            self.partitions.setdefault(i['desBucket'], []).append(i)
+        self.page_items = page_items
+        self.latency = latency
+
+    def page(self, items, des_bucket, ExclusiveStartKey):
+        start = ExclusiveStartKey['n'] if ExclusiveStartKey else 0
+        end = min(start + self.page_items, len(items))
+        time.sleep(self.latency)
+        r = {'Items': [{'desKey': i['desKey'], 'versionId': i['versionId']}
+                       for i in items[start:end] if i['desBucket'] == des_bucket]}
+        if end < len(items):
+            r['LastEvaluatedKey'] = {'n': end}
+        return r
+
+    def query(self, IndexName, ExpressionAttributeValues, ProjectionExpression, KeyConditionExpression,
+              ExclusiveStartKey=None):
+        des_bucket = ExpressionAttributeValues[':b']
+        return self.page(self.partitions[des_bucket], des_bucket, ExclusiveStartKey)
+
+    def scan(self, IndexName, ExpressionAttributeValues, ProjectionExpression, FilterExpression,
+             Segment, TotalSegments, ExclusiveStartKey=None):
+        return self.page(self.items[Segment::TotalSegments], ExpressionAttributeValues[':b'], ExclusiveStartKey)
+
+
+# 其中 1/10 是其他目的桶的记录，Scan 需要过滤掉
+def gen_items(total, versioned):
+    return [{'desBucket': 'des' if i % 10 else 'other', 'desKey': f'data/{i % 200:04d}/obj-{i:09d}',
+             'versionId': f'v{i:030d}' if i % 100 < versioned else 'null'} for i in range(total)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark versionId loading from stub DDB')
+    parser.add_argument('--items', type=int, default=1000000, help='Number of DDB items, default 1000000')
+    parser.add_argument('--versioned', type=int, default=10, help='Percent of items with a real versionId, default 10')
+    parser.add_argument('--page-items', type=int, default=8000, help='Items per 1MB page, default 8000')
+    parser.add_argument('--latency', type=float, default=0.1, help='Seconds per DDB request, default 0.1')
+    parser.add_argument('--segments', default='1,4,16', help='Comma separated VersionIndexSegments values')
+    args = parser.parse_args()
+
+    table = StubTable(gen_items(args.items, args.versioned), args.page_items, args.latency)
+    for segments in [int(s) for s in args.segments.split(',')]:
+        start = time.perf_counter()
+        index = get_versionid_from_ddb(des_bucket='des', table=table, VersionIndexSegments=segments)
+        spent = time.perf_counter() - start
+        assert len(index) == len(table.partitions['des']), f'Loaded {len(index)} versionIds'
+        print(f'VersionIndexSegments {segments:3d}: {len(index):,} versionIds in {spent:.2f} s')
+
+    # 与 boto3 反序列化的结果一样，dict 的每个 key/versionId 都是新的字符串
+    del index
+    table.page_items, table.latency = args.items, 0
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    ver_dict = {}
+    for i in table.query(IndexName='desBucket-index', ExpressionAttributeValues={':b': 'des'},
+                         ProjectionExpression='desKey, versionId', KeyConditionExpression='desBucket=:b')['Items']:
+        ver_dict[i['desKey'].encode().decode()] = i['versionId'].encode().decode()
+    dict_bytes = tracemalloc.get_traced_memory()[0] - base
+    del ver_dict
+    base = tracemalloc.get_traced_memory()[0]
+    index = get_versionid_from_ddb(des_bucket='des', table=table, VersionIndexSegments=1)
+    index_bytes = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+    print(f'dict: {dict_bytes / 1024 / 1024:.1f} MB, VersionIndex: {index_bytes / 1024 / 1024:.1f} MB '
+          f'for {len(index):,} versionIds, x{dict_bytes / index_bytes:.1f} smaller')
@@ -0,0 +1,129 @@
+# Verify jobsender compare results on randomized listings
+# 用随机生成的源/目的桶列表（含 unicode、以 '/' 结尾的目录对象、互为前缀的Key、不属于目的前缀的Key）
+# 校验 merge-join、hash 索引、流式对比三种方式与旧的列表查找对比结果完全一致
+
+import argparse
+import logging
+import random
+import sys
+from pathlib import Path, PurePosixPath
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'cluster' / 'cdk-cluster' / 'code'))
+from s3_migration_lib import FileList, delta_job_list, get_des_file_list, get_src_file_list, \
+    iter_des_file_list, iter_src_file_list, stream_delta_job_list  # noqa: E402
+from benchmark_bucket_listing import StubS3Client  # noqa: E402
+from benchmark_delta_job_list import legacy_delta_job_list  # noqa: E402
+
+logging.basicConfig(level=logging.ERROR)
+
+KEY_CHARS = ['a', 'b', 'Z', '0', '-', '.', ' ', '/', '/', 'é', 'ß', '中', '文', '😀', ' ']
+
+
+def gen_key(rnd):
+    key = ''.join(rnd.choice(KEY_CHARS) for _ in range(rnd.randint(1, 10)))
+    return key.lstrip('/') or 'k'
+
+
+# 生成一组随机 case：源桶对象，目的桶对象（部分一致、部分大小不同），以及不属于目的前缀的干扰对象
+def gen_case(rnd, des_prefix):
+    src_objects = {}
+    for _ in range(rnd.randint(0, 60)):
+        key = gen_key(rnd)
+        if rnd.random() < 0.2:
+            key += '/'  # 目录对象
+        src_objects[key] = rnd.choice([0, 1, 5, 1024])
+    des_objects = {}
+    for key, size in src_objects.items():
+        r = rnd.random()
+        if r < 0.5:
+            des_key = str(PurePosixPath(des_prefix) / key)
+            if key[-1] == '/':
+                des_key += '/'
+            des_objects[des_key] = size if r < 0.4 else size + 1
+    for _ in range(rnd.randint(0, 10)):
+        if des_prefix:
+            des_objects[des_prefix.rstrip('/') + rnd.choice(['-other/', '0', 'x/']) + gen_key(rnd)] = 1
+        else:
+            des_objects[gen_key(rnd)] = 1
+    return src_objects, des_objects
+
+
+class SizedStubS3Client(StubS3Client):
+    def __init__(self, objects):
+        super().__init__(list(objects), 0)
+        self.objects = objects
+
+    def get_paginator(self, operation_name):
+        paginator = super().get_paginator(operation_name)
+        objects = self.objects
+
+        class SizedPaginator:
+            def paginate(self, **kwargs):
+                for page in paginator.paginate(**kwargs):
+                    for n in page["Contents"]:
+                        n["Size"] = objects[n["Key"]]
+                    yield page
+        return SizedPaginator()
+
+
+def verify(rounds, seed):
+    rnd = random.Random(seed)
+    total_jobs = 0
+    for i in range(rounds):
+        des_prefix = rnd.choice(['', 'backup', 'backup/', 'b/2020', '中文'])
+        src_objects, des_objects = gen_case(rnd, des_prefix)
+        # S3 按 UTF-8 字节序返回列表，与 Python 字符串按码位排序的结果一致
+        assert sorted(src_objects) == sorted(src_objects, key=lambda k: k.encode('utf-8'))
+        src_client, des_client = SizedStubS3Client(src_objects), SizedStubS3Client(des_objects)
+        list_concurrency = rnd.choice([1, 3])
+        ignore_list = rnd.choice([[], ['src/a*'], ['*/', 'src/中*']])
+        kwargs = dict(src_bucket='src', src_prefix='', des_bucket='des', des_prefix=des_prefix,
+                      ignore_list=ignore_list, JobsenderCompareVersionId=False)
+
+        src_file_list = get_src_file_list(s3_client=src_client, bucket='src', S3Prefix='',
+                                          JobsenderCompareVersionId=False, ListConcurrency=list_concurrency,
+                                          snapshot=None)
+        des_file_list = get_des_file_list(s3_client=des_client, bucket='des', S3Prefix=des_prefix, table=None,
+                                          JobsenderCompareVersionId=False, ListConcurrency=list_concurrency,
+                                          VersionIndexSegments=1, snapshot=None)
+        # 目的列表只包含 des_prefix 下的对象
+        assert len(des_file_list) == sum(1 for k in des_objects if k.startswith(str(PurePosixPath(des_prefix)) + '/')
+                                         or not des_prefix)
+
+        expect = legacy_delta_job_list(src_file_list=src_file_list, des_file_list=des_file_list,
+                                       src_bucket='src', des_bucket='des', des_prefix=des_prefix,
+                                       ignore_list=ignore_list)
+        merge_result = delta_job_list(src_file_list=src_file_list, des_file_list=des_file_list, **kwargs)
+        shuffled_des = list(des_file_list)
+        rnd.shuffle(shuffled_des)
+        hash_result = delta_job_list(src_file_list=src_file_list, des_file_list=shuffled_des, **kwargs)
+        # 未排序的 FileList 用自带的哈希索引查找，不能改变调用者列表的顺序
+        shuffled_file_list = FileList(shuffled_des)
+        file_list_result = delta_job_list(src_file_list=src_file_list, des_file_list=shuffled_file_list, **kwargs)
+        assert list(shuffled_file_list) == shuffled_des, f'FileList reordered, round {i}'
+        stream_ignore = []
+        stream_jobs = list(stream_delta_job_list(
+            src_file_iter=iter_src_file_list(s3_client=src_client, bucket='src', S3Prefix='',
+                                             JobsenderCompareVersionId=False, ListConcurrency=list_concurrency,
+                                             snapshot=None),
+            des_file_iter=iter_des_file_list(s3_client=des_client, bucket='des', S3Prefix=des_prefix, table=None,
+                                             JobsenderCompareVersionId=False, ListConcurrency=list_concurrency,
+                                             VersionIndexSegments=1, snapshot=None),
+            ignore_records=stream_ignore,
+            **kwargs
+        ))
+        assert merge_result == expect, f'merge-join differs, round {i}'
+        assert hash_result == expect, f'hash index differs, round {i}'
+        assert file_list_result == expect, f'FileList index differs, round {i}'
+        assert (stream_jobs, stream_ignore) == expect, f'stream compare differs, round {i}'
+        total_jobs += len(expect[0])
+    print(f'{rounds} randomized rounds passed, {total_jobs} jobs compared')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Verify jobsender compare results on randomized listings')
+    parser.add_argument('--rounds', type=int, default=2000, help='Number of randomized rounds, default 2000')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed, default 0')
+    args = parser.parse_args()
+    verify(args.rounds, args.seed)